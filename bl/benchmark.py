@@ -0,0 +1,413 @@
+# -*- coding: utf8 -*-
+"""
+DESCRIPTION:
+
+Throughput benchmark of LocNuclei over the bundled data-sets. Every case is predicted end to end by locnuclei.py
+in its own process, reporting proteins per second, peak RSS and the per-stage breakdown of its run-statistics
+(see bl/run_statistics.py). With --stages the BLAST- and the SVM-track are additionally run on their own, in this
+process, on all proteins of a case.
+
+Cases:
+ - example: the proteins in example/
+ - dataset: the independent sets of development_dataset/ (sn_indep_hval20.fa, tr_indep_hval0_rr_hval20.fa) - the
+   fasta-files come without profiles, so the profiles ({AC}.profile) need to be given with --profile_folder
+ - synthetic: batches of the example proteins repeated to the sizes given with --sizes - every repetition but the
+   first is a point mutant, so the batches are not predicted as duplicates of the example proteins
+
+The predictions are checked against development_dataset/subnuclear.locnuclei_predictions and
+traveler.locnuclei_predictions for all proteins listed there, the unchanged copies in the synthetic batches against
+the predictions of the example proteins. The benchmark exits with an error if any prediction differs.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from bl.helper import Helper
+from bl.kernel_backend import DEFAULT_KERNEL_BACKEND, KERNEL_BACKENDS
+from bl.locnuclei_predictor import LocNucleiPredictor
+from bl.protein import Protein
+from bl.run_statistics import RunStatistics
+
+
+class Benchmark(object):
+
+    PACKAGE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    EXAMPLE_FOLDER = os.path.join(PACKAGE_FOLDER, 'example')
+    DATASET_FOLDER = os.path.join(PACKAGE_FOLDER, 'development_dataset')
+    # mode -> tupel(predict traveller, reference predictions, independent data-set)
+    MODES = OrderedDict([('sn', (False, 'subnuclear.locnuclei_predictions', 'sn_indep_hval20.fa')),
+                         ('tr', (True, 'traveler.locnuclei_predictions', 'tr_indep_hval0_rr_hval20.fa'))])
+    CASES = ('example', 'dataset', 'synthetic')
+    SYNTHETIC_SIZES = (10, 100, 1000, 10000)
+    AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'  # substitutes of the point mutations of synthetic proteins
+    REPORT_VERSION = 1
+
+    def run(self, modes, cases, synthetic_sizes):
+        """ Run all cases for all modes
+        :return: List of the results of all runs, as written to the report
+        """
+        for mode in modes:
+            example_predictions = None
+            if 'example' in cases or 'synthetic' in cases:
+                # synthetic batches are checked against the predictions of the example proteins they consist of
+                example_predictions = self.run_case(mode, 'example', self.EXAMPLE_FOLDER, self.EXAMPLE_FOLDER,
+                                                    self.reference_predictions(mode))
+            if 'dataset' in cases:
+                self.run_dataset_case(mode)
+            if 'synthetic' in cases:
+                for size in synthetic_sizes:
+                    self.run_synthetic_case(mode, size, example_predictions)
+
+        return self.results
+
+    def run_dataset_case(self, mode):
+        dataset_fasta = os.path.join(self.DATASET_FOLDER, self.MODES[mode][2])
+        if not self.profile_folder:
+            print('Skipping {fl}: its profiles need to be given with --profile_folder'.format(fl=dataset_fasta))
+            return
+
+        case_folder = self.case_folder(mode, 'dataset')
+        missing_profiles = 0
+        for header, sequence in self.read_fasta_entries(dataset_fasta):
+            ac = header.split('#')[1].strip()
+            profile_file = os.path.join(self.profile_folder, '{ac}.profile'.format(ac=ac))
+            if not os.path.isfile(profile_file):
+                missing_profiles += 1
+                continue
+            self.write_case_protein(case_folder, ac, sequence, profile_file)
+        if missing_profiles:
+            print('{nr} proteins of {fl} were skipped, their profile is not in {dr}'.format(
+                nr=missing_profiles, fl=dataset_fasta, dr=self.profile_folder))
+
+        self.run_case(mode, 'dataset', case_folder, case_folder, self.reference_predictions(mode))
+
+    def run_synthetic_case(self, mode, size, example_predictions):
+        """ Predict a batch of the example proteins, each repeated under a new name until there are size proteins.
+        Every repetition but the first is a point mutant, so LocNuclei can't predict the batch as duplicates.
+        """
+        case_name = 'synthetic_{nr}'.format(nr=size)
+        case_folder = self.case_folder(mode, case_name)
+        helper = Helper(self.verbose)
+        example_names = sorted(name[:-len('.fasta')] for name in os.listdir(self.EXAMPLE_FOLDER)
+                               if name.endswith('.fasta'))
+        expected_predictions = dict()
+        for protein_nr in range(size):
+            example_name = example_names[protein_nr % len(example_names)]
+            copy_nr = protein_nr // len(example_names)
+            protein_name = 'syn{nr}{ac}'.format(nr=protein_nr, ac=example_name)
+            example_fasta = os.path.join(self.EXAMPLE_FOLDER, '{p}.fasta'.format(p=example_name))
+            sequence = ''.join(helper.clean_fasta_input(example_fasta, protein_name)[1:])
+            self.write_case_protein(case_folder, protein_name, self.mutated_sequence(sequence, copy_nr),
+                                    os.path.join(self.EXAMPLE_FOLDER, '{p}.profile'.format(p=example_name)))
+            # a mutant may legitimately be predicted differently, only the unchanged copy is checked
+            if copy_nr == 0 and example_predictions and example_name in example_predictions:
+                expected_predictions[protein_name] = example_predictions[example_name]
+
+        self.run_case(mode, case_name, case_folder, case_folder, expected_predictions)
+
+    def mutated_sequence(self, sequence, copy_nr):
+        """ :return: The sequence with deterministic point mutations - copy 0 is the unchanged sequence, the
+        following len(sequence) * 19 copies are all different single mutants (enough for 10000 proteins of the
+        example), later copies get further mutations, which may repeat earlier copies """
+        residues = list(sequence)
+        mutant_nr = copy_nr
+        position_offset = 0
+        while mutant_nr > 0:
+            mutant_nr -= 1
+            position = (mutant_nr + position_offset) % len(residues)
+            mutant_nr //= len(residues)
+            substitutes = [amino_acid for amino_acid in self.AMINO_ACIDS if amino_acid != residues[position]]
+            residues[position] = substitutes[mutant_nr % len(substitutes)]
+            mutant_nr //= len(substitutes)
+            position_offset += 1  # further mutations of later copies start at another position
+
+        return ''.join(residues)
+
+    def run_case(self, mode, case_name, fasta_folder, blast_folder, expected_predictions):
+        """ Predict the proteins of a case end to end (and track by track with --stages) and check the predictions
+        :return: Predictions of the end to end run, as returned by read_predictions
+        """
+        protein_count = len([name for name in os.listdir(fasta_folder) if name.endswith('.fasta')])
+        print('Benchmarking {c} ({nr} proteins) for mode {m}'.format(c=case_name, nr=protein_count, m=mode))
+        result, predictions = self.run_end_to_end(mode, case_name, fasta_folder, blast_folder, protein_count)
+        compared, mismatches = self.compare_predictions(predictions, expected_predictions)
+        result['compared_predictions'] = compared
+        result['mismatches'] = mismatches
+        if self.with_stages:
+            result['tracks'] = self.run_tracks(mode, case_name, fasta_folder, blast_folder)
+
+        self.results.append(result)
+        self.print_result(result)
+        return predictions
+
+    def run_end_to_end(self, mode, case_name, fasta_folder, blast_folder, protein_count):
+        """ Predict the proteins with locnuclei.py in its own process, so its peak RSS is the one of this case only
+        :return: tupel(result of the run, predictions as returned by read_predictions)
+        """
+        run_folder = tempfile.mkdtemp(prefix='run_', dir=self.case_folder(mode, case_name))
+        output_file = os.path.join(run_folder, 'predictions.txt')
+        stats_file = os.path.join(run_folder, 'stats.json')
+        call = [sys.executable, os.path.join(self.PACKAGE_FOLDER, 'locnuclei.py'), fasta_folder, blast_folder,
+                output_file, '--fasta_suffix', '*.fasta', '--blast_suffix', '*.profile', '--jobs', str(self.jobs),
+                '--kernel_backend', self.kernel_backend, '--stats_file', stats_file]
+        if self.MODES[mode][0]:
+            call.append('--traveller')
+        if self.batch_size:
+            call.extend(['--batch_size', str(self.batch_size)])
+        if self.verbose:
+            print(' '.join(call))
+
+        wall_start = time.perf_counter()
+        process = subprocess.Popen(call, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.PACKAGE_FOLDER)
+        out, err = process.communicate()
+        wall_seconds = time.perf_counter() - wall_start
+        if process.returncode != 0 or not os.path.isfile(stats_file):
+            print(out.decode('utf8', 'replace'))
+            print(err.decode('utf8', 'replace'))
+            error('LocNuclei failed for {c} in mode {m} with exit-code {nr}'.format(c=case_name, m=mode,
+                                                                                  nr=process.returncode))
+            exit(750)
+
+        with open(stats_file, 'r') as stats_src:
+            stats = json.load(stats_src)
+        result = OrderedDict([
+            ('case', case_name),
+            ('mode', mode),
+            ('proteins', protein_count),
+            ('wall_seconds', round(wall_seconds, 6)),  # including start-up of the interpreter and the predictors
+            ('proteins_per_second', round(protein_count / wall_seconds, 3) if wall_seconds > 0 else None),
+            ('cpu_seconds', stats['cpu_seconds']),
+            ('peak_rss_bytes', stats['peak_rss_bytes']),
+            ('peak_child_rss_bytes', stats['peak_child_rss_bytes']),
+            ('stages', stats['stages']),
+            ('counters', stats['counters']),
+        ])
+        return result, self.read_predictions(output_file)
+
+    def run_tracks(self, mode, case_name, fasta_folder, blast_folder):
+        """ Run the BLAST- and the SVM-track on their own on all proteins of the case, i.e. the SVMs also predict the
+        proteins with BLAST-hit
+        :return: Stages of both tracks as in the run-statistics report
+        """
+        run_statistics = RunStatistics(self.verbose)
+        case_folder = self.case_folder(mode, case_name)
+        with LocNucleiPredictor(self.verbose, False, self.MODES[mode][0], self.jobs,
+                                kernel_backend=self.kernel_backend, run_statistics=run_statistics) as loc_nuclei:
+            loc_nuclei.prepare_temporary_directory(case_folder)
+            with run_statistics.stage('track_load'):
+                loc_nuclei.load_predictors()
+            input_files = loc_nuclei.find_input_files(fasta_folder, '*.fasta', blast_folder, '*.profile')
+
+            loc_nuclei.blast_predictor.working_directory = tempfile.mkdtemp(prefix='blast_', dir=case_folder)
+            with run_statistics.stage('track_blast', len(input_files)):
+                loc_nuclei.blast_predictor.predict_all_query_proteins(self.query_proteins(input_files))
+
+            loc_nuclei.svm_predictor.working_directory = tempfile.mkdtemp(prefix='svm_', dir=case_folder)
+            with run_statistics.stage('track_svm', len(input_files)):
+                loc_nuclei.svm_predictor.predict_all_query_proteins_without_blast_hit(
+                    self.query_proteins(input_files))
+
+        return run_statistics.report()['stages']
+
+    def query_proteins(self, input_files):
+        """ :return: OrderedDict of protein name to a new Protein, for the input files found by find_input_files """
+        query_proteins = OrderedDict()
+        for protein_name, (fasta_file, blast_file) in input_files.items():
+            query_proteins[protein_name] = Protein(self.verbose)
+            query_proteins[protein_name].fasta_file = fasta_file
+            query_proteins[protein_name].blast_file = blast_file
+
+        return query_proteins
+
+    def reference_predictions(self, mode):
+        return self.read_predictions(os.path.join(self.DATASET_FOLDER, self.MODES[mode][1]))
+
+    def read_predictions(self, result_file):
+        """ Read a result-file of LocNuclei
+        :return: Dictionary of protein name to tupel(source, tupel of (class, reliability) sorted by class)
+        """
+        predictions = dict()
+        with open(result_file, 'r') as result_src:
+            for line in result_src:
+                if line.startswith('#') or not line.strip():
+                    continue
+                cols = [col.strip() for col in line.split('\t')]
+                protein_name, localization, source, reliability = cols[:4]
+                classes = [loc.strip() for loc in localization.split('.') if loc.strip() and loc.strip() != 'unknown']
+                reliabilities = [float(value.rstrip('.')) for value in reliability.split() if value != 'NA']
+                if len(reliabilities) == 1:
+                    reliabilities = reliabilities * len(classes)  # a BLAST-hit has one RI for all its locations
+                predictions[protein_name] = (source, tuple(sorted(zip(classes, reliabilities))))
+
+        return predictions
+
+    def compare_predictions(self, predictions, expected_predictions):
+        """ Compare the predictions of all proteins with an expected prediction - source and classes need to be
+        equal, the reliabilities may differ by the RI-tolerance
+        :return: tupel(number of compared proteins, list of the differing predictions)
+        """
+        compared = 0
+        mismatches = list()
+        for protein_name in sorted(set(predictions) & set(expected_predictions)):
+            compared += 1
+            source, class_reliabilities = predictions[protein_name]
+            expected_source, expected_class_reliabilities = expected_predictions[protein_name]
+            is_equal = source == expected_source and \
+                [loc for loc, _ in class_reliabilities] == [loc for loc, _ in expected_class_reliabilities] and \
+                all(abs(ri - expected_ri) <= self.ri_tolerance for (_, ri), (_, expected_ri)
+                    in zip(class_reliabilities, expected_class_reliabilities))
+            if not is_equal:
+                mismatches.append(OrderedDict([('protein', protein_name),
+                                               ('predicted', [source, class_reliabilities]),
+                                               ('expected', [expected_source, expected_class_reliabilities])]))
+
+        return compared, mismatches
+
+    def print_result(self, result):
+        print('{c} ({m}): {nr} proteins in {w:.2f}s, {ps} proteins/s, peak RSS {r:.1f} MB (external programs '
+              '{cr:.1f} MB)'.format(c=result['case'], m=result['mode'], nr=result['proteins'], w=result['wall_seconds'],
+                                    ps=result['proteins_per_second'], r=result['peak_rss_bytes'] / 1024.0 / 1024.0,
+                                    cr=result['peak_child_rss_bytes'] / 1024.0 / 1024.0))
+        for stage_name, stage in list(result['stages'].items()) + list(result.get('tracks', dict()).items()):
+            print('\t{s}: {n} calls, {i} items, {w:.2f}s wall-clock, {cpu:.2f}s CPU'.format(
+                s=stage_name, n=stage['calls'], i=stage['items'], w=stage['wall_seconds'], cpu=stage['cpu_seconds']))
+        print('\tPredictions: {nr} compared, {mm} differing'.format(nr=result['compared_predictions'],
+                                                                    mm=len(result['mismatches'])))
+        for mismatch in result['mismatches']:
+            print('\t\t{p}: predicted {pr}, expected {ex}'.format(p=mismatch['protein'], pr=mismatch['predicted'],
+                                                                  ex=mismatch['expected']))
+
+    def write_report(self, report_file):
+        report = OrderedDict([('version', self.REPORT_VERSION), ('jobs', self.jobs),
+                              ('kernel_backend', self.kernel_backend), ('batch_size', self.batch_size),
+                              ('results', self.results)])
+        with open(report_file, 'w') as report_out:
+            json.dump(report, report_out, indent=2)
+            report_out.write('\n')
+        print('Wrote benchmark-report to {fl}'.format(fl=report_file))
+
+    def mismatch_count(self):
+        return sum(len(result['mismatches']) for result in self.results)
+
+    def case_folder(self, mode, case_name):
+        case_folder = os.path.join(self.working_directory, '{m}_{c}'.format(m=mode, c=case_name))
+        if not os.path.isdir(case_folder):
+            os.makedirs(case_folder)
+        return case_folder
+
+    def write_case_protein(self, case_folder, protein_name, sequence, profile_file):
+        with open(os.path.join(case_folder, '{p}.fasta'.format(p=protein_name)), 'w') as fasta_out:
+            fasta_out.write('>{p}\n{seq}\n'.format(p=protein_name, seq=sequence))
+        # profiles are only linked, so large synthetic batches don't copy them
+        os.symlink(os.path.abspath(profile_file), os.path.join(case_folder, '{p}.profile'.format(p=protein_name)))
+
+    def read_fasta_entries(self, fasta_file):
+        header = None
+        sequence_lines = list()
+        with open(fasta_file, 'r') as fasta_src:
+            for line in fasta_src:
+                if line.startswith('>'):
+                    if header is not None:
+                        yield header, ''.join(sequence_lines)
+                    header = line[1:]
+                    sequence_lines = list()
+                elif header is not None:
+                    sequence_lines.append(line.strip())
+        if header is not None:
+            yield header, ''.join(sequence_lines)
+
+    def __init__(self, is_verbose, working_directory, profile_folder=None, jobs=1,
+                 kernel_backend=DEFAULT_KERNEL_BACKEND, batch_size=None, with_stages=False, ri_tolerance=0.5):
+        self.verbose = is_verbose
+        self.working_directory = working_directory  # all cases and runs are created in here
+        self.profile_folder = profile_folder  # profiles of the development data-sets, named {AC}.profile
+        self.jobs = jobs
+        self.kernel_backend = kernel_backend
+        self.batch_size = batch_size
+        self.with_stages = with_stages
+        self.ri_tolerance = ri_tolerance
+        self.results = list()
+
+
+def main():
+    usage_string = 'python -m bl.benchmark --profile_folder profiles/ --report_file benchmark.json'
+
+    parser = argparse.ArgumentParser(description=__doc__, usage=usage_string,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', help='Comma-separated prediction modes: sn and/or tr (default: sn,tr)',
+                        default='sn,tr')
+    parser.add_argument('--cases', help='Comma-separated cases: example, dataset and/or synthetic '
+                                        '(default: all)', default=','.join(Benchmark.CASES))
+    parser.add_argument('--sizes', help='Comma-separated sizes of the synthetic batches (default: 10,100,1000,10000)',
+                        default=','.join(str(size) for size in Benchmark.SYNTHETIC_SIZES))
+    parser.add_argument('--profile_folder', help='Folder with the profiles ({AC}.profile) of the proteins in the '
+                                                 'development data-sets')
+    parser.add_argument('--stages', help='Additionally run the BLAST- and the SVM-track on their own',
+                        action='store_true')
+    parser.add_argument('-j', '--jobs', help='Number of processes to run in parallel (default: 1)', type=int,
+                        default=1)
+    parser.add_argument('--kernel_backend', help='Kernel backend to benchmark (default: binary)',
+                        choices=KERNEL_BACKENDS, default=DEFAULT_KERNEL_BACKEND)
+    parser.add_argument('--batch_size', help='Batch size of the end to end runs (default: all proteins in one batch)',
+                        type=int)
+    parser.add_argument('--ri_tolerance', help='Allowed difference of reliability indices to the expected '
+                                               'predictions - the reference files round the sub-nuclear RIs '
+                                               '(default: 0.5)', type=float, default=0.5)
+    parser.add_argument('--temp_folder', help='Folder to create the cases in, kept afterwards. If not given, a '
+                                              'temporary directory is created and deleted.')
+    parser.add_argument('--report_file', help='Write all results as JSON to this file')
+    parser.add_argument('-v', '--verbose', help='Toggles verbose mode on', action='store_true')
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    cases = [case.strip() for case in args.cases.split(',') if case.strip()]
+    for mode in modes:
+        if mode not in Benchmark.MODES:
+            error('Unknown mode {m}, use sn and/or tr'.format(m=mode))
+            exit(751)
+    for case in cases:
+        if case not in Benchmark.CASES:
+            error('Unknown case {c}, use one of: {all}'.format(c=case, all=', '.join(Benchmark.CASES)))
+            exit(751)
+    try:
+        sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    except ValueError:
+        error('Sizes need to be comma-separated numbers, got {s}'.format(s=args.sizes))
+        exit(751)
+
+    helper = Helper(args.verbose)
+    if args.report_file:
+        helper.file_not_there_check(args.report_file)
+    if args.temp_folder and helper.folder_existence_check(args.temp_folder):
+        working_directory = args.temp_folder
+    else:
+        working_directory = tempfile.mkdtemp()
+
+    benchmark = Benchmark(args.verbose, working_directory, args.profile_folder, args.jobs, args.kernel_backend,
+                          args.batch_size, args.stages, args.ri_tolerance)
+    try:
+        benchmark.run(modes, cases, sizes)
+    finally:
+        if working_directory != args.temp_folder:
+            shutil.rmtree(working_directory)
+
+    if args.report_file:
+        benchmark.write_report(args.report_file)
+    if benchmark.mismatch_count():
+        error('{nr} predictions differ from the expected ones'.format(nr=benchmark.mismatch_count()))
+        exit(752)
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
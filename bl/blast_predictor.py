@@ -2,39 +2,62 @@
 from __future__ import print_function
 import os
 import sys
-import subprocess
 from bl.helper import Helper
+from bl.kmer_index import KmerIndex
+from bl.psiblast_parser import PsiBlastParser
+from bl.run_statistics import RunStatistics
+from bl.worker_pool import WorkerPool
 
 
 class BlastPredictor(object):
     SUBNUCLEAR_EVALUE = -20
     TRAVELLER_EVALUE = -5
     BLAST_MIN = 20.0
+    # shorter identical sequences may not reach the E-value threshold in blastpgp, so they are still blasted
+    EXACT_MATCH_MIN_LENGTH = 50
+    # minimum k-mer score (see bl/kmer_index.py) to run blastpgp - on the sub-nuclear development set no protein
+    # with a blast-hit scored below 4, and a protein is only skipped if its score is below the minimum. Not calibrated
+    # for the weaker E-value of traveller predictions, so off there.
+    SUBNUCLEAR_KMER_MIN_SCORE = 4
+    TRAVELLER_KMER_MIN_SCORE = 0
 
     def predict_all_query_proteins(self, all_query_proteins):
         if self.verbose:
             print('Starting to create BLAST-Predictions for all query-proteins:')
 
         # 1) initialize needed information
-        self.get_locations_from_lookup_fasta(self.fm.lookup_fasta)
+        self.load_lookup_proteins()
 
-        # 2) query blast-db with all proteins:
-        blast_prediction_file = self.blast_query_protein_against_db(all_query_proteins)
-
-        # 3) extract predictions from blast-prediction-file
-        all_query_proteins = self.extract_predicitons_from_file(blast_prediction_file, all_query_proteins)
+        # 2) query blast-db with all proteins, predictions are extracted as soon as a protein's blast finished
+        all_query_proteins = self.blast_query_protein_against_db(all_query_proteins)
 
         return all_query_proteins
 
+    def load_lookup_proteins(self):
+        """ Read the lookup-fasta (and k-mer index) once - following predictions with this object reuse it """
+        if not self.all_lookup_proteins:
+            with self.run_statistics.stage('lookup_load'):
+                if self.metadata_store is not None:
+                    self.get_locations_from_metadata_store(self.metadata_store)
+                else:
+                    self.get_locations_from_lookup_fasta(self.fm.lookup_fasta)
+                if self.kmer_min_score > 0 and self.fm.kmer_index and os.path.isfile(self.fm.kmer_index):
+                    self.kmer_index = KmerIndex(self.verbose)
+                    self.kmer_index.read_index_file(self.fm.kmer_index)
+
     def get_locations_from_lookup_fasta(self, lookup_fasta):
         """
         :param lookup_fasta: Open LookUp-Fasta which was used for to build the blastDB.
-                Read all locations and corresponding ACs.
+                Read all locations and corresponding ACs, and index the ACs by their sequence.
         :return: None
         """
+        ac = None
+        sequence_lines = list()
         with open(lookup_fasta, 'r') as lookup:
             for line in lookup:
                 if line.startswith('>'):  # header found!
+                    self.__index_lookup_sequence(ac, sequence_lines)
+                    sequence_lines = list()
                     header = line.split('#')
                     ac = header[1].strip()
                     locations = header[4].replace('\n', '').strip()
@@ -50,8 +73,70 @@ class BlastPredictor(object):
                         exit(-1)
                     else:
                         self.all_lookup_proteins[ac] = locations
+                elif ac is not None:
+                    sequence_lines.append(line)
+        self.__index_lookup_sequence(ac, sequence_lines)
+
+    def get_locations_from_metadata_store(self, metadata_store):
+        """ Same as get_locations_from_lookup_fasta, from the compiled metadata of the lookup-fasta
+        :param metadata_store: MetadataStore built from the lookup-fasta
+        :return: None
+        """
+        for ac, locations in metadata_store.lookup_location_dict().items():
+            if self.predict_traveller:
+                if 'Traveller' in locations:
+                    locations = 'Traveller.'
+                else:
+                    locations = 'NOT Traveller.'
+            self.all_lookup_proteins[ac] = locations
+        self.lookup_sequence_index = metadata_store.lookup_sequence_index(self.EXACT_MATCH_MIN_LENGTH)
+
+    def __index_lookup_sequence(self, ac, sequence_lines):
+        if ac is not None:
+            sequence_key = self.__sequence_key(''.join(sequence_lines))
+            if sequence_key is not None:
+                self.lookup_sequence_index.setdefault(sequence_key, ac)  # first AC of identical sequences is used
+
+    def __sequence_key(self, sequence):
+        helper = Helper(self.verbose)
+        sequence = helper.normalized_sequence(sequence)
+        if len(sequence) < self.EXACT_MATCH_MIN_LENGTH:
+            return None
+        return helper.sequence_digest(sequence)
+
+    def has_no_plausible_homologue(self, protein_name, query_protein):
+        """ :return: True if the protein's k-mer score is below the minimum, i.e. blastpgp can be skipped """
+        if self.kmer_index is None:
+            return False
+
+        helper = Helper(self.verbose)
+        with self.run_statistics.stage('kmer_prefilter'):
+            kmer_score = self.kmer_index.best_diagonal_score(helper.cleaned_sequence(query_protein, protein_name))
+        if self.verbose:
+            print('K-mer score of {ac}: {s}'.format(ac=protein_name, s=kmer_score))
+        return kmer_score < self.kmer_min_score
+
+    def predict_from_exact_match(self, protein_name, query_protein):
+        """ Predict a query protein whose sequence is identical to a protein of the lookup-fasta, without running
+        blastpgp - blast would report this protein as hit with 100% identity.
+        :return: True if the protein was predicted, False otherwise
+        """
+        helper = Helper(self.verbose)
+        sequence_key = self.__sequence_key(helper.cleaned_sequence(query_protein, protein_name))
+        if sequence_key is None or sequence_key not in self.lookup_sequence_index:
+            return False
+
+        self.set_blast_hit(protein_name, query_protein, self.lookup_sequence_index[sequence_key], 100.0)
+        return True
 
     def blast_query_protein_against_db(self, query_proteins):
+        return self.collect_blast_predictions(query_proteins, self.submit_blast_searches(query_proteins))
+
+    def submit_blast_searches(self, query_proteins):
+        """ Predict the query proteins identical to a lookup protein and submit blastpgp for all others with a
+        plausible homologue, without waiting for the searches - so other work can be submitted to the worker pool
+        :return: Pending searches, to be passed to collect_blast_predictions
+        """
         if self.predict_traveller:
             e_value = self.TRAVELLER_EVALUE
         else:
@@ -61,156 +146,194 @@ class BlastPredictor(object):
         # /usr/bin/blastpgp -F F -a 1 -j 3 -b 150 -e 1e${e_param} -h 1e-10 -d $DB -i $(pwd)/${DIR}/$(basename $i)
         # -o ${folder}${prefix}.blastPsiOutTmp
         # based on runPsiBlastProfileCreatorAli.sh
-        blast_files = list()
-        hssp_files = list()
+        pending_blast_calls = list()
+        exact_matches = 0
+        skipped_proteins = 0
         for cur_query_protein in query_proteins:
+            if self.predict_from_checkpoint(cur_query_protein, query_proteins[cur_query_protein]):
+                continue  # searched before the run was resumed
+            if self.predict_from_exact_match(cur_query_protein, query_proteins[cur_query_protein]):
+                exact_matches += 1
+                continue  # identical to a lookup protein, blast can't find a better hit
+            if self.has_no_plausible_homologue(cur_query_protein, query_proteins[cur_query_protein]):
+                skipped_proteins += 1
+                continue  # blast won't find a hit, the protein is predicted by the SVMs
             fasta = query_proteins[cur_query_protein].fasta_file
+            if fasta is None:
+                # blastpgp needs a file - only written for proteins given in memory
+                fasta = self.write_query_fasta(cur_query_protein, query_proteins[cur_query_protein].sequence)
             if self.verbose:
                 print('############')
                 print('Blast Prediciton for {ac}:'.format(ac=cur_query_protein))
-            blast_file = self.__call_blast(e_value, cur_query_protein, fasta)
-            hssp_file = '{blast_file}.psiBlast2hssp'.format(blast_file=blast_file)
-            blast_files.append(blast_file)
-            hssp_files.append(hssp_file)
-
-        self.fm.add_file_list_to_deletion(blast_files)
-        self.fm.add_file_list_to_deletion(hssp_files)
-
-        # 2) calling perl psi-blast2hssp.pl {blast_dir}       
-        self.__call_hssp_calculations()  # works on full directory
-        # 3) Create Blast-Predictions
-        blast_prediction_file = self.__create_blast_prediction_file()  # works on full directory
-
-        return blast_prediction_file
-
-    def extract_predicitons_from_file(self, blast_prediction_file, all_query_proteins):
-        with open(blast_prediction_file, 'r') as pred_src:
-            for line in pred_src:
-                if line and not line.isspace():
-                    # example-line:
-                    # A4Q9E5	A4Q9E5	100.0
-                    predictions = line.split()
-                    if len(predictions) > 1:
-                        query = predictions[0].strip()
-                        hit = predictions[1].strip()
-                        hit_locations = self.all_lookup_proteins[hit]
-                        seq_id = (float(predictions[2].strip())-self.BLAST_MIN)*100/(100-self.BLAST_MIN)
-                        seq_id = round(seq_id,2)
-                        if query in all_query_proteins:
-                            all_query_proteins[query].has_blast_hit = True
-                            all_query_proteins[query].has_prediction = True
-                            all_query_proteins[query].reliability = seq_id
-                            all_query_proteins[query].location_prediction = hit_locations.replace('\n', '').strip()
-                        else:
-                            error('We built a blast-query for {q} but it is not in the query-proteins - '
-                                  'This should not be possible'.format(q=query))
-                        if self.verbose:
-                            print('Found BLAST-HIT: -> {q} {h} {hl}'.format(q=query, h=hit, hl=hit_locations))
-        
-        return all_query_proteins
-
-    def __create_blast_prediction_file(self):
-        predictor_call, prediction_file = self.__build_blast_prediction_call()
-        # 3) write blast-predictions to result-file
-        sp = subprocess.Popen(predictor_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = sp.communicate()
-        if out:
-            if self.verbose:
-                print('JAR-Out: \n{o}'.format(o=out))
-        if err:
-            if self.verbose:
-                print('JAR-Error: \n{e}'.format(e=err))
-        if sp.returncode:
-            code = int(sp.returncode)
-            print('JAR-Out: \n{o}'.format(o=out))
-            print('JAR-Error: \n{e}'.format(e=err))
-            if code != 0:
-                error('PrintBlastPredictions.jar returned with exit-code {nr}'.format(nr=code))
-                exit(9)
-
-        self.fm.add_file_to_delete(prediction_file)  # clean up!
+            blast_file, pending_call = self.__submit_blast(e_value, cur_query_protein, fasta)
+            pending_blast_calls.append((cur_query_protein, blast_file, pending_call))
 
-        return prediction_file
+        return pending_blast_calls, exact_matches, skipped_proteins
 
-    def __build_blast_prediction_call(self):
-        java_predictor = self.fm.blast_prediction_printer
-        helper = Helper(self.verbose)
-        prediction_file = os.path.join(self.working_directory, 'blast.predictions')
-        helper.file_not_there_check(prediction_file)
-        predictor_call = ['java', '-jar', java_predictor,  self.working_directory, 'maxSeqId', prediction_file]
+    def collect_blast_predictions(self, query_proteins, pending_searches):
+        """ Wait for the searches submitted by submit_blast_searches and predict the proteins with a blast-hit
+        :return: The given dictionary of query proteins
+        """
+        pending_blast_calls, exact_matches, skipped_proteins = pending_searches
+        blast_files = list()
+        self.failed_proteins = dict()
+        for cur_query_protein, blast_file, pending_call in pending_blast_calls:
+            if self.__collect_blast(cur_query_protein, blast_file, pending_call):
+                blast_files.append(blast_file)
+                # 2) predict from the hit with the highest identity in the last round of the finished blast
+                self.predict_from_blast_file(cur_query_protein, query_proteins[cur_query_protein], blast_file)
 
-        return predictor_call, prediction_file
+        self.fm.add_file_list_to_deletion(blast_files)
+        self.report_failed_proteins()
+        self.run_statistics.count('blast_exact_matches', exact_matches)
+        self.run_statistics.count('blast_skipped_by_kmer_index', skipped_proteins)
+        self.run_statistics.count('blast_failed', len(self.failed_proteins))
+        if self.verbose:
+            print('{nr} of {t} query-proteins are identical to a lookup-protein'.format(nr=exact_matches,
+                                                                                        t=len(query_proteins)))
+        if self.verbose and self.kmer_index is not None:
+            print('Skipped blastpgp for {nr} of {t} query-proteins without plausible homologue (k-mer score below '
+                  '{m})'.format(nr=skipped_proteins, t=len(query_proteins), m=self.kmer_min_score))
 
-    def __call_hssp_calculations(self):
-        hssp_call = self.__build_hssp_call()
-        # 2) build hssp-files:
-        sp = subprocess.Popen(hssp_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = sp.communicate()
-        if out:
-            if self.verbose:
-                print('HSSP-Out: \n{o}'.format(o=out))
-        if err:
-            if self.verbose:
-                print('HSSP-Error: \n{e}'.format(e=err))
-            if 'Use of uninitialized value $query in concatenation' in str(err):
-                # we are using the wrong separator character! (# instead of |)
-                error('HSSP calculation failed, because query-ac could not be determined in input fasta!')
-                exit(8)
-        if sp.returncode:
-            code = int(sp.returncode)
-            print('HSSP-Out: \n{o}'.format(o=out))
-            print('HSSP-Error: \n{e}'.format(e=err))
-            if code != 0:
-                error('psi-blast2hssp.pl returned with exit-code {nr}'.format(nr=code))
-                exit(8)
+        return query_proteins
 
-    def __build_hssp_call(self):
-        path_to_perlscript = self.fm.psiblast2hssp
-        hssp_call = ['perl', path_to_perlscript, self.working_directory]
+    def predict_from_checkpoint(self, protein_name, query_protein):
+        """ Predict a query protein from the result of its search in the run that is resumed
+        :return: True if the search of the protein finished before, False otherwise
+        """
+        if self.checkpoint is None:
+            return False
+        blast_result = self.checkpoint.blast_result(protein_name)
+        if blast_result is None:
+            return False
+
+        self.run_statistics.count('blast_resumed')
+        hit_ac, identity = blast_result
+        if hit_ac is not None:
+            self.set_blast_hit(protein_name, query_protein, hit_ac, identity)
+        return True
+
+    def predict_from_blast_file(self, protein_name, query_protein, blast_file):
+        """ Set the prediction of the query protein from the hit with the highest percentage identity in its
+        blastpgp-output, if there is one.
+        :return: True if the protein has a blast-hit, False otherwise
+        """
+        # parsing the hits replaces psi-blast2hssp.pl, selecting the best one PrintBlastPredictions.jar
+        with self.run_statistics.stage('hssp'):
+            hits = self.psiblast_parser.read_hits(blast_file)
+        with self.run_statistics.stage('best_hit'):
+            best_hit = self.psiblast_parser.select_best_hit(hits)
+        if best_hit is None or best_hit.hit_ac is None:
+            if self.checkpoint is not None:
+                self.checkpoint.store_blast_result(protein_name, None, None)
+            return False
+        self.run_statistics.count('blast_hits')
+
+        self.set_blast_hit(protein_name, query_protein, best_hit.hit_ac, best_hit.identity)
+        if self.checkpoint is not None:
+            self.checkpoint.store_blast_result(protein_name, best_hit.hit_ac, best_hit.identity)
+        return True
+
+    def set_blast_hit(self, protein_name, query_protein, hit_ac, identity):
+        """ Predict the query protein with the locations of the hit
+        :param identity: Percentage identity of query and hit
+        """
+        hit_locations = self.all_lookup_proteins[hit_ac]
+        seq_id = (identity-self.BLAST_MIN)*100/(100-self.BLAST_MIN)
+        seq_id = round(seq_id,2)
+        query_protein.has_blast_hit = True
+        query_protein.has_prediction = True
+        query_protein.reliability = seq_id
+        query_protein.location_prediction = hit_locations.replace('\n', '').strip()
+        # the hit's identity is the reliability of each of its locations
+        hit_classes = [location.strip() for location in hit_locations.split('.')
+                       if location and not location.isspace()]
+        query_protein.predicted_classes = hit_classes
+        query_protein.class_reliabilities = [seq_id] * len(hit_classes)
         if self.verbose:
-            call_string = ''
-            for c in hssp_call:
-                call_string += ' {sub_call}'.format(sub_call=c)
-        return hssp_call
+            print('Found BLAST-HIT: -> {q} {h} {hl}'.format(q=protein_name, h=hit_ac, hl=hit_locations))
 
-    def __call_blast(self, evalue, protein_name, query_fasta):
+    def write_query_fasta(self, protein_name, sequence):
+        helper = Helper(self.verbose)
+        query_fasta = os.path.join(self.working_directory, '{p}.fasta'.format(p=protein_name))
+        helper.file_not_there_check(query_fasta)
+        cleaned_fasta = helper.clean_sequence_input(sequence, protein_name)
+        with open(query_fasta, 'w') as fasta_out:
+            fasta_out.write('>{p}|{p}\n{seq}\n'.format(p=protein_name, seq=cleaned_fasta[1]))
+        self.fm.add_file_to_delete(query_fasta)
+
+        return query_fasta
+
+    def report_failed_proteins(self):
+        if self.failed_proteins:
+            error('blastpgp failed for {nr} of the query-proteins - they are predicted without homology-based '
+                  'inference:'.format(nr=len(self.failed_proteins)))
+            for protein_name in sorted(self.failed_proteins):
+                error('\t{ac}: {reason}'.format(ac=protein_name, reason=self.failed_proteins[protein_name]))
+
+    def __submit_blast(self, evalue, protein_name, query_fasta):
         fasta_in = query_fasta
         blast_out = protein_name+'.blastPsiOutTmp'
         blast_out = os.path.join(self.working_directory, blast_out)
 
         blast_call = self.__build_blast_call(evalue, fasta_in, blast_out)
 
-        sp = subprocess.Popen(blast_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = sp.communicate()
+        return blast_out, self.worker_pool.submit_external_call(blast_call)
+
+    def __collect_blast(self, protein_name, blast_out, pending_call):
+        """ Wait for the blast-call of a protein and record it as failed, if blastpgp did not succeed
+        :return: True if blastpgp succeeded, False otherwise
+        """
+        returncode, out, err, run_time = pending_call.get()
+        self.run_statistics.add_external_run('blast', run_time)
         if out:
             if self.verbose:
                 print(out)
         if err:
             if self.verbose:
                 print(err)
-        if sp.returncode:
-            code = int(sp.returncode)
-            print(out)
-            print(err)
+        if returncode:
+            code = int(returncode)
             if code != 0:
-                error('blastpgp returned with exit-code {nr}'.format(nr=code))
-                exit(7)
+                self.failed_proteins[protein_name] = 'blastpgp returned with exit-code {nr}: {e}'.format(
+                    nr=code, e=err.decode('utf8', 'replace').strip() if err else '')
+                if os.path.isfile(blast_out):
+                    os.remove(blast_out)  # incomplete output must not be kept
+                return False
 
-        return blast_out
+        return True
 
     def __build_blast_call(self, e_value, fasta_in, blast_out):
         e_value = '1e{e_val}'.format(e_val=e_value)
-        blast_call = ['/usr/bin/blastpgp', '-F', 'F', '-a', '1', '-j', '3', '-b', '150', '-e', e_value, '-h', '1e-10',
-                      '-d', self.fm.blast_db, '-i', fasta_in, '-o', blast_out]
+        blast_threads = str(self.blast_threads)  # subprocess arguments need to be strings
+        blast_call = ['/usr/bin/blastpgp', '-F', 'F', '-a', blast_threads, '-j', '3', '-b', '150', '-e', e_value,
+                      '-h', '1e-10', '-d', self.fm.blast_db, '-i', fasta_in, '-o', blast_out]
 
         return blast_call
 
-    def __init__(self, is_verbose, working_directory, file_manager, predict_traveller):
+    def __init__(self, is_verbose, working_directory, file_manager, predict_traveller, worker_pool=None,
+                 blast_threads=1, kmer_min_score=None, metadata_store=None, run_statistics=None, checkpoint=None):
         self.verbose = is_verbose
         self.all_lookup_proteins = dict()
+        self.lookup_sequence_index = dict()  # sha1 of a lookup protein's sequence -> its AC
         self.working_directory = working_directory
         self.fm = file_manager
         self.predict_traveller = predict_traveller
+        if worker_pool is None:
+            worker_pool = WorkerPool(is_verbose, 1)
+        self.worker_pool = worker_pool  # runs one blastpgp per worker
+        self.blast_threads = blast_threads  # threads per blastpgp-call
+        self.failed_proteins = dict()  # protein name -> reason, for all proteins blastpgp failed for
+        self.psiblast_parser = PsiBlastParser(is_verbose)
+        if kmer_min_score is None:
+            kmer_min_score = self.TRAVELLER_KMER_MIN_SCORE if predict_traveller else self.SUBNUCLEAR_KMER_MIN_SCORE
+        self.kmer_min_score = kmer_min_score  # 0 disables the k-mer prefilter
+        self.kmer_index = None  # loaded with the lookup-proteins, if bl/model_builder.py built it
+        self.metadata_store = metadata_store  # compiled lookup-fasta, parsed instead if None
+        if run_statistics is None:
+            run_statistics = RunStatistics(is_verbose)
+        self.run_statistics = run_statistics
+        self.checkpoint = checkpoint  # bl/checkpoint.py, finished searches are recorded there if set
 
 
 def error(*objs):
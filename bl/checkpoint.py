@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+""" Durable completion markers of a run, so a run that died can be resumed without repeating finished work
+
+The markers are written to a folder in the working-directory, one folder per prediction mode:
+ - blast/{protein}.json: best BLAST-hit (or none) of a protein whose blastpgp-search finished
+ - kernel/l{l}_y{y}.{key}.npy: normalized kernel rows of a chunk of query proteins, the key is a digest of the
+   query ids and the training proteins they were calculated against
+ - predictions/{protein}.json: final prediction of a protein
+Every marker is written to a temporary file first, synced to disk and then renamed, i.e. it is either complete or
+missing. The markers are bound to the protein names, so a resumed run needs the same input.
+"""
+from __future__ import print_function
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import numpy
+
+
+class Checkpoint(object):
+
+    BLAST_FOLDER = 'blast'
+    KERNEL_FOLDER = 'kernel'
+    PREDICTION_FOLDER = 'predictions'
+
+    def blast_result(self, protein_name):
+        """ :return: tupel(hit AC, identity) of the finished search of the protein - (None, None) if it had no hit -
+        or None if there is no marker """
+        marker = self.__read_json_marker(self.BLAST_FOLDER, protein_name)
+        if marker is None:
+            return None
+        return marker['hit_ac'], marker['identity']
+
+    def store_blast_result(self, protein_name, hit_ac, identity):
+        self.__write_json_marker(self.BLAST_FOLDER, protein_name, {'hit_ac': hit_ac, 'identity': identity})
+
+    def kernel_key(self, max_kmer_length, max_sub_score, train_id_file, test_id_file):
+        """ :return: Key of the kernel rows of the query proteins in test_id_file against the proteins in
+        train_id_file """
+        key = hashlib.sha1()
+        for id_file in (train_id_file, test_id_file):
+            with open(id_file, 'rb') as id_src:
+                key.update(id_src.read())
+            key.update(b'\0')
+
+        return 'l{k}_y{sub}.{key}'.format(k=max_kmer_length, sub=max_sub_score, key=key.hexdigest())
+
+    def kernel_rows(self, kernel_key):
+        """ :return: Normalized kernel rows stored for the key, None if there are none """
+        kernel_file = os.path.join(self.checkpoint_folder, self.KERNEL_FOLDER, '{k}.npy'.format(k=kernel_key))
+        if not os.path.isfile(kernel_file):
+            return None
+        return numpy.load(kernel_file)
+
+    def store_kernel_rows(self, kernel_key, normalized_rows):
+        kernel_file = os.path.join(self.checkpoint_folder, self.KERNEL_FOLDER, '{k}.npy'.format(k=kernel_key))
+        with self.__durable_file(kernel_file, 'wb') as kernel_out:
+            numpy.save(kernel_out, numpy.asarray(normalized_rows, dtype=numpy.float64))
+
+    def load_prediction(self, protein_name, protein):
+        """ Set the stored prediction of a protein, if there is one
+        :return: True if the protein was predicted before, False otherwise
+        """
+        marker = self.__read_json_marker(self.PREDICTION_FOLDER, protein_name)
+        if marker is None:
+            return False
+
+        protein.location_prediction = marker['location_prediction']
+        protein.reliability = marker['reliability']
+        protein.has_blast_hit = marker['has_blast_hit']
+        protein.has_prediction = marker['has_prediction']
+        protein.predicted_classes = marker['predicted_classes']
+        protein.class_reliabilities = marker['class_reliabilities']
+        return True
+
+    def store_prediction(self, protein_name, protein):
+        self.__write_json_marker(self.PREDICTION_FOLDER, protein_name, {
+            'location_prediction': protein.location_prediction, 'reliability': protein.reliability,
+            'has_blast_hit': protein.has_blast_hit, 'has_prediction': protein.has_prediction,
+            'predicted_classes': protein.predicted_classes, 'class_reliabilities': protein.class_reliabilities})
+
+    def remove(self):
+        """ Remove all markers, e.g. after the run finished """
+        if os.path.isdir(self.checkpoint_folder):
+            shutil.rmtree(self.checkpoint_folder)
+        if self.verbose:
+            print('Removed checkpoints in {dr}'.format(dr=self.checkpoint_folder))
+
+    def __read_json_marker(self, folder, protein_name):
+        marker_file = os.path.join(self.checkpoint_folder, folder, '{p}.json'.format(p=protein_name))
+        if not os.path.isfile(marker_file):
+            return None
+        with open(marker_file, 'r') as marker_src:
+            return json.load(marker_src)
+
+    def __write_json_marker(self, folder, protein_name, content):
+        marker_file = os.path.join(self.checkpoint_folder, folder, '{p}.json'.format(p=protein_name))
+        with self.__durable_file(marker_file, 'w') as marker_out:
+            json.dump(content, marker_out)
+
+    @contextlib.contextmanager
+    def __durable_file(self, target_file, mode):
+        # written to {file}.tmp, synced and renamed to the file only if the with-block ends without error
+        temp_file = '{fl}.tmp'.format(fl=target_file)
+        with open(temp_file, mode) as target:
+            yield target
+            target.flush()
+            os.fsync(target.fileno())
+        os.rename(temp_file, target_file)
+
+    def __init__(self, is_verbose, checkpoint_folder, resume=False):
+        """
+        :param checkpoint_folder: Folder of the markers, created if it does not exist
+        :param resume: Use the markers of a previous run in the folder - they are removed otherwise
+        """
+        self.verbose = is_verbose
+        self.checkpoint_folder = checkpoint_folder
+        if not resume and os.path.isdir(checkpoint_folder):
+            shutil.rmtree(checkpoint_folder)
+        for folder in (self.BLAST_FOLDER, self.KERNEL_FOLDER, self.PREDICTION_FOLDER):
+            if not os.path.isdir(os.path.join(checkpoint_folder, folder)):
+                os.makedirs(os.path.join(checkpoint_folder, folder))
+
+        if resume and self.verbose:
+            finished_proteins = len([marker for marker in os.listdir(os.path.join(checkpoint_folder,
+                                                                                  self.PREDICTION_FOLDER))
+                                     if marker.endswith('.json')])
+            print('Resuming from {dr}: {nr} proteins were predicted before'.format(dr=checkpoint_folder,
+                                                                                   nr=finished_proteins))
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -0,0 +1,226 @@
+# -*- coding: utf8 -*-
+""" Sub-nuclear and traveller predictions in one run
+
+Both model-sets are loaded by their own LocNuclei object, sharing one worker pool and one set of run-statistics.
+The input files are discovered once and every batch is predicted in one pass: the BLAST-searches of both modes are
+submitted to the worker pool side by side, then one query kernel input is written for all proteins without blast-hit
+in either mode and the kernels of both modes are calculated from it - again side by side. Both predictions of a
+protein are written to one line of the output.
+"""
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from contextlib import ExitStack
+from bl.kernel_backend import DEFAULT_KERNEL_BACKEND
+from bl.locnuclei_predictor import LocNucleiPredictor
+from bl.protein import Protein
+from bl.result_cache import ResultCache
+from bl.result_writer import ResultWriter
+from bl.run_statistics import RunStatistics
+from bl.worker_pool import WorkerPool
+
+
+class PredictionTrack(object):
+
+    """ Query proteins of one mode of a batch that are predicted """
+
+    def __init__(self, loc_nuclei, all_query_proteins, uncached_query_proteins, cache_keys):
+        self.loc_nuclei = loc_nuclei
+        self.all_query_proteins = all_query_proteins
+        self.uncached_query_proteins = uncached_query_proteins  # not answered from the result-cache or checkpoint
+        self.cache_keys = cache_keys
+        # one protein per group of duplicates, see LocNuclei.deduplicate_query_proteins
+        self.query_proteins, self.representatives = loc_nuclei.deduplicate_query_proteins(uncached_query_proteins)
+
+
+class CombinedLocNuclei(object):
+
+    def predict_given_files(self, fasta_folder, fasta_suffix, blast_folder, blast_suffix, tmp_folder, out_file,
+                            only_blast, batch_size=None):
+        """ Predict all proteins of the given folders for both modes and write both predictions to out_file
+        :param batch_size: Predict the proteins in batches of this size and append the results of every batch to
+                the output file as soon as it is done (default: all proteins in one batch)
+        """
+        with self.run_statistics.stage('input_discovery'):
+            input_files = self.sn_loc_nuclei.find_input_files(fasta_folder, fasta_suffix, blast_folder, blast_suffix)
+        self.predict_input_files(input_files, tmp_folder, out_file, only_blast, batch_size)
+
+    def predict_input_files(self, input_files, tmp_folder, out_file, only_blast, batch_size=None):
+        """ Same as predict_given_files, for input files discovered before (e.g. a shard of bl/sharding.py)
+        :param input_files: OrderedDict of protein name to tupel(fasta-file, blast-file), as returned by
+                LocNuclei.find_input_files
+        """
+        for loc_nuclei in (self.sn_loc_nuclei, self.tr_loc_nuclei):
+            loc_nuclei.prepare_temporary_directory(tmp_folder)
+            loc_nuclei.prepare_checkpoint()
+        writer = ResultWriter(self.verbose)
+
+        with open(out_file, 'w') as target:
+            target.write(writer.COMBINED_HEADER)
+            protein_names = list(input_files)
+            if not batch_size:
+                batch_size = max(1, len(protein_names))
+            for batch_start in range(0, len(protein_names), batch_size):
+                batch_names = protein_names[batch_start:batch_start + batch_size]
+                sn_query_proteins = self.query_proteins(input_files, batch_names)
+                tr_query_proteins = self.query_proteins(input_files, batch_names)
+                self.predict_batch(sn_query_proteins, tr_query_proteins, only_blast)
+
+                with self.run_statistics.stage('output', len(sn_query_proteins)):
+                    writer.write_combined_result_lines(sn_query_proteins, tr_query_proteins, target)
+                    target.flush()  # results of finished batches can be read while the rest is predicted
+                if self.verbose or batch_size < len(protein_names):
+                    print('Predicted {nr} of {t} proteins'.format(nr=batch_start + len(sn_query_proteins),
+                                                                 t=len(protein_names)))
+
+    def predict_query_records(self, query_records, tmp_folder, out_file, only_blast, batch_size):
+        """ Same as predict_input_files, for proteins read lazily, e.g. by bl/input_reader.py - only the current
+        batch is held in memory
+        :param query_records: Iterable of tupel(id, sequence, profile)
+        """
+        for loc_nuclei in (self.sn_loc_nuclei, self.tr_loc_nuclei):
+            loc_nuclei.prepare_temporary_directory(tmp_folder)
+            loc_nuclei.prepare_checkpoint()
+        writer = ResultWriter(self.verbose)
+
+        protein_count = 0
+        with open(out_file, 'w') as target:
+            target.write(writer.COMBINED_HEADER)
+            for batch in self.sn_loc_nuclei.iter_record_batches(query_records, batch_size):
+                sn_query_proteins, protein_ids = self.sn_loc_nuclei.record_query_proteins(batch, protein_count)
+                tr_query_proteins, protein_ids = self.tr_loc_nuclei.record_query_proteins(batch, protein_count)
+                self.predict_batch(sn_query_proteins, tr_query_proteins, only_blast)
+
+                with self.run_statistics.stage('output', len(sn_query_proteins)):
+                    writer.write_combined_result_lines(sn_query_proteins, tr_query_proteins, target, protein_ids)
+                    target.flush()
+                protein_count += len(batch)
+                # a full batch may be followed by others, the number of batches is unknown while reading
+                if self.verbose or protein_count > len(batch) or len(batch) == batch_size:
+                    print('Predicted {nr} proteins'.format(nr=protein_count))
+
+    def query_proteins(self, input_files, protein_names):
+        """ :return: OrderedDict of protein name to a new Protein, for the given proteins of find_input_files """
+        query_proteins = OrderedDict()
+        for protein_name in protein_names:
+            query_proteins[protein_name] = Protein(self.verbose)
+            query_proteins[protein_name].fasta_file, query_proteins[protein_name].blast_file = \
+                input_files[protein_name]
+
+        return query_proteins
+
+    def predict_batch(self, sn_query_proteins, tr_query_proteins, only_blast=False):
+        """ Predict a batch of query proteins for both modes in its own sub-folder of the working-directory, which is
+        removed afterwards (unless in debug-mode)
+        :param sn_query_proteins: Dictionary of protein name to Protein, with fasta_file and blast_file set
+        :param tr_query_proteins: Dictionary of the same protein names to other Protein-objects for the same files
+        :param only_blast: Only run homology based inference
+        :return: None, the predictions are set in both dictionaries
+        """
+        batch_directory = tempfile.mkdtemp(dir=self.sn_loc_nuclei.working_directory)
+        try:
+            self.predict_query_proteins(batch_directory, sn_query_proteins, tr_query_proteins, only_blast)
+        finally:
+            if not self.debug:
+                shutil.rmtree(batch_directory)
+                self.sn_loc_nuclei.file_manager.remove_folder_from_deletion(batch_directory)
+                self.tr_loc_nuclei.file_manager.remove_folder_from_deletion(batch_directory)
+
+    def predict_query_proteins(self, batch_directory, sn_query_proteins, tr_query_proteins, only_blast):
+        # 0) Answer proteins predicted before from the result-caches and predict duplicates of a protein only once,
+        #    every mode works in its own sub-folder
+        tracks = list()  # PredictionTrack per mode with proteins to predict
+        for mode, loc_nuclei, all_query_proteins in (('sn', self.sn_loc_nuclei, sn_query_proteins),
+                                                     ('tr', self.tr_loc_nuclei, tr_query_proteins)):
+            uncached_query_proteins, cache_keys = loc_nuclei.lookup_cached_predictions(all_query_proteins, only_blast)
+            if not uncached_query_proteins:
+                continue
+            loc_nuclei.load_predictors(only_blast)
+            self.run_statistics.count('predicted_proteins', len(uncached_query_proteins))
+            track_directory = os.path.join(batch_directory, mode)
+            os.mkdir(track_directory)
+            loc_nuclei.blast_predictor.working_directory = track_directory
+            if not only_blast:
+                loc_nuclei.svm_predictor.working_directory = track_directory
+            tracks.append(PredictionTrack(loc_nuclei, all_query_proteins, uncached_query_proteins, cache_keys))
+
+        # 1) BLAST-searches of both modes side by side on the shared worker pool
+        pending_searches = [track.loc_nuclei.blast_predictor.submit_blast_searches(track.query_proteins)
+                            for track in tracks]
+        for track, pending in zip(tracks, pending_searches):
+            track.loc_nuclei.blast_predictor.collect_blast_predictions(track.query_proteins, pending)
+
+        # 2) SVMs for the proteins without blast-hit in either mode - one query kernel input for both modes, the
+        #    predictions of a mode are only set for its own proteins without blast-hit
+        query_ids = [protein_name for protein_name in sn_query_proteins
+                     if any(protein_name in track.query_proteins and
+                            not track.query_proteins[protein_name].has_blast_hit for track in tracks)]
+        if not only_blast and query_ids:
+            kernel_group_count = sum(track.loc_nuclei.svm_predictor.kernel_group_count() for track in tracks)
+            chunk_count = -(-self.worker_pool.jobs // kernel_group_count)  # ceil
+            with self.run_statistics.stage('kernel_input', len(query_ids)):
+                query_chunks = tracks[0].loc_nuclei.svm_predictor.create_query_chunks(sn_query_proteins, query_ids,
+                                                                                      chunk_count)
+            pending_predictions = [track.loc_nuclei.svm_predictor.submit_query_matrices(query_ids, query_chunks)
+                                   for track in tracks]
+            for track, pending in zip(tracks, pending_predictions):
+                track.loc_nuclei.svm_predictor.collect_predictions(track.query_proteins, pending)
+
+        # 3) Remember the new predictions, of every protein
+        for track in tracks:
+            track.loc_nuclei.share_duplicate_predictions((track.all_query_proteins, track.uncached_query_proteins),
+                                                         track.representatives)
+            track.loc_nuclei.store_cached_predictions(track.uncached_query_proteins, track.cache_keys,
+                                                      track.representatives)
+
+    def __init__(self, is_verbose, is_debug, sn_loc_nuclei, tr_loc_nuclei, worker_pool, run_statistics):
+        self.verbose = is_verbose
+        self.debug = is_debug
+        self.sn_loc_nuclei = sn_loc_nuclei
+        self.tr_loc_nuclei = tr_loc_nuclei
+        self.worker_pool = worker_pool
+        self.run_statistics = run_statistics
+
+
+class CombinedLocNucleiPredictor(object):
+
+    def __init__(self, verbose, debug, jobs=1, blast_threads=1, cache_file=None,
+                 cache_max_mb=ResultCache.DEFAULT_MAX_SIZE_MB, kmer_min_score=None,
+                 kernel_backend=DEFAULT_KERNEL_BACKEND, run_statistics=None, resume=False):
+        self.verbose = verbose
+        self.debug = debug
+        self.jobs = jobs
+        self.blast_threads = blast_threads
+        self.cache_file = cache_file  # shared by both modes, the results are cached per mode
+        self.cache_max_mb = cache_max_mb
+        self.kmer_min_score = kmer_min_score  # None: default of the BlastPredictor for each mode
+        self.kernel_backend = kernel_backend
+        if run_statistics is None:
+            run_statistics = RunStatistics(verbose)
+        self.run_statistics = run_statistics
+        self.resume = resume  # continue from the checkpoints of both modes in the given temp-folder
+
+    def __enter__(self):
+        # as LocNucleiPredictor, only usable in a with-statement so the temp folders and the pool are cleaned up
+        self.worker_pool = WorkerPool(self.verbose, self.jobs)  # runs the BLAST- and kernel-calls of both modes
+        self.exit_stack = ExitStack()
+        loc_nuclei = list()
+        for predict_traveller in (False, True):
+            loc_nuclei.append(self.exit_stack.enter_context(LocNucleiPredictor(
+                self.verbose, self.debug, predict_traveller, self.jobs, self.blast_threads, self.cache_file,
+                self.cache_max_mb, self.kmer_min_score, self.kernel_backend, run_statistics=self.run_statistics,
+                worker_pool=self.worker_pool, resume=self.resume)))
+
+        return CombinedLocNuclei(self.verbose, self.debug, loc_nuclei[0], loc_nuclei[1], self.worker_pool,
+                                 self.run_statistics)
+
+    def __exit__(self, type, value, traceback):
+        self.exit_stack.close()
+        self.worker_pool.close()
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -58,6 +58,21 @@ class ExternalFileManager(object):
     def files_to_remove(self):
         return self._remove_list
 
+    @property
+    def target_class_abbreviation(self):
+        return self._target_class_abbreviation
+
+    def model_files(self):
+        """ :return: Sorted list of all data-files and scripts the predictions of the current target depend on """
+        model_files = list()
+        for folder in (self._target_folder, self._blast_script_folder):
+            for dir_path, dir_names, file_names in os.walk(folder):
+                model_files.extend(os.path.join(dir_path, file_name) for file_name in file_names)
+        model_files.append(self.my_string_kernel)
+        model_files.append(self.amino_file)
+
+        return sorted(model_files)
+
     @property
     def train_fasta_file(self):
         return self._train_fasta_file
@@ -66,14 +81,59 @@ class ExternalFileManager(object):
     def best_params(self):
         return self._best_params
 
+    @property
+    def model_bundle(self):
+        return self._model_bundle
+
+    @property
+    def kmer_index(self):
+        return self._kmer_index
+
+    @property
+    def metadata_store(self):
+        return self._metadata_store
+
     def matrix_file_for_params(self, k_mer, sub_score):
         matrix_path = os.path.join(self.matrix_folder, 'l{k}_y{sub}.matrix'.format(k=k_mer, sub=sub_score))
         return matrix_path
 
+    def diagonal_file_for_params(self, k_mer, sub_score):
+        """ Binary (.npy) diagonal of the un-normalized matrix, created by bl/model_builder.py """
+        diagonal_path = os.path.join(self.matrix_folder, 'l{k}_y{sub}.diag.npy'.format(k=k_mer, sub=sub_score))
+        return diagonal_path
+
     def normalized_matrix_file_for_params(self, k_mer, sub_score):
-        matrix_path = os.path.join(self.matrix_folder, 'l{k}_y{sub}.norm.matrix'.format(k=k_mer, sub=sub_score))
+        """ Resolves to the binary (.npy) matrix created by bl/model_builder.py, if available """
+        matrix_path = self.binary_normalized_matrix_file_for_params(k_mer, sub_score)
+        if not os.path.isfile(matrix_path):
+            matrix_path = os.path.join(self.matrix_folder, 'l{k}_y{sub}.norm.matrix'.format(k=k_mer, sub=sub_score))
         return matrix_path
 
+    def binary_normalized_matrix_file_for_params(self, k_mer, sub_score):
+        matrix_path = os.path.join(self.matrix_folder, 'l{k}_y{sub}.norm.npy'.format(k=k_mer, sub=sub_score))
+        return matrix_path
+
+    def matrix_check(self, k_mer, sub_score):
+        """ Checks if the training matrix is available either in text- or in binary format, if not exits the program!
+        """
+        if not os.path.isfile(self.diagonal_file_for_params(k_mer, sub_score)):
+            helper = Helper(self.verbose)
+            helper.file_check(self.matrix_file_for_params(k_mer, sub_score))
+        return True
+
+    def support_vector_id_file_for_params(self, k_mer, sub_score):
+        id_path = os.path.join(self.matrix_folder, 'l{k}_y{sub}.sv.idList'.format(k=k_mer, sub=sub_score))
+        return id_path
+
+    def support_vector_kernel_input_for_params(self, k_mer, sub_score):
+        input_path = os.path.join(self.matrix_folder, 'l{k}_y{sub}.sv.psiBlastMat'.format(k=k_mer, sub=sub_score))
+        return input_path
+
+    def neighborhood_index_file_for_params(self, k_mer, sub_score):
+        """ Training-side index of the numpy profile-kernel, created by bl/model_builder.py """
+        index_path = os.path.join(self.matrix_folder, 'l{k}_y{sub}.neighborhoods.npz'.format(k=k_mer, sub=sub_score))
+        return index_path
+
     @property
     def matrix_folder(self):
         return self._matrix_folder
@@ -84,6 +144,12 @@ class ExternalFileManager(object):
     def add_file_list_to_deletion(self, files_to_remove):
         self._remove_list.extend(files_to_remove)
 
+    def remove_folder_from_deletion(self, folder):
+        """ Forget all files to delete in the given folder, e.g. because the whole folder was deleted already """
+        folder = os.path.join(folder, '')
+        self._remove_list = [file_to_remove for file_to_remove in self._remove_list
+                             if not file_to_remove.startswith(folder)]
+
     def is_predictor_setup_sane(self, predict_traveller=False):
         if self.verbose:
             print('Running selfcheck - preparing to start predictions')
@@ -97,21 +163,24 @@ class ExternalFileManager(object):
             target_class_abbreviation = 'sn'
 
         target_folder = os.path.join(data_folder, target_class_abbreviation)
+        self._target_class_abbreviation = target_class_abbreviation
+        self._target_folder = target_folder
         self._matrix_folder = os.path.join(target_folder, 'matrices')
         blast_script_folder = os.path.join(script_folder, 'blast_scripts')
+        self._blast_script_folder = blast_script_folder
         helper = Helper(self.verbose)
         # Check for needed files
         # 1) check for matrices - parameters taken from best results from parameter-optimization # TODO use getter
         if predict_traveller:
-            helper.file_check(os.path.join(self._matrix_folder, 'l3_y6.matrix'))
+            self.matrix_check(3, 6)
         else:
-            helper.file_check(os.path.join(self._matrix_folder, 'l3_y5.matrix'))
-            helper.file_check(os.path.join(self._matrix_folder, 'l3_y7.matrix'))
-            helper.file_check(os.path.join(self._matrix_folder, 'l4_y6.matrix'))
-            helper.file_check(os.path.join(self._matrix_folder, 'l4_y7.matrix'))
-            helper.file_check(os.path.join(self._matrix_folder, 'l4_y8.matrix'))
-            helper.file_check(os.path.join(self._matrix_folder, 'l4_y9.matrix'))
-            helper.file_check(os.path.join(self._matrix_folder, 'l5_y8.matrix'))
+            self.matrix_check(3, 5)
+            self.matrix_check(3, 7)
+            self.matrix_check(4, 6)
+            self.matrix_check(4, 7)
+            self.matrix_check(4, 8)
+            self.matrix_check(4, 9)
+            self.matrix_check(5, 8)
         # 2) check train-files:
         self._train_fasta_file = \
             os.path.join(self._matrix_folder, '{abr}_train.fasta'.format(abr=target_class_abbreviation))
@@ -126,6 +195,15 @@ class ExternalFileManager(object):
         helper.file_check(self.globals_file)
         self._best_params = os.path.join(target_folder, '{abr}_best_params'.format(abr=target_class_abbreviation))
         helper.file_check(self.best_params)
+        # 2b) pre-trained models - optional, built by bl/model_builder.py; without them the SVMs are fitted per run
+        self._model_bundle = \
+            os.path.join(target_folder, '{abr}_model_bundle.npz'.format(abr=target_class_abbreviation))
+        # 2c) k-mer index of the lookup-proteins - optional, built by bl/model_builder.py; without it all proteins
+        #     are blasted
+        self._kmer_index = os.path.join(target_folder, '{abr}_kmer_index.npz'.format(abr=target_class_abbreviation))
+        # 2d) compiled ACs, locations and labels of the lookup- and training-fasta - optional, built by
+        #     bl/model_builder.py; without it the fasta-files are parsed
+        self._metadata_store = os.path.join(target_folder, '{abr}_metadata.npz'.format(abr=target_class_abbreviation))
         # 3) check for kernel-creation-script
         self._my_string_kernel = os.path.join(data_folder, self.STRING_KERNEL)
         helper.file_check(self.my_string_kernel)
@@ -151,10 +229,16 @@ class ExternalFileManager(object):
         self._train_kernel_input = None
         self._train_fasta_file = None
         self._best_params = None
+        self._model_bundle = None
+        self._kmer_index = None
+        self._metadata_store = None
         self._test_id_file = None  # dynamically created while running
         self._test_kernel_input = None  # dynamically created while running
         self._globals_file = None
         self._matrix_folder = None
+        self._target_class_abbreviation = None
+        self._target_folder = None
+        self._blast_script_folder = None
         self._my_string_kernel = None
         self._blast_db = None
         self._psiblast2hssp = None
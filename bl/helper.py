@@ -1,10 +1,13 @@
 # -*- coding: utf8 -*-
 from __future__ import print_function
+import glob
 import os
 import re
 import sys
 import datetime
+import hashlib
 import numpy
+from collections import OrderedDict
 
 
 class Helper(object):
@@ -22,6 +25,56 @@ class Helper(object):
 
         return clean_fasta
 
+    def clean_sequence_input(self, sequence, proteinname):
+        """ Same as clean_fasta_input, for a sequence given in memory (with or without fasta-header) """
+        clean_fasta = ['>{p_name}\n'.format(p_name=proteinname)]
+        sequence_lines = [line.strip() for line in sequence.splitlines()
+                          if line and not line.isspace() and not line.startswith('>')]
+        clean_fasta.append(''.join(sequence_lines))
+
+        return clean_fasta
+
+    def cleaned_sequence(self, protein, proteinname):
+        """ :return: Sequence of the protein (given in memory or as fasta-file) without header and linebreaks """
+        if protein.sequence is not None:
+            cleaned_fasta = self.clean_sequence_input(protein.sequence, proteinname)
+        else:
+            cleaned_fasta = self.clean_fasta_input(protein.fasta_file, proteinname)
+
+        return ''.join(cleaned_fasta[1:])
+
+    def normalized_sequence(self, sequence):
+        """ :return: Sequence without whitespace and stop-codon, in upper case - identical proteins are equal """
+        return ''.join(sequence.split()).upper().rstrip('*')
+
+    def sequence_digest(self, sequence):
+        """ :return: SHA-1 digest (bytes) of the normalized sequence """
+        return hashlib.sha1(self.normalized_sequence(sequence).encode('ascii', 'replace')).digest()
+
+    def input_digest(self, protein, proteinname):
+        """ :return: SHA-1 hex-digest of the normalized sequence and the profile of a protein - proteins with the same
+        digest get the same prediction """
+        digest = hashlib.sha1()
+        digest.update(self.normalized_sequence(self.cleaned_sequence(protein, proteinname)).encode('ascii', 'replace'))
+        digest.update(b'\0')  # separator, so shifted parts can't produce the same digest
+        if protein.profile is not None:
+            digest.update(protein.profile.encode('utf8'))
+        elif protein.blast_file is not None:
+            with open(protein.blast_file, 'rb') as blast_src:
+                for block in iter(lambda: blast_src.read(1024 * 1024), b''):
+                    digest.update(block)
+
+        return digest.hexdigest()
+
+    def file_digest(self, file_name):
+        """ :return: SHA-1 hex-digest of the content of a file, used to notice changes of input files """
+        digest = hashlib.sha1()
+        with open(file_name, 'rb') as file_src:
+            for block in iter(lambda: file_src.read(1024 * 1024), b''):
+                digest.update(block)
+
+        return digest.hexdigest()
+
     def file_check(self, file_name):
         """
         Checks if file is available, if not exits the program!
@@ -68,6 +121,38 @@ class Helper(object):
 
         return folder_is_there
 
+    def find_input_files(self, fasta_folder, fasta_suffix, blast_folder, blast_suffix):
+        """ Match the fasta- and blast-files of all proteins, with the same checks as get_fasta_files and
+        get_blast_files of LocNuclei, but without creating the proteins yet.
+        :return: OrderedDict of protein name to tupel(fasta-file, blast-file)
+        """
+        input_files = OrderedDict()
+        fasta_counter = 0
+        for fasta_file in glob.iglob(os.path.join(fasta_folder, fasta_suffix)):
+            fasta_counter += 1
+            fasta_name = os.path.basename(fasta_file)
+            fasta_name = fasta_name[:fasta_name.find('.')]  # reduces the file-name to the prefix only
+            input_files[fasta_name] = (fasta_file, None)
+
+        if len(input_files) == fasta_counter:  # sanity check
+            if self.verbose:
+                print('Read {nr} FastaFiles from {dire}'.format(nr=fasta_counter, dire=fasta_folder))
+        else:
+            error('Read {nr} of FastaFiles but only {nr2} unique prefixes'.format(
+                nr=fasta_counter, nr2=len(input_files)))
+            exit(500)
+
+        for blast_file in glob.iglob(os.path.join(blast_folder, blast_suffix)):
+            blast_name = os.path.basename(blast_file)
+            blast_name = blast_name[:blast_name.find('.')]  # reduces the file-name to the prefix only
+            if blast_name in input_files:
+                input_files[blast_name] = (input_files[blast_name][0], blast_file)
+            else:
+                error('Found Blast-File {bf} for which no fasta-file was provided'.format(bf=blast_file))
+                exit(404)
+
+        return input_files
+
     def read_protein_numbers(self, proteinnumbers_file):
         """
 
@@ -171,7 +256,11 @@ class Helper(object):
         if not self.file_check(matrix_file):
             exit(404)
 
-        gram_train = numpy.loadtxt(matrix_file, skiprows=header_row_count)
+        if matrix_file.endswith('.npy'):
+            # binary matrix created by bl/model_builder.py - mapped read-only, so the page cache is shared
+            gram_train = numpy.load(matrix_file, mmap_mode='r')
+        else:
+            gram_train = numpy.loadtxt(matrix_file, skiprows=header_row_count)
 
         if self.verbose:
             print("gram_train_shape: " + str(gram_train.shape))
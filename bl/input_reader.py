@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+""" Streaming readers for query proteins given as one multi-fasta file and one profile archive, instead of one file
+per protein in two folders
+
+Both files may be gzip-compressed. The profile archive is either
+ - a tar-archive (optionally gzip- or bzip2-compressed) with one profile-file per protein, named like the files of
+   a blast-folder ({AC}.profile), or
+ - all profiles concatenated into one file, each preceded by a header-line '>{AC}' as in a fasta-file
+Proteins and profiles are matched by accession: the id of the fasta-header (truncated by whitespace, the accession
+within composed ids like 'sp|P40218|YM24_YEAST') and the file name prefix before the first dot of a tar-member.
+Everything is read lazily - profiles in the order of the fasta-file are never held in memory longer than their
+protein, profiles in another order until their protein is read.
+"""
+from __future__ import print_function
+import gzip
+import io
+import os
+import sys
+import tarfile
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class InputReader(object):
+
+    ID_SEPARATORS = ('|', '#')  # of composed fasta-ids, see accession
+
+    def iter_query_proteins(self, fasta_file, profile_archive):
+        """ Yield the proteins of the fasta-file together with their profiles
+        :return: Generator of tupel(accession, sequence, profile), in the order of the fasta-file
+        """
+        profiles = self.iter_profiles(profile_archive)
+        waiting_profiles = dict()  # accession -> profile, read ahead while looking for the profile of a protein
+        seen_accessions = set()
+        for accession, sequence in self.iter_fasta(fasta_file):
+            if accession in seen_accessions:
+                error('Protein {ac} is given twice in {fl}'.format(ac=accession, fl=fasta_file))
+                exit(500)
+            seen_accessions.add(accession)
+
+            profile = waiting_profiles.pop(accession, None)
+            while profile is None:
+                profile_accession, next_profile = next(profiles, (None, None))
+                if profile_accession is None:
+                    error('Found no profile for {ac} in {fl}'.format(ac=accession, fl=profile_archive))
+                    exit(404)
+                if profile_accession == accession:
+                    profile = next_profile
+                elif profile_accession in seen_accessions or profile_accession in waiting_profiles:
+                    error('Profile {ac} is given twice in {fl}'.format(ac=profile_accession, fl=profile_archive))
+                    exit(500)
+                else:
+                    waiting_profiles[profile_accession] = next_profile
+
+            yield accession, sequence, profile
+
+        for profile_accession, profile in profiles:
+            waiting_profiles[profile_accession] = profile
+        if waiting_profiles:
+            error('Found profiles for which no protein was provided: {ac}'.format(
+                ac=', '.join(sorted(waiting_profiles))))
+            exit(404)
+
+    def iter_fasta(self, fasta_file):
+        """ :return: Generator of tupel(accession, sequence) of all proteins in the (multi-)fasta-file """
+        accession = None
+        sequence_lines = list()
+        with self.open_text(fasta_file) as fasta_src:
+            for line in fasta_src:
+                if line.startswith('>'):
+                    if accession is not None:
+                        yield accession, ''.join(sequence_lines)
+                    accession = self.accession(line[1:])
+                    sequence_lines = list()
+                elif line and not line.isspace():
+                    if accession is None:
+                        error('{fl} does not start with a fasta-header'.format(fl=fasta_file))
+                        exit(500)
+                    sequence_lines.append(line.strip())
+        if accession is not None:
+            yield accession, ''.join(sequence_lines)
+
+    def iter_profiles(self, profile_archive):
+        """ :return: Generator of tupel(accession, profile) of all profiles in a tar-archive or concatenated file """
+        if tarfile.is_tarfile(profile_archive):
+            return self.iter_tar_profiles(profile_archive)
+
+        return self.iter_concatenated_profiles(profile_archive)
+
+    def iter_tar_profiles(self, profile_archive):
+        # 'r|*' reads the (compressed) archive as a stream, member by member
+        with tarfile.open(profile_archive, 'r|*') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                member_name = os.path.basename(member.name)
+                if member_name.startswith('.'):
+                    continue  # e.g. meta-data files of the archiving tool
+                accession = member_name.split('.')[0]  # the file name prefix, as for a blast-folder
+                yield accession, archive.extractfile(member).read().decode('utf-8')
+
+    def iter_concatenated_profiles(self, profile_archive):
+        accession = None
+        profile_lines = list()
+        with self.open_text(profile_archive) as profile_src:
+            for line in profile_src:
+                if line.startswith('>'):
+                    if accession is not None:
+                        yield accession, ''.join(profile_lines)
+                    accession = self.accession(line[1:])
+                    profile_lines = list()
+                elif accession is not None:
+                    profile_lines.append(line)
+                elif line and not line.isspace():
+                    error('{fl} is neither a tar-archive nor starts with a profile-header '
+                          '">{{AC}}"'.format(fl=profile_archive))
+                    exit(500)
+        if accession is not None:
+            yield accession, ''.join(profile_lines)
+
+    def accession(self, header):
+        """ :return: Accession of a fasta-header (without '>'): its id, for composed ids the accession within it -
+        the second field of UniProt-ids ('sp|P40218|YM24_YEAST') and of the ids of the LocNuclei data-sets
+        ('TTLL3_MOUSE|A4Q9E5|...', '3HAO_YEAST#P47096#...')
+        """
+        header_values = header.split()
+        if not header_values:
+            return ''
+        protein_id = header_values[0]
+        for separator in self.ID_SEPARATORS:
+            id_values = protein_id.split(separator)
+            if len(id_values) >= 2 and id_values[1]:
+                return id_values[1]
+
+        return protein_id
+
+    def open_text(self, file_name):
+        """ :return: File opened for reading text, decompressed if it is gzip-compressed """
+        with open(file_name, 'rb') as file_src:
+            is_compressed = file_src.read(2) == GZIP_MAGIC
+        if is_compressed:
+            return io.TextIOWrapper(gzip.open(file_name, 'rb'), encoding='utf-8')
+
+        return io.open(file_name, 'r', encoding='utf-8')
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
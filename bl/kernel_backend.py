@@ -0,0 +1,222 @@
+# -*- coding: utf8 -*-
+""" Backends calculating the string-kernel of query proteins against training proteins for the SVMPredictor
+
+Both return the un-normalized kernel in the layout of the my-string-kernel output: one row per query protein with one
+column per training protein plus the query's self-hit as last column.
+ - 'binary': calls bl/data/my-string-kernel on the worker pool and parses its output
+ - 'numpy': calculates the same kernel with bl/profile_kernel.py in this process - the neighborhoods of the training
+   proteins are read from the index built by bl/model_builder.py (or indexed on first use) once per
+   kernel-parameter combination and kept for all following batches
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy
+from bl.profile_kernel import NeighborhoodIndex, ProfileKernel
+from bl.run_statistics import RunStatistics
+from bl.worker_pool import FinishedCall
+
+KERNEL_BACKENDS = ('binary', 'numpy')
+DEFAULT_KERNEL_BACKEND = 'binary'
+
+
+class StringKernelBackend(object):
+
+    def submit_kernel(self, max_kmer_length, max_sub_score, test_id_file, test_kernel_input, train_id_file,
+                      train_kernel_input):
+        """ Start my-string-kernel on the next free worker
+        :return: Pending kernel, to be passed to collect_kernel
+        """
+        kernel_call = self.build_string_kernel_call(max_kmer_length, max_sub_score, test_id_file, test_kernel_input,
+                                                    train_id_file, train_kernel_input)
+        if self.verbose:
+            print(' '.join(kernel_call))
+        return self.worker_pool.submit_external_call(kernel_call)
+
+    def collect_kernel(self, pending_kernel, max_kmer_length, max_sub_score):
+        """ Wait for a kernel submitted by submit_kernel
+        :return: Un-normalized kernel as 2-D array, self-hits in the last column
+        """
+        out, run_time = self.collect_string_kernel_output(pending_kernel, max_kmer_length, max_sub_score)
+        kernel_values = self.parse_string_kernel_output(out)
+        self.run_statistics.add_external_run('kernel_l{k}_y{y}'.format(k=max_kmer_length, y=max_sub_score), run_time,
+                                             items=0 if kernel_values is None else len(kernel_values))
+        return kernel_values
+
+    def build_string_kernel_call(self, max_kmer_length, max_sub_score, test_id_file, test_kernel_input,
+                                 train_id_file, train_kernel_input):
+        max_kmer_length = str(max_kmer_length)  # subprocess arguments need to be strings
+        max_sub_score = str(max_sub_score)
+
+        kernel_call = list()
+        kernel_call.append(self.fm.my_string_kernel)
+        kernel_call.append('-o')
+        kernel_call.append(test_id_file)
+        kernel_call.append('-O')
+        kernel_call.append(train_id_file)
+        kernel_call.append('-p')
+        kernel_call.append(test_kernel_input)
+        kernel_call.append('-P')
+        kernel_call.append(train_kernel_input)
+        kernel_call.append('-K')
+        kernel_call.append('-L')
+        kernel_call.append(max_kmer_length)
+        kernel_call.append('-Y')
+        kernel_call.append(max_sub_score)
+        kernel_call.append('-i')
+        kernel_call.append(self.fm.amino_file)
+        kernel_call.append('-g')
+        kernel_call.append(self.fm.globals_file)
+
+        # call to kernel:
+        # my $kernelCommand = "$stringKernelExePath -o $combinedIDFile -O $trainIDsFilePath
+        # -p $kernelInputFile -P $trainInputFilePath -K -L $maxKmerLength -Y $maxSubScore -i $aminoFilePath
+        # -g $globalsFilePath  1> $kernelMatrixFilePath 2> $kernelMatrixErrorFilePath";
+
+        return kernel_call
+
+    def collect_string_kernel_output(self, pending_call, max_kmer_length, max_sub_score):
+        """ :return: tupel(stdout of my-string-kernel, tupel(wall-seconds, cpu-seconds) of its run) """
+        returncode, out, err, run_time = pending_call.get()
+        if out and self.verbose:
+            print('String-Kernel finished for parameters k-mer-length {k} and sub-scores {l} in {s:.2f}s'.format(
+                k=max_kmer_length, l=max_sub_score, s=run_time[0]))
+        if err:
+            if self.verbose:
+                print(err)
+        if returncode:
+            code = int(returncode)
+            print(out)
+            print(err)
+            if code != 0:
+                error('String-kernel returned with exit-code {nr}'.format(nr=code))
+                exit(666)
+
+        return out, run_time
+
+    def parse_string_kernel_output(self, out):
+        """ Parse the my-string-kernel output
+        :param out: stdout of my-string-kernel - a header-line with row/column-counts, followed by one row per query
+                with one column per training protein plus the query's self-hit as last column
+        :return: Un-normalized kernel as 2-D array, None if there was no output
+        """
+        if not out:
+            return None
+
+        lines = out.split(b'\n')
+        header_index = 0
+        while not lines[header_index].strip() or lines[header_index].strip().startswith(b'Read in all data files.'):
+            header_index += 1
+        header_values = lines[header_index].strip().split()
+        try:
+            row_count = int(header_values[0])
+            col_count = int(header_values[1])
+        except (ValueError, IndexError):
+            error('Was not able to parse row/column-counts from my-string-kernel output')
+            exit(712)
+
+        kernel_values = numpy.fromstring(b'\n'.join(lines[header_index + 1:]).decode('ascii'), dtype=numpy.float64,
+                                         sep=' ')
+        if kernel_values.size != row_count * (col_count + 1):
+            error('my-string-kernel output has {nr} values, expected {r} rows with {c} columns '
+                  'plus self-hit'.format(nr=kernel_values.size, r=row_count, c=col_count))
+            exit(713)
+
+        return kernel_values.reshape(row_count, col_count + 1)
+
+    def __init__(self, is_verbose, file_manager, worker_pool, run_statistics):
+        self.verbose = is_verbose
+        self.fm = file_manager
+        self.worker_pool = worker_pool
+        self.run_statistics = run_statistics
+
+
+class ProfileKernelBackend(object):
+
+    def submit_kernel(self, max_kmer_length, max_sub_score, test_id_file, test_kernel_input, train_id_file,
+                      train_kernel_input):
+        """ Calculate the kernel of the query proteins against the indexed training proteins
+        :return: Finished kernel, to be passed to collect_kernel
+        """
+        index = self.training_index(max_kmer_length, max_sub_score, train_id_file, train_kernel_input)
+        query_count = len(self.read_ids(test_id_file))
+        with self.run_statistics.stage('kernel_l{k}_y{y}'.format(k=max_kmer_length, y=max_sub_score), query_count):
+            kernel_values = self.profile_kernel.kernel_rows(index, test_kernel_input)
+        if len(kernel_values) != query_count:
+            error('Kernel input {fl} has {nr} proteins, expected {q}'.format(fl=test_kernel_input,
+                                                                             nr=len(kernel_values), q=query_count))
+            exit(741)
+        if self.verbose:
+            print('Profile-kernel finished for parameters k-mer-length {k} and sub-scores {l}'.format(
+                k=max_kmer_length, l=max_sub_score))
+
+        return FinishedCall(kernel_values)
+
+    def collect_kernel(self, pending_kernel, max_kmer_length, max_sub_score):
+        """ :return: Un-normalized kernel as 2-D array, self-hits in the last column """
+        return pending_kernel.get()
+
+    def training_index(self, max_kmer_length, max_sub_score, train_id_file, train_kernel_input):
+        """ :return: NeighborhoodIndex of the training proteins - stored by bl/model_builder.py or built on first use
+        """
+        index_key = (max_kmer_length, max_sub_score, train_kernel_input)
+        if index_key not in self._training_indices:
+            with self.run_statistics.stage('neighborhood_index'):
+                index = self.read_stored_index(max_kmer_length, max_sub_score, train_kernel_input)
+                if index is None:
+                    index = self.profile_kernel.build_index(train_kernel_input, max_kmer_length, max_sub_score)
+            train_count = len(self.read_ids(train_id_file))
+            if len(index.train_names) != train_count:
+                error('Kernel input {fl} has {nr} proteins, expected {t}'.format(fl=train_kernel_input,
+                                                                                 nr=len(index.train_names),
+                                                                                 t=train_count))
+                exit(741)
+            self._training_indices[index_key] = index
+
+        return self._training_indices[index_key]
+
+    def read_stored_index(self, max_kmer_length, max_sub_score, train_kernel_input):
+        """ :return: NeighborhoodIndex built by bl/model_builder.py, if it was built from the current content of the
+        training kernel input, None otherwise
+        """
+        index_file = self.fm.neighborhood_index_file_for_params(max_kmer_length, max_sub_score)
+        if not os.path.isfile(index_file):
+            return None
+
+        index = NeighborhoodIndex(self.verbose)
+        index.read_index_file(index_file)
+        if not index.is_built_from(max_kmer_length, max_sub_score, train_kernel_input):
+            if self.verbose:
+                print('Neighborhood-index {fl} was not built from {tr} - the index is built again'.format(
+                    fl=index_file, tr=train_kernel_input))
+            return None
+
+        return index
+
+    def read_ids(self, id_file):
+        with open(id_file, 'r') as id_src:
+            return [line.strip() for line in id_src if line and not line.isspace()]
+
+    def __init__(self, is_verbose, file_manager, run_statistics):
+        self.verbose = is_verbose
+        self.fm = file_manager
+        self.run_statistics = run_statistics
+        self.profile_kernel = ProfileKernel(is_verbose)
+        self._training_indices = dict()  # (l, y, training kernel input) -> NeighborhoodIndex
+
+
+def create_kernel_backend(is_verbose, backend_name, file_manager, worker_pool, run_statistics=None):
+    """ :return: Kernel backend of the given name, one of KERNEL_BACKENDS """
+    if run_statistics is None:
+        run_statistics = RunStatistics(is_verbose)
+    if backend_name == 'binary':
+        return StringKernelBackend(is_verbose, file_manager, worker_pool, run_statistics)
+    elif backend_name == 'numpy':
+        return ProfileKernelBackend(is_verbose, file_manager, run_statistics)
+
+    error('Unknown kernel-backend {b}, use one of: {all}'.format(b=backend_name, all=', '.join(KERNEL_BACKENDS)))
+    exit(742)
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+""" Inverted index of the k-mers of the lookup proteins, used to skip blastpgp for query proteins without any
+plausible homologue in the blast-db
+
+For every k-mer the index stores the lookup proteins and positions it occurs at. A query's score is the highest
+number of k-mers it shares with one lookup protein on one diagonal band of the dot-plot - homologues share
+k-mers along their alignment-diagonal, random matches are scattered.
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy
+
+
+class KmerIndex(object):
+
+    INDEX_VERSION = 1
+    KMER_LENGTH = 4
+    BAND_WIDTH = 16  # diagonals merged into one band, to tolerate small insertions/deletions
+    ALPHABET_SIZE = 26  # k-mers are encoded on the letters A-Z
+
+    def build_index(self, lookup_fasta):
+        """ Index all sequences of the lookup-fasta
+        :param lookup_fasta: LookUp-Fasta which was used to build the blast-db
+        :return: None
+        """
+        all_codes = list()
+        all_targets = list()
+        all_positions = list()
+        self.target_count = 0
+        for sequence in self.__read_sequences(lookup_fasta):
+            codes, positions = self.kmer_codes(sequence)
+            all_codes.append(codes)
+            all_targets.append(numpy.full(len(codes), self.target_count, dtype=numpy.int32))
+            all_positions.append(positions.astype(numpy.int32))
+            self.target_count += 1
+
+        all_codes = numpy.concatenate(all_codes)
+        order = numpy.argsort(all_codes, kind='stable')
+        self._offsets = numpy.searchsorted(all_codes[order],
+                                           numpy.arange(self.ALPHABET_SIZE ** self.KMER_LENGTH + 1)).astype(numpy.int64)
+        self._targets = numpy.concatenate(all_targets)[order]
+        self._positions = numpy.concatenate(all_positions)[order]
+
+        if self.verbose:
+            print('Indexed {nr} k-mers of {t} lookup-proteins'.format(nr=len(self._targets), t=self.target_count))
+
+    def kmer_codes(self, sequence):
+        """ :return: tupel(codes, positions) of all k-mers of the sequence consisting of letters only """
+        letters = numpy.frombuffer(sequence.upper().encode('ascii', 'replace'), dtype=numpy.uint8).astype(numpy.int64)
+        letters -= ord('A')
+        kmer_count = len(letters) - self.KMER_LENGTH + 1
+        if kmer_count < 1:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+        is_letter = (letters >= 0) & (letters < self.ALPHABET_SIZE)
+        codes = numpy.zeros(kmer_count, dtype=numpy.int64)
+        is_valid = numpy.ones(kmer_count, dtype=bool)
+        for offset in range(self.KMER_LENGTH):
+            codes = codes * self.ALPHABET_SIZE + letters[offset:offset + kmer_count]
+            is_valid &= is_letter[offset:offset + kmer_count]
+
+        positions = numpy.nonzero(is_valid)[0]
+        return codes[is_valid], positions
+
+    def best_diagonal_score(self, sequence):
+        """ :return: Highest number of k-mers the sequence shares with one lookup protein on one diagonal band """
+        codes, query_positions = self.kmer_codes(sequence)
+        starts = self._offsets[codes]
+        hit_counts = self._offsets[codes + 1] - starts
+        total_hits = int(hit_counts.sum())
+        if total_hits == 0:
+            return 0
+
+        # indices of all postings of all query k-mers, without a python-loop over the k-mers
+        hit_indices = numpy.repeat(starts - numpy.cumsum(hit_counts) + hit_counts, hit_counts) + \
+            numpy.arange(total_hits)
+        targets = self._targets[hit_indices].astype(numpy.int64)
+        diagonals = self._positions[hit_indices] - numpy.repeat(query_positions, hit_counts) + len(sequence)
+        max_band_count = (int(self._positions.max()) + len(sequence)) // self.BAND_WIDTH + 1
+        band_keys = targets * max_band_count + diagonals // self.BAND_WIDTH
+
+        return int(numpy.unique(band_keys, return_counts=True)[1].max())
+
+    def write_index_file(self, index_file):
+        with open(index_file, 'wb') as index_out:
+            numpy.savez(index_out, version=numpy.int64(self.INDEX_VERSION), kmer_length=numpy.int64(self.KMER_LENGTH),
+                        band_width=numpy.int64(self.BAND_WIDTH), target_count=numpy.int64(self.target_count),
+                        offsets=self._offsets, targets=self._targets, positions=self._positions)
+
+        if self.verbose:
+            print('Wrote k-mer index to {fl}'.format(fl=index_file))
+
+    def read_index_file(self, index_file):
+        if not os.path.isfile(index_file):
+            error('K-mer index {fl} not available - exit!'.format(fl=index_file))
+            exit(404)
+
+        with numpy.load(index_file, allow_pickle=False) as arrays:
+            if int(arrays['version']) != self.INDEX_VERSION or int(arrays['kmer_length']) != self.KMER_LENGTH or \
+                    int(arrays['band_width']) != self.BAND_WIDTH:
+                error('K-mer index {fl} was built with another version - '
+                      'please rebuild it with bl/model_builder.py'.format(fl=index_file))
+                exit(730)
+            self.target_count = int(arrays['target_count'])
+            self._offsets = arrays['offsets']
+            self._targets = arrays['targets']
+            self._positions = arrays['positions']
+
+        if self.verbose:
+            print('Read k-mer index of {nr} lookup-proteins from {fl}'.format(nr=self.target_count, fl=index_file))
+
+    def __read_sequences(self, lookup_fasta):
+        sequence_lines = None
+        with open(lookup_fasta, 'r') as lookup:
+            for line in lookup:
+                if line.startswith('>'):
+                    if sequence_lines is not None:
+                        yield ''.join(sequence_lines)
+                    sequence_lines = list()
+                elif sequence_lines is not None:
+                    sequence_lines.append(line.strip())
+        if sequence_lines is not None:
+            yield ''.join(sequence_lines)
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+        self.target_count = 0
+        self._offsets = None
+        self._targets = None
+        self._positions = None
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
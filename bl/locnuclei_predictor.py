@@ -1,14 +1,23 @@
 # -*- coding: utf8 -*-
 from __future__ import print_function
 import glob
+import itertools
 import os
+import shutil
 import sys
 import tempfile
 import subprocess
+from collections import OrderedDict
 from bl.blast_predictor import BlastPredictor
+from bl.checkpoint import Checkpoint
 from bl.external_file_manager import ExternalFileManager
+from bl.kernel_backend import DEFAULT_KERNEL_BACKEND
+from bl.metadata_store import MetadataStore
+from bl.result_cache import ResultCache
 from bl.result_writer import ResultWriter
+from bl.run_statistics import RunStatistics
 from bl.svm_predictor import SVMPredictor
+from bl.worker_pool import WorkerPool
 
 from bl.helper import Helper
 from bl.protein import Protein
@@ -16,10 +25,23 @@ from bl.protein import Protein
 
 class LocNucleiPredictor(object):
 
-    def __init__(self, verbose, debug, predict_traveller):
+    DEFAULT_BATCH_SIZE = 500  # proteins predicted together by the in-memory API
+
+    def __init__(self, verbose, debug, predict_traveller, jobs=1, blast_threads=1, cache_file=None,
+                 cache_max_mb=ResultCache.DEFAULT_MAX_SIZE_MB, kmer_min_score=None,
+                 kernel_backend=DEFAULT_KERNEL_BACKEND, run_statistics=None, worker_pool=None, resume=False):
         self.verbose = verbose
         self.debug = debug
         self.predict_traveller = predict_traveller
+        self.jobs = jobs
+        self.blast_threads = blast_threads
+        self.cache_file = cache_file  # SQLite-file to cache results in, no caching if None
+        self.cache_max_mb = cache_max_mb
+        self.kmer_min_score = kmer_min_score  # None: default of the BlastPredictor for the target
+        self.kernel_backend = kernel_backend  # see bl/kernel_backend.py
+        self.run_statistics = run_statistics  # see bl/run_statistics.py, a new one is created if None
+        self.worker_pool = worker_pool  # shared with other predictors, closed by its creator - created if None
+        self.resume = resume  # continue from the checkpoints in the given temp-folder, see bl/checkpoint.py
 
     def __enter__(self):
         # using encapsulated class in 'PackageResource' as in
@@ -29,6 +51,8 @@ class LocNucleiPredictor(object):
             """
             The initial starting point for all locnuclei related methods and sub-procedures
             """
+            CHECKPOINT_FOLDER = 'checkpoints'  # in the working-directory, one sub-folder per target
+
             def get_fasta_files(self, fasta_folder, fasta_suffix):
                 """ Read all Fasta-Files in a big dictionary.
                 :param fasta_folder: Folder where the fasta-files to predict are stored
@@ -91,13 +115,37 @@ class LocNucleiPredictor(object):
 
                 return work_dir
 
+            def prepare_checkpoint(self):
+                """ Record finished work in the working-directory, if it was given by the user - so a run that
+                dies can be resumed. Without resume, markers of a previous run are removed.
+                """
+                if self.remove_working_dir:
+                    if self.resume:
+                        error('Resuming a run needs the temp-folder of the run to resume')
+                        exit(760)
+                    return  # a new temporary directory would not be found again
+
+                checkpoint_folder = os.path.join(self.working_directory, self.CHECKPOINT_FOLDER,
+                                                 self.file_manager.target_class_abbreviation)
+                self.checkpoint = Checkpoint(self.verbose, checkpoint_folder, self.resume)
+                if self.blast_predictor is not None:
+                    self.blast_predictor.checkpoint = self.checkpoint
+                if self.svm_predictor is not None:
+                    self.svm_predictor.checkpoint = self.checkpoint
+
             def write_results_to_output_file(self, result_file):
                 writer = ResultWriter(self.verbose)
-                writer.write_results_to_file(self.all_query_proteins, result_file)
+                with self.run_statistics.stage('output', len(self.all_query_proteins)):
+                    writer.write_results_to_file(self.all_query_proteins, result_file)
 
-            def clean_up(self):
+            def clean_up(self, keep_checkpoint=False):
+                """ :param keep_checkpoint: Keep the checkpoint, e.g. because the run failed and may be resumed """
                 if self.verbose:
                     print('Cleaning up temp-files and -folders')
+                if self.checkpoint is not None and not keep_checkpoint:
+                    self.checkpoint.remove()
+                    if not os.listdir(os.path.dirname(self.checkpoint.checkpoint_folder)):
+                        os.rmdir(os.path.dirname(self.checkpoint.checkpoint_folder))
                 for file_to_delete in self.files_to_remove:
                     if self.verbose:
                         print('Deleting {fl}'.format(fl=file_to_delete))
@@ -115,24 +163,356 @@ class LocNucleiPredictor(object):
 
             def predict_given_files(self, fasta_folder, fasta_suffix, blast_folder, blast_suffix, tmp_folder, out_file, only_blast):
                 # 0) Read files and determine the workload
-                self.get_fasta_files(fasta_folder, fasta_suffix)
-                self.get_blast_files(blast_folder, blast_suffix)
+                with self.run_statistics.stage('input_discovery'):
+                    self.get_fasta_files(fasta_folder, fasta_suffix)
+                    self.get_blast_files(blast_folder, blast_suffix)
                 self.prepare_temporary_directory(tmp_folder)
+                self.prepare_checkpoint()
                 # self.prepare_query_files(tmp_folder)
+                # 1) + 2) Blast and SVM predictions
+                self.all_query_proteins = self.predict_query_proteins(self.all_query_proteins, only_blast)
+
+                # 3) Write out results
+                self.write_results_to_output_file(out_file)
+
+            def stream_given_files(self, fasta_folder, fasta_suffix, blast_folder, blast_suffix, tmp_folder, out_file,
+                                   only_blast, batch_size):
+                """ Same as predict_given_files, but predicts the proteins in batches of batch_size and appends
+                the results of every batch to the output file as soon as it is done. Only the file names of all
+                proteins are held in memory, everything else only for the current batch.
+                """
+                with self.run_statistics.stage('input_discovery'):
+                    input_files = self.find_input_files(fasta_folder, fasta_suffix, blast_folder, blast_suffix)
+                self.stream_input_files(input_files, tmp_folder, out_file, only_blast, batch_size)
+
+            def stream_input_files(self, input_files, tmp_folder, out_file, only_blast, batch_size):
+                """ Same as stream_given_files, for input files discovered before (e.g. a shard of bl/sharding.py)
+                :param input_files: OrderedDict of protein name to tupel(fasta-file, blast-file), as returned by
+                        find_input_files
+                """
+                self.prepare_temporary_directory(tmp_folder)
+                self.prepare_checkpoint()
+                writer = ResultWriter(self.verbose)
+
+                with open(out_file, 'w') as target:
+                    target.write(writer.HEADER)
+                    protein_names = list(input_files)
+                    for batch_start in range(0, len(protein_names), batch_size):
+                        batch_query_proteins = OrderedDict()
+                        for protein_name in protein_names[batch_start:batch_start + batch_size]:
+                            batch_query_proteins[protein_name] = Protein(self.verbose)
+                            batch_query_proteins[protein_name].fasta_file, \
+                                batch_query_proteins[protein_name].blast_file = input_files[protein_name]
+
+                        batch_query_proteins = self.predict_batch(batch_query_proteins, only_blast)
+                        with self.run_statistics.stage('output', len(batch_query_proteins)):
+                            writer.write_result_lines(batch_query_proteins, target)
+                            target.flush()  # results of finished batches can be read while the rest is predicted
+                        if self.verbose or batch_size < len(protein_names):
+                            print('Predicted {nr} of {t} proteins'.format(nr=batch_start + len(batch_query_proteins),
+                                                                         t=len(protein_names)))
+
+            def stream_query_records(self, query_records, tmp_folder, out_file, only_blast, batch_size):
+                """ Same as stream_input_files, for proteins read lazily, e.g. by bl/input_reader.py - only the
+                current batch is held in memory
+                :param query_records: Iterable of tupel(id, sequence, profile)
+                """
+                self.prepare_temporary_directory(tmp_folder)
+                self.prepare_checkpoint()
+                writer = ResultWriter(self.verbose)
+
+                protein_count = 0
+                with open(out_file, 'w') as target:
+                    target.write(writer.HEADER)
+                    for batch in self.iter_record_batches(query_records, batch_size):
+                        batch_query_proteins, protein_ids = self.record_query_proteins(batch, protein_count)
+                        batch_query_proteins = self.predict_batch(batch_query_proteins, only_blast)
+                        with self.run_statistics.stage('output', len(batch_query_proteins)):
+                            writer.write_result_lines(batch_query_proteins, target, protein_ids)
+                            target.flush()
+                        protein_count += len(batch)
+                        # the number of batches is unknown while reading, a full batch may be followed by others
+                        if self.verbose or protein_count > len(batch) or len(batch) == batch_size:
+                            print('Predicted {nr} proteins'.format(nr=protein_count))
+
+            def iter_record_batches(self, query_records, batch_size):
+                """ :return: Generator of lists of at most batch_size records of the iterable """
+                query_records = iter(query_records)
+                while True:
+                    with self.run_statistics.stage('input_read'):
+                        batch = list(itertools.islice(query_records, batch_size))
+                    if not batch:
+                        return
+                    yield batch
+
+            def record_query_proteins(self, batch, first_number=0):
+                """ Create the query proteins of a batch of records under internal names, so any id can be given -
+                numbered from first_number on, so the names stay unique (and resumable) over all batches of a run
+                :param batch: List of tupel(id, sequence, profile)
+                :return: tupel(OrderedDict of internal name to Protein, dictionary of internal name to id)
+                """
+                query_proteins = OrderedDict()
+                protein_ids = dict()
+                for protein_nr, (protein_id, sequence, profile) in enumerate(batch, first_number):
+                    protein_name = 'q{nr}'.format(nr=protein_nr)
+                    query_proteins[protein_name] = Protein(self.verbose)
+                    query_proteins[protein_name].sequence = sequence
+                    query_proteins[protein_name].profile = profile
+                    protein_ids[protein_name] = protein_id
+
+                return query_proteins, protein_ids
+
+            def find_input_files(self, fasta_folder, fasta_suffix, blast_folder, blast_suffix):
+                """ Match the fasta- and blast-files of all proteins, with the same checks as get_fasta_files and
+                get_blast_files, but without creating the proteins yet.
+                :return: OrderedDict of protein name to tupel(fasta-file, blast-file)
+                """
+                helper = Helper(self.verbose)
+                return helper.find_input_files(fasta_folder, fasta_suffix, blast_folder, blast_suffix)
+
+            def load_predictors(self, only_blast=False):
+                """ Create the predictors and load their lookup-data and models once - they are kept for all
+                following predictions of this object.
+                :param only_blast: Don't load the SVM-models
+                :return: None
+                """
+                if self.metadata_store is None:
+                    # shared by both predictors, if bl/model_builder.py built it from the current fasta-files
+                    metadata_store = MetadataStore(self.verbose)
+                    with self.run_statistics.stage('metadata_load'):
+                        is_current = metadata_store.read_store_if_current(self.file_manager.metadata_store,
+                                                                          self.file_manager.lookup_fasta,
+                                                                          self.file_manager.train_fasta_file)
+                    if is_current:
+                        self.metadata_store = metadata_store
+                if self.blast_predictor is None:
+                    self.blast_predictor = BlastPredictor(self.verbose, self.working_directory, self.file_manager,
+                                                          self.predict_traveller, self.worker_pool,
+                                                          self.blast_threads, self.kmer_min_score,
+                                                          self.metadata_store, self.run_statistics, self.checkpoint)
+                    self.blast_predictor.load_lookup_proteins()
+                if not only_blast and self.svm_predictor is None:
+                    self.svm_predictor = SVMPredictor(self.verbose, self.working_directory, self.file_manager,
+                                                      worker_pool=self.worker_pool,
+                                                      metadata_store=self.metadata_store,
+                                                      kernel_backend=self.kernel_backend,
+                                                      run_statistics=self.run_statistics,
+                                                      checkpoint=self.checkpoint)
+
+            def predict_query_proteins(self, all_query_proteins, only_blast):
+                """ Predict the given query proteins, using the current working-directory for temporary files
+                :param all_query_proteins: Dictionary of protein name to Protein, with fasta_file and blast_file set
+                :param only_blast: Only run homology based inference
+                :return: The given dictionary with predictions set
+                """
+                # 0) Answer proteins predicted before from the result-cache
+                uncached_query_proteins, cache_keys = self.lookup_cached_predictions(all_query_proteins, only_blast)
+                if not uncached_query_proteins:
+                    return all_query_proteins
+                unique_query_proteins, representatives = self.deduplicate_query_proteins(uncached_query_proteins)
+
+                self.load_predictors(only_blast)
+                self.run_statistics.count('predicted_proteins', len(uncached_query_proteins))
                 # 1) Ask Blast for homologues proteins - if we've a hit we don't need to run the whole SVM-process:
-                blaster = BlastPredictor(self.verbose, self.working_directory, self.file_manager, self.predict_traveller)
-                self.all_query_proteins = blaster.predict_all_query_proteins(self.all_query_proteins)
+                self.blast_predictor.working_directory = self.working_directory
+                unique_query_proteins = self.blast_predictor.predict_all_query_proteins(unique_query_proteins)
 
                 # 2) Run SVMs for proteins without an blast-hit
                 if only_blast == False:
-                    profkernel_predictor = SVMPredictor(self.verbose, self.working_directory, self.file_manager)
-                    self.all_query_proteins = profkernel_predictor.predict_all_query_proteins_without_blast_hit(self.all_query_proteins)
+                    self.svm_predictor.working_directory = self.working_directory
+                    unique_query_proteins = \
+                        self.svm_predictor.predict_all_query_proteins_without_blast_hit(unique_query_proteins)
 
-                # 3) Write out results
-                self.write_results_to_output_file(out_file)
+                # 3) Remember the new predictions, of every protein
+                self.share_duplicate_predictions((all_query_proteins, uncached_query_proteins), representatives)
+                self.store_cached_predictions(uncached_query_proteins, cache_keys, representatives)
 
-            def __init__(self, is_verbose, predict_traveller):
+                return all_query_proteins
+
+            def lookup_cached_predictions(self, all_query_proteins, only_blast):
+                """ Set the predictions of all proteins predicted before from the checkpoint of a resumed run and
+                from the result-cache
+                :return: tupel(dictionary of the proteins that still need to be predicted, cache-key per protein)
+                """
+                if self.checkpoint is not None:
+                    unfinished_query_proteins = OrderedDict()
+                    for protein_name, protein in all_query_proteins.items():
+                        if not self.checkpoint.load_prediction(protein_name, protein):
+                            unfinished_query_proteins[protein_name] = protein
+                    self.run_statistics.count('predictions_resumed',
+                                              len(all_query_proteins) - len(unfinished_query_proteins))
+                    all_query_proteins = unfinished_query_proteins
+
+                cache_keys = dict()
+                if self.result_cache is None:
+                    return all_query_proteins, cache_keys
+
+                mode = self.file_manager.target_class_abbreviation
+                if only_blast:
+                    mode += '_blast'  # only-blast results differ for proteins without blast-hit
+                # proteins skipped by the k-mer prefilter are predicted by the SVMs instead of their blast-hit
+                mode += '_k{s}'.format(s=self.effective_kmer_min_score())
+                uncached_query_proteins = OrderedDict()
+                for protein_name, protein in all_query_proteins.items():
+                    cache_keys[protein_name] = self.result_cache.protein_key(protein_name, protein, mode)
+                    if not self.result_cache.lookup(cache_keys[protein_name], protein):
+                        uncached_query_proteins[protein_name] = protein
+                self.run_statistics.count('cache_hits', len(all_query_proteins) - len(uncached_query_proteins))
+                self.run_statistics.count('cache_misses', len(uncached_query_proteins))
+                if not uncached_query_proteins:
+                    self.result_cache.commit()
+
+                return uncached_query_proteins, cache_keys
+
+            def effective_kmer_min_score(self):
+                """ :return: k-mer score below which the BlastPredictor skips blastpgp, 0 if the prefilter is off -
+                as in BlastPredictor.load_lookup_proteins, it is only on if the k-mer index was built """
+                kmer_min_score = self.kmer_min_score
+                if kmer_min_score is None:
+                    if self.predict_traveller:
+                        kmer_min_score = BlastPredictor.TRAVELLER_KMER_MIN_SCORE
+                    else:
+                        kmer_min_score = BlastPredictor.SUBNUCLEAR_KMER_MIN_SCORE
+                if kmer_min_score <= 0 or not self.file_manager.kmer_index or \
+                        not os.path.isfile(self.file_manager.kmer_index):
+                    return 0
+
+                return kmer_min_score
+
+            def store_cached_predictions(self, query_proteins, cache_keys, representatives=None):
+                """ Remember the new predictions - not for failed BLAST-searches, whose result is incomplete
+                :param representatives: Duplicate proteins, as returned by deduplicate_query_proteins
+                """
+                if representatives is None:
+                    representatives = dict()
+                finished_query_proteins = OrderedDict(
+                    (protein_name, protein) for protein_name, protein in query_proteins.items()
+                    if representatives.get(protein_name, protein_name) not in self.blast_predictor.failed_proteins)
+                if self.checkpoint is not None:
+                    for protein_name, protein in finished_query_proteins.items():
+                        self.checkpoint.store_prediction(protein_name, protein)
+                if self.result_cache is None:
+                    return
+
+                for protein_name, protein in finished_query_proteins.items():
+                    self.result_cache.store(cache_keys[protein_name], protein)
+                self.result_cache.commit()
+
+            def deduplicate_query_proteins(self, query_proteins):
+                """ Group the query proteins by their normalized sequence and profile, e.g. isoforms or mirrored
+                entries under several accessions - every group is predicted once, for its first protein
+                :return: tupel(OrderedDict of the first protein of every group, dictionary of the name of every
+                        other protein to the name of the first protein of its group)
+                """
+                helper = Helper(self.verbose)
+                unique_query_proteins = OrderedDict()
+                representatives = dict()
+                group_names = dict()  # input-digest -> name of the first protein with it
+                with self.run_statistics.stage('deduplication', len(query_proteins)):
+                    for protein_name, protein in query_proteins.items():
+                        input_digest = helper.input_digest(protein, protein_name)
+                        if input_digest in group_names:
+                            representatives[protein_name] = group_names[input_digest]
+                        else:
+                            group_names[input_digest] = protein_name
+                            unique_query_proteins[protein_name] = protein
+                self.run_statistics.count('dedup_input_proteins', len(query_proteins))
+                self.run_statistics.count('dedup_unique_proteins', len(unique_query_proteins))
+                if self.verbose and representatives:
+                    print('{nr} of {t} query-proteins are duplicates of another query-protein'.format(
+                        nr=len(representatives), t=len(query_proteins)))
+
+                return unique_query_proteins, representatives
+
+            def share_duplicate_predictions(self, query_dictionaries, representatives):
+                """ Let every duplicate share the Protein - and so the prediction - of the first protein of its
+                group, so the ResultWriter writes the prediction for every accession
+                :param query_dictionaries: Dictionaries of protein name to Protein to update
+                :param representatives: Duplicate proteins, as returned by deduplicate_query_proteins
+                """
+                for query_proteins in query_dictionaries:
+                    for protein_name, representative_name in representatives.items():
+                        if protein_name in query_proteins:
+                            query_proteins[protein_name] = query_proteins[representative_name]
+
+            def predict_batch(self, all_query_proteins, only_blast=False):
+                """ Predict a batch of query proteins in its own sub-folder of the working-directory, which is
+                removed afterwards (unless in debug-mode). Used to predict several batches with the same, warm,
+                predictors.
+                :param all_query_proteins: Dictionary of protein name to Protein, with fasta_file and blast_file set
+                :param only_blast: Only run homology based inference
+                :return: The given dictionary with predictions set
+                """
+                base_directory = self.working_directory
+                batch_directory = tempfile.mkdtemp(dir=base_directory)
+                self.working_directory = batch_directory
+                try:
+                    all_query_proteins = self.predict_query_proteins(all_query_proteins, only_blast)
+                finally:
+                    self.working_directory = base_directory
+                    if not self.debug:
+                        shutil.rmtree(batch_directory)
+                        self.file_manager.remove_folder_from_deletion(batch_directory)
+
+                return all_query_proteins
+
+            def predict_sequences(self, query_proteins, only_blast=False, batch_size=None):
+                """ Predict proteins given in memory - temporary files are only written for the external tools
+                (blastpgp and my-string-kernel).
+                :param query_proteins: tupel(id, sequence, profile) or an iterable of them. The profile is the
+                        content of the protein's PSI-BLAST profile-file, the sequence may include a fasta-header
+                :param only_blast: Only run homology based inference
+                :param batch_size: Number of proteins predicted together
+                :return: List of PredictionRecord, in the order of the input
+                """
+                return list(self.iter_predictions(query_proteins, only_blast, batch_size))
+
+            def iter_predictions(self, query_proteins, only_blast=False, batch_size=None):
+                """ Same as predict_sequences, but yields the PredictionRecords batch by batch, so an iterable
+                input is never held in memory completely.
+                """
+                if isinstance(query_proteins, tuple) and len(query_proteins) == 3 and \
+                        all(isinstance(value, str) for value in query_proteins):
+                    query_proteins = [query_proteins]  # a single protein
+                if batch_size is None:
+                    batch_size = LocNucleiPredictor.DEFAULT_BATCH_SIZE
+                if self.working_directory is None:
+                    self.prepare_temporary_directory(None)
+
+                batch = list()
+                for query_protein in query_proteins:
+                    batch.append(query_protein)
+                    if len(batch) >= batch_size:
+                        for record in self.__predict_sequence_batch(batch, only_blast):
+                            yield record
+                        batch = list()
+                if batch:
+                    for record in self.__predict_sequence_batch(batch, only_blast):
+                        yield record
+
+            def __predict_sequence_batch(self, batch, only_blast):
+                all_query_proteins, protein_ids = self.record_query_proteins(batch)
+                all_query_proteins = self.predict_batch(all_query_proteins, only_blast)
+
+                writer = ResultWriter(self.verbose)
+                return [writer.prediction_record(protein_ids[protein_name], protein)
+                        for protein_name, protein in all_query_proteins.items()]
+
+            def close_worker_pool(self):
+                if self.owns_worker_pool:
+                    self.worker_pool.close()
+
+            def close_result_cache(self):
+                if self.result_cache is not None:
+                    if self.verbose:
+                        self.result_cache.report_statistics()
+                    self.result_cache.close()
+                    self.result_cache = None
+
+            def __init__(self, is_verbose, is_debug, predict_traveller, jobs, blast_threads, cache_file,
+                         cache_max_mb, kmer_min_score, kernel_backend, run_statistics, worker_pool, resume):
                 self.verbose = is_verbose
+                self.debug = is_debug
                 self.all_query_proteins = dict()
 
                 self.remove_working_dir = False
@@ -144,12 +524,38 @@ class LocNucleiPredictor(object):
                 self.file_manager = ExternalFileManager(is_verbose)
                 self.file_manager.is_predictor_setup_sane(predict_traveller)
 
-        self.package_obj = LocNuclei(self.verbose, self.predict_traveller)
+                self.owns_worker_pool = worker_pool is None
+                if worker_pool is None:
+                    worker_pool = WorkerPool(is_verbose, jobs)
+                self.worker_pool = worker_pool  # shared by all predictors of this run
+                self.blast_threads = blast_threads
+                self.kmer_min_score = kmer_min_score
+                self.kernel_backend = kernel_backend
+                if run_statistics is None:
+                    run_statistics = RunStatistics(is_verbose)
+                self.run_statistics = run_statistics  # shared by all predictors of this run
+                self.blast_predictor = None  # created on first prediction, see load_predictors
+                self.svm_predictor = None
+                self.metadata_store = None
+
+                self.resume = resume
+                self.checkpoint = None  # created for a working-directory given by the user, see prepare_checkpoint
+
+                self.result_cache = None
+                if cache_file:
+                    self.result_cache = ResultCache(is_verbose, cache_file, self.file_manager, cache_max_mb)
+
+        self.package_obj = LocNuclei(self.verbose, self.debug, self.predict_traveller, self.jobs, self.blast_threads,
+                                     self.cache_file, self.cache_max_mb, self.kmer_min_score,
+                                     self.kernel_backend, self.run_statistics, self.worker_pool, self.resume)
         return self.package_obj
 
     def __exit__(self, type, value, traceback):
+        self.package_obj.close_worker_pool()
+        self.package_obj.close_result_cache()
         if not self.debug:
-            self.package_obj.clean_up()
+            # a failed run (an exception or exit()) keeps its checkpoint, so it can be resumed
+            self.package_obj.clean_up(keep_checkpoint=type is not None)
 
 
 def error(*objs):
@@ -0,0 +1,179 @@
+# -*- coding: utf8 -*-
+""" Compiled metadata of the lookup- and training-fasta, built once by bl/model_builder.py
+
+Stores the ACs and location strings of the lookup proteins, the digests of their sequences (for exact-match
+predictions) and the label of every training protein for every class as a boolean matrix - so the predictors
+don't need to parse the fasta-headers on every run. The store remembers digests of the fasta-files it was built
+from and is only used as long as these are unchanged.
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy
+from bl.helper import Helper
+
+
+class MetadataStore(object):
+
+    STORE_VERSION = 1
+    DIGEST_SIZE = 20  # bytes of a SHA-1 sequence digest
+
+    def build_store(self, lookup_fasta, train_fasta, class_names):
+        """
+        :param lookup_fasta: LookUp-Fasta which was used to build the blast-db
+        :param train_fasta: Fasta of the training proteins
+        :param class_names: Names of all classes, as given in the best-params file
+        :return: None
+        """
+        helper = Helper(self.verbose)
+        lookup_acs = list()
+        lookup_locations = list()
+        sequence_digests = list()
+        sequence_lengths = list()
+        for header, sequence in self.__read_fasta_entries(lookup_fasta):
+            cols = header.split('#')
+            lookup_acs.append(cols[1].strip())
+            lookup_locations.append(cols[4].replace('\n', '').strip())
+            normalized_sequence = helper.normalized_sequence(sequence)
+            sequence_digests.append(helper.sequence_digest(normalized_sequence))
+            sequence_lengths.append(len(normalized_sequence))
+
+        self.lookup_acs = numpy.array(lookup_acs, dtype=numpy.str_)
+        self.lookup_locations = numpy.array(lookup_locations, dtype=numpy.str_)
+        # one row of raw digest-bytes per protein - fixed-length byte-strings would lose trailing zero-bytes
+        self.sequence_digests = numpy.frombuffer(b''.join(sequence_digests), dtype=numpy.uint8).reshape(
+            len(sequence_digests), self.DIGEST_SIZE)
+        self.sequence_lengths = numpy.array(sequence_lengths, dtype=numpy.int64)
+
+        # read_fasta_file is used for every class, so labels are the same as when parsing the fasta
+        self.class_names = numpy.array(sorted(class_names), dtype=numpy.str_)
+        label_columns = list()
+        train_acs = list()
+        for class_name in self.class_names:
+            y_values_train, train_acs = helper.read_fasta_file(class_name, train_fasta)
+            label_columns.append(y_values_train == 1)
+        self.train_acs = numpy.array(train_acs, dtype=numpy.str_)
+        self.train_labels = numpy.column_stack(label_columns) if label_columns else \
+            numpy.zeros((len(train_acs), 0), dtype=bool)
+
+        self.source_digests = numpy.array([helper.file_digest(lookup_fasta), helper.file_digest(train_fasta)],
+                                          dtype=numpy.str_)
+
+        if self.verbose:
+            print('Compiled metadata of {l} lookup-proteins and {t} training-proteins for {c} classes'.format(
+                l=len(self.lookup_acs), t=len(self.train_acs), c=len(self.class_names)))
+
+    def is_built_from(self, lookup_fasta, train_fasta):
+        """ :return: True if the store was built from the current content of both fasta-files """
+        helper = Helper(self.verbose)
+        return list(self.source_digests) == [helper.file_digest(lookup_fasta), helper.file_digest(train_fasta)]
+
+    def lookup_location_dict(self):
+        """ :return: Dictionary of lookup AC to its location string, as given in the lookup-fasta """
+        return dict(zip(self.lookup_acs.tolist(), self.lookup_locations.tolist()))
+
+    def lookup_sequence_index(self, min_length):
+        """ :return: Dictionary of sequence digest to the first lookup AC with this sequence, for all sequences
+        with at least min_length residues """
+        sequence_index = dict()
+        for digest, length, ac in zip(self.sequence_digests, self.sequence_lengths.tolist(),
+                                      self.lookup_acs.tolist()):
+            if length >= min_length:
+                sequence_index.setdefault(digest.tobytes(), ac)
+
+        return sequence_index
+
+    def has_class(self, class_name):
+        return class_name in self.class_names
+
+    def class_labels(self, class_name):
+        """ Same values as Helper.read_fasta_file for the training-fasta
+        :return: tupel(y-values as numpy int-array, list of training ACs)
+        """
+        class_index = int(numpy.nonzero(self.class_names == class_name)[0][0])
+        y_values_train = self.train_labels[:, class_index].astype(numpy.int64)
+        if self.verbose:
+            positives = int(y_values_train.sum())
+            print('For {cl} Read {pnr} positives and {nnr} negatives'.format(
+                cl=class_name, pnr=positives, nnr=len(y_values_train) - positives))
+
+        return y_values_train, self.train_acs.tolist()
+
+    def write_store_file(self, store_file):
+        with open(store_file, 'wb') as store_out:
+            numpy.savez(store_out, version=numpy.int64(self.STORE_VERSION), lookup_acs=self.lookup_acs,
+                        lookup_locations=self.lookup_locations, sequence_digests=self.sequence_digests,
+                        sequence_lengths=self.sequence_lengths, class_names=self.class_names,
+                        train_acs=self.train_acs, train_labels=self.train_labels,
+                        source_digests=self.source_digests)
+
+        if self.verbose:
+            print('Wrote metadata-store to {fl}'.format(fl=store_file))
+
+    def read_store_file(self, store_file):
+        if not os.path.isfile(store_file):
+            error('Metadata-store {fl} not available - exit!'.format(fl=store_file))
+            exit(404)
+
+        with numpy.load(store_file, allow_pickle=False) as arrays:
+            if int(arrays['version']) != self.STORE_VERSION:
+                error('Metadata-store {fl} was built with another version - '
+                      'please rebuild it with bl/model_builder.py'.format(fl=store_file))
+                exit(731)
+            self.lookup_acs = arrays['lookup_acs']
+            self.lookup_locations = arrays['lookup_locations']
+            self.sequence_digests = arrays['sequence_digests']
+            self.sequence_lengths = arrays['sequence_lengths']
+            self.class_names = arrays['class_names']
+            self.train_acs = arrays['train_acs']
+            self.train_labels = arrays['train_labels']
+            self.source_digests = arrays['source_digests']
+
+        if self.verbose:
+            print('Read metadata of {l} lookup-proteins and {t} training-proteins from {fl}'.format(
+                l=len(self.lookup_acs), t=len(self.train_acs), fl=store_file))
+
+    def read_store_if_current(self, store_file, lookup_fasta, train_fasta):
+        """ Read the store, if it exists and was built from the current content of both fasta-files
+        :return: True if the store was read, False otherwise
+        """
+        if not store_file or not os.path.isfile(store_file):
+            return False
+
+        self.read_store_file(store_file)
+        if not self.is_built_from(lookup_fasta, train_fasta):
+            if self.verbose:
+                print('Metadata-store {fl} is outdated - the fasta-files are parsed instead'.format(fl=store_file))
+            return False
+
+        return True
+
+    def __read_fasta_entries(self, fasta_file):
+        header = None
+        sequence_lines = list()
+        with open(fasta_file, 'r') as fasta_src:
+            for line in fasta_src:
+                if line.startswith('>'):
+                    if header is not None:
+                        yield header, ''.join(sequence_lines)
+                    header = line
+                    sequence_lines = list()
+                elif header is not None:
+                    sequence_lines.append(line)
+        if header is not None:
+            yield header, ''.join(sequence_lines)
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+        self.lookup_acs = None
+        self.lookup_locations = None
+        self.sequence_digests = None
+        self.sequence_lengths = None
+        self.class_names = None
+        self.train_acs = None
+        self.train_labels = None
+        self.source_digests = None
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
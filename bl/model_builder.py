@@ -0,0 +1,212 @@
+# -*- coding: utf8 -*-
+"""
+DESCRIPTION:
+
+One-time build step: convert the training matrices into binary numpy-files, fit the SVMs of all
+classes and store them in a model-bundle, so predictions do not need to refit them on every run.
+For every kernel-parameter combination the training ids and kernel input are reduced to the
+support vectors, so query-kernels only need to be calculated against these.
+The neighborhoods of these support vectors are indexed for the numpy profile-kernel.
+Additionally a k-mer index of the lookup-proteins is built, used to skip BLAST for proteins
+without a plausible homologue, and a metadata-store, holding the ACs, locations and labels of the
+lookup- and training-fasta, so they are not parsed on every run.
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import numpy
+from bl.external_file_manager import ExternalFileManager
+from bl.helper import Helper
+from bl.kmer_index import KmerIndex
+from bl.metadata_store import MetadataStore
+from bl.model_bundle import ModelBundle
+from bl.profile_kernel import ProfileKernel
+from bl.svm_predictor import SVMPredictor
+
+
+class ModelBuilder(object):
+
+    def convert_matrix_files(self):
+        """ Convert the text training matrices of all kernel-parameters of the best-params file into binary
+        numpy-files - the normalized matrix and the diagonal of the un-normalized matrix - which can be
+        memory-mapped instead of parsed.
+        """
+        helper = Helper(self.verbose)
+        all_params = helper.read_param_file(self.fm.best_params)
+        trainer = SVMPredictor(self.verbose, None, self.fm, use_model_bundle=False)
+
+        for max_kmer_length, max_sub_score in sorted(set((params['l'], params['y']) for params in all_params.values())):
+            if self.verbose:
+                print('Converting matrices for l={k} and y={sub}'.format(k=max_kmer_length, sub=max_sub_score))
+            text_matrix = os.path.join(self.fm.matrix_folder, 'l{k}_y{sub}.norm.matrix'.format(k=max_kmer_length,
+                                                                                               sub=max_sub_score))
+            binary_matrix = self.fm.binary_normalized_matrix_file_for_params(max_kmer_length, max_sub_score)
+            self.write_binary_file(binary_matrix, helper.read_matrix_file(text_matrix))
+
+            diagonal_file = self.fm.diagonal_file_for_params(max_kmer_length, max_sub_score)
+            if os.path.isfile(diagonal_file):
+                os.remove(diagonal_file)  # otherwise the old binary diagonal would be read instead of the text matrix
+            diagonal_values = trainer.get_diagonal_values_from_matrix_files(max_kmer_length, max_sub_score)
+            self.write_binary_file(diagonal_file, diagonal_values)
+
+    def write_binary_file(self, binary_file, values):
+        # write to a temporary file first, so concurrent predictions never map a half-written file
+        temp_file = '{fl}.tmp'.format(fl=binary_file)
+        with open(temp_file, 'wb') as binary_out:
+            numpy.save(binary_out, numpy.ascontiguousarray(values, dtype=numpy.float64))
+        os.rename(temp_file, binary_file)
+        if self.verbose:
+            print('Wrote {fl}'.format(fl=binary_file))
+
+    def build_model_bundle(self):
+        helper = Helper(self.verbose)
+        all_params = helper.read_param_file(self.fm.best_params)
+        trainer = SVMPredictor(self.verbose, None, self.fm, use_model_bundle=False,
+                               metadata_store=self.load_current_metadata_store())
+        bundle = ModelBundle(self.verbose)
+
+        for class_name in all_params:
+            class_params = all_params[class_name]
+            if self.verbose:
+                print('Fitting SVM for class {cl}'.format(cl=class_name))
+
+            y_values_train, ac_list_train = trainer.read_train_labels(class_name)
+            train_matrix = self.fm.normalized_matrix_file_for_params(class_params['l'], class_params['y'])
+            gram_train = helper.read_matrix_file(train_matrix)
+            classifier = trainer.train_predictor(gram_train, y_values_train, class_params['C'], class_params['tol'],
+                                                 class_params['cw'] == 'auto')
+
+            bundle.train_size = len(ac_list_train)
+            bundle.add_class_model(class_name, class_params, classifier)
+
+        for max_kmer_length, max_sub_score in bundle.kernel_group_params():
+            support_union = numpy.unique(numpy.concatenate(
+                [bundle.class_support(class_name) for class_name in bundle.class_names
+                 if bundle.kernel_params(class_name) == (max_kmer_length, max_sub_score)]))
+            train_diagonal_values = trainer.get_diagonal_values_from_matrix_files(max_kmer_length, max_sub_score)
+            diagonal_values = [train_diagonal_values[train_index] for train_index in support_union]
+            bundle.add_kernel_group(max_kmer_length, max_sub_score, support_union, diagonal_values)
+            self.write_support_vector_kernel_input(max_kmer_length, max_sub_score, support_union)
+
+        bundle.write_bundle_file(self.fm.model_bundle)
+        return bundle
+
+    def build_neighborhood_indices(self, bundle):
+        """ Index the neighborhoods of the support vectors of every kernel-parameter combination for the numpy
+        profile-kernel (see bl/kernel_backend.py), so they are not enumerated again for every run
+        :param bundle: ModelBundle, written together with the support vector kernel inputs
+        :return: None
+        """
+        profile_kernel = ProfileKernel(self.verbose)
+        for max_kmer_length, max_sub_score in bundle.kernel_group_params():
+            support_kernel_input = self.fm.support_vector_kernel_input_for_params(max_kmer_length, max_sub_score)
+            index = profile_kernel.build_index(support_kernel_input, max_kmer_length, max_sub_score)
+            index_file = self.fm.neighborhood_index_file_for_params(max_kmer_length, max_sub_score)
+            temp_file = '{fl}.tmp'.format(fl=index_file)
+            index.write_index_file(temp_file)
+            os.rename(temp_file, index_file)
+
+    def build_metadata_store(self):
+        helper = Helper(self.verbose)
+        all_params = helper.read_param_file(self.fm.best_params)
+        metadata_store = MetadataStore(self.verbose)
+        metadata_store.build_store(self.fm.lookup_fasta, self.fm.train_fasta_file, list(all_params))
+        temp_file = '{fl}.tmp'.format(fl=self.fm.metadata_store)
+        metadata_store.write_store_file(temp_file)
+        os.rename(temp_file, self.fm.metadata_store)
+        return metadata_store
+
+    def load_current_metadata_store(self):
+        """ :return: MetadataStore if one was built from the current fasta-files, None otherwise """
+        metadata_store = MetadataStore(self.verbose)
+        if metadata_store.read_store_if_current(self.fm.metadata_store, self.fm.lookup_fasta,
+                                                self.fm.train_fasta_file):
+            return metadata_store
+        return None
+
+    def build_kmer_index(self):
+        kmer_index = KmerIndex(self.verbose)
+        kmer_index.build_index(self.fm.lookup_fasta)
+        temp_file = '{fl}.tmp'.format(fl=self.fm.kmer_index)
+        kmer_index.write_index_file(temp_file)
+        os.rename(temp_file, self.fm.kmer_index)
+        return kmer_index
+
+    def write_support_vector_kernel_input(self, max_kmer_length, max_sub_score, support_union):
+        """ Write the training id-list and kernel input reduced to the given support vectors
+        :param max_kmer_length: Parameter l of the kernel
+        :param max_sub_score: Parameter y of the kernel
+        :param support_union: Sorted indices (rows of the training matrix) of the support vectors to keep
+        :return: None
+        """
+        with open(self.fm.train_id_file, 'r') as id_src:
+            train_ids = [line.strip() for line in id_src if line and not line.isspace()]
+        support_ids = [train_ids[train_index] for train_index in support_union]
+
+        kernel_input_blocks = self.read_kernel_input_blocks(self.fm.train_kernel_input)
+
+        support_id_file = self.fm.support_vector_id_file_for_params(max_kmer_length, max_sub_score)
+        with open(support_id_file, 'w') as id_out:
+            for support_id in support_ids:
+                id_out.write('{protein_name}\n'.format(protein_name=support_id))
+
+        support_kernel_input = self.fm.support_vector_kernel_input_for_params(max_kmer_length, max_sub_score)
+        with open(support_kernel_input, 'w') as kernel_out:
+            for support_id in support_ids:
+                if support_id not in kernel_input_blocks:
+                    error('Support vector {ac} is missing in {fl}'.format(ac=support_id, fl=self.fm.train_kernel_input))
+                    exit(404)
+                kernel_out.write(kernel_input_blocks[support_id])
+
+        if self.verbose:
+            print('Reduced training set for l={k} and y={sub} to {nr} of {t} proteins'.format(
+                k=max_kmer_length, sub=max_sub_score, nr=len(support_ids), t=len(train_ids)))
+
+    def read_kernel_input_blocks(self, kernel_input_file):
+        """ Split a kernel input file (cleaned fasta followed by its profile, per protein) into its proteins
+        :param kernel_input_file: File as given to my-string-kernel with -p/-P
+        :return: Dictionary of protein name to the protein's full text-block
+        """
+        blocks = dict()
+        protein_name = None
+        with open(kernel_input_file, 'r') as kernel_src:
+            for line in kernel_src:
+                if line.startswith('>'):
+                    protein_name = line[1:].strip()
+                    blocks[protein_name] = list()
+                if protein_name is not None:
+                    blocks[protein_name].append(line)
+
+        return dict((name, ''.join(lines)) for name, lines in blocks.items())
+
+    def __init__(self, is_verbose, file_manager):
+        self.verbose = is_verbose
+        self.fm = file_manager
+
+
+def main():
+    usage_string = 'python -m bl.model_builder [-t]'
+
+    parser = argparse.ArgumentParser(description=__doc__, usage=usage_string)
+    parser.add_argument('-t', '--traveller', help='Build the traveller model instead of the sub-nuclear models',
+                        action='store_true')
+    parser.add_argument('-v', '--verbose', help='Toggles verbose mode on', action='store_true')
+    args = parser.parse_args()
+
+    file_manager = ExternalFileManager(args.verbose)
+    file_manager.is_predictor_setup_sane(args.traveller)
+    builder = ModelBuilder(args.verbose, file_manager)
+    builder.convert_matrix_files()
+    builder.build_metadata_store()
+    bundle = builder.build_model_bundle()
+    builder.build_neighborhood_indices(bundle)
+    builder.build_kmer_index()
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
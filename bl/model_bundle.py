@@ -0,0 +1,285 @@
+# -*- coding: utf8 -*-
+""" Pre-trained per-class SVM models, stored in a versioned numpy-archive
+
+The bundle holds everything needed to predict with a fitted svm.SVC(kernel='precomputed', probability=True)
+without refitting it: dual coefficients, support-vector indices (rows of the training gram-matrix), intercept and
+the Platt-scaling parameters A and B.
+Classes sharing the kernel-parameters (l, y) form a kernel-group. Per group the bundle stores the union of their
+support vectors and the un-normalized diagonal values of these, so query-kernels only need to be calculated against
+the support vectors. The dual coefficients of a group's classes are stacked into one matrix, so all classes of a
+group are predicted with one matrix multiplication.
+"""
+from __future__ import print_function
+import os
+import sys
+import numpy
+
+
+class ModelBundle(object):
+
+    BUNDLE_VERSION = 2
+    MIN_PROBABILITY = 1e-7  # libsvm clips pairwise probabilities to [min_prob, 1 - min_prob]
+    MAX_PROBABILITY_ITERATIONS = 100  # libsvm: max(100, nr_class)
+
+    @property
+    def class_names(self):
+        return list(self._class_names)
+
+    def add_class_model(self, class_name, class_params, classifier):
+        """ Store the parameters of a fitted binary svm.SVC.
+        :param class_name: Name of the class as given in the best-params file
+        :param class_params: Parameters of the class as read by Helper.read_param_file
+        :param classifier: svm.SVC fitted with kernel='precomputed' and probability=True
+        :return: None
+        """
+        model = dict()
+        model['dual_coef'] = numpy.asarray(classifier.dual_coef_[0], dtype=numpy.float64)
+        model['support'] = numpy.asarray(classifier.support_, dtype=numpy.int64)
+        model['intercept'] = numpy.float64(classifier.intercept_[0])
+        model['prob_a'] = numpy.float64(classifier.probA_[0])
+        model['prob_b'] = numpy.float64(classifier.probB_[0])
+        model['l'] = int(class_params['l'])
+        model['y'] = int(class_params['y'])
+
+        if class_name not in self._models:
+            self._class_names.append(class_name)
+        self._models[class_name] = model
+
+    def add_kernel_group(self, max_kmer_length, max_sub_score, support_union, diagonal_values):
+        """ Register the support vectors of all classes using the given kernel-parameters.
+        :param max_kmer_length: Parameter l of the kernel
+        :param max_sub_score: Parameter y of the kernel
+        :param support_union: Sorted indices of all training proteins that are support vectors of any class
+                of the group
+        :param diagonal_values: Un-normalized kernel self-hits of the proteins in support_union (same order)
+        :return: None
+        """
+        group = dict()
+        group['support'] = numpy.asarray(support_union, dtype=numpy.int64)
+        group['diagonal'] = numpy.asarray(diagonal_values, dtype=numpy.float64)
+        self._kernel_groups[(int(max_kmer_length), int(max_sub_score))] = group
+
+        for class_name in self._class_names:
+            model = self._models[class_name]
+            if (model['l'], model['y']) == (int(max_kmer_length), int(max_sub_score)):
+                # position of each of the class' support vectors in the reduced query-matrix of the group
+                model['group_support'] = numpy.searchsorted(group['support'], model['support'])
+        self.__stack_kernel_group(int(max_kmer_length), int(max_sub_score))
+
+    def kernel_group_params(self):
+        """ :return: Sorted list of all (l, y) combinations used by the classes of this bundle """
+        return sorted(set(self.kernel_params(class_name) for class_name in self._class_names))
+
+    def kernel_group_support(self, max_kmer_length, max_sub_score):
+        return self._kernel_groups[(int(max_kmer_length), int(max_sub_score))]['support']
+
+    def kernel_group_diagonal(self, max_kmer_length, max_sub_score):
+        return self._kernel_groups[(int(max_kmer_length), int(max_sub_score))]['diagonal']
+
+    def has_class(self, class_name):
+        return class_name in self._models
+
+    def kernel_params(self, class_name):
+        model = self._models[class_name]
+        return model['l'], model['y']
+
+    def class_support(self, class_name):
+        return self._models[class_name]['support']
+
+    def write_bundle_file(self, bundle_file):
+        arrays = dict()
+        arrays['version'] = numpy.int64(self.BUNDLE_VERSION)
+        arrays['train_size'] = numpy.int64(self.train_size)
+        arrays['class_names'] = numpy.asarray(self._class_names)
+        for class_name in self._class_names:
+            for key, value in self._models[class_name].items():
+                arrays['{cl}__{key}'.format(cl=class_name, key=key)] = numpy.asarray(value)
+        for max_kmer_length, max_sub_score in self.kernel_group_params():
+            group_name = self.__kernel_group_name(max_kmer_length, max_sub_score)
+            for key, value in self._kernel_groups[(max_kmer_length, max_sub_score)].items():
+                arrays['{gr}__{key}'.format(gr=group_name, key=key)] = value
+
+        with open(bundle_file, 'wb') as bundle_out:
+            numpy.savez(bundle_out, **arrays)
+
+        if self.verbose:
+            print('Wrote model-bundle with {nr} classes to {fl}'.format(nr=len(self._class_names), fl=bundle_file))
+
+    def read_bundle_file(self, bundle_file):
+        if not os.path.isfile(bundle_file):
+            error('Model-bundle {fl} not available - exit!'.format(fl=bundle_file))
+            exit(404)
+
+        with numpy.load(bundle_file, allow_pickle=False) as arrays:
+            version = int(arrays['version'])
+            if version != self.BUNDLE_VERSION:
+                error('Model-bundle {fl} has version {v}, expected version {ev} - '
+                      'please rebuild it with bl/model_builder.py'.format(fl=bundle_file, v=version,
+                                                                          ev=self.BUNDLE_VERSION))
+                exit(720)
+
+            self.train_size = int(arrays['train_size'])
+            self._class_names = [str(class_name) for class_name in arrays['class_names']]
+            self._models = dict()
+            for class_name in self._class_names:
+                model = dict()
+                model['dual_coef'] = arrays['{cl}__dual_coef'.format(cl=class_name)]
+                model['support'] = arrays['{cl}__support'.format(cl=class_name)]
+                model['intercept'] = float(arrays['{cl}__intercept'.format(cl=class_name)])
+                model['prob_a'] = float(arrays['{cl}__prob_a'.format(cl=class_name)])
+                model['prob_b'] = float(arrays['{cl}__prob_b'.format(cl=class_name)])
+                model['l'] = int(arrays['{cl}__l'.format(cl=class_name)])
+                model['y'] = int(arrays['{cl}__y'.format(cl=class_name)])
+                model['group_support'] = arrays['{cl}__group_support'.format(cl=class_name)]
+                self._models[class_name] = model
+
+            self._kernel_groups = dict()
+            self._stacked_groups = dict()
+            for max_kmer_length, max_sub_score in self.kernel_group_params():
+                group_name = self.__kernel_group_name(max_kmer_length, max_sub_score)
+                group = dict()
+                group['support'] = arrays['{gr}__support'.format(gr=group_name)]
+                group['diagonal'] = arrays['{gr}__diagonal'.format(gr=group_name)]
+                self._kernel_groups[(max_kmer_length, max_sub_score)] = group
+                self.__stack_kernel_group(max_kmer_length, max_sub_score)
+
+        if self.verbose:
+            print('Read model-bundle with {nr} classes from {fl}'.format(nr=len(self._class_names), fl=bundle_file))
+
+    def group_class_names(self, max_kmer_length, max_sub_score):
+        """ :return: Names of the classes of a kernel-group, in the column order of group_decision_values() """
+        return list(self._stacked_groups[(int(max_kmer_length), int(max_sub_score))]['class_names'])
+
+    def group_decision_values(self, max_kmer_length, max_sub_score, gram_query):
+        """ Decision values of all classes of a kernel-group at once
+        :param max_kmer_length: Parameter l of the kernel
+        :param max_sub_score: Parameter y of the kernel
+        :param gram_query: Normalized kernel values, one row per query and one column per protein of
+                kernel_group_support()
+        :return: Matrix with one row per query and one column per class of group_class_names()
+        """
+        stacked_group = self._stacked_groups[(int(max_kmer_length), int(max_sub_score))]
+        gram_query = self.__checked_query_matrix(max_kmer_length, max_sub_score, gram_query)
+
+        return gram_query.dot(stacked_group['dual_coef']) + stacked_group['intercept']
+
+    def group_positive_probabilities(self, max_kmer_length, max_sub_score, decision_values):
+        """ Same as positive_probabilities() for all classes of a kernel-group
+        :param decision_values: Decision values as returned by group_decision_values()
+        :return: Matrix of the probabilities of the positive classes, in the shape of decision_values
+        """
+        stacked_group = self._stacked_groups[(int(max_kmer_length), int(max_sub_score))]
+        return self.__platt_probabilities(decision_values, stacked_group['prob_a'], stacked_group['prob_b'])
+
+    def decision_values(self, class_name, gram_query):
+        """ Equivalent of svm.SVC.decision_function for a query-matrix against the support vectors of the class' group
+        :param class_name: Class to predict
+        :param gram_query: Normalized kernel values, one row per query and one column per protein of
+                kernel_group_support() for the kernel-parameters of the class
+        :return: Array with one decision value per query
+        """
+        model = self._models[class_name]
+        gram_query = self.__checked_query_matrix(model['l'], model['y'], gram_query)
+
+        return gram_query[:, model['group_support']].dot(model['dual_coef']) + model['intercept']
+
+    def positive_probabilities(self, class_name, decision_values):
+        """ Equivalent of svm.SVC.predict_proba(...)[:, 1], i.e. libsvm's Platt-scaling followed by its
+        pairwise coupling for two classes.
+        :param class_name: Class to predict
+        :param decision_values: Decision values as returned by decision_values()
+        :return: Array with the probability of the positive class per query
+        """
+        model = self._models[class_name]
+        return self.__platt_probabilities(decision_values, model['prob_a'], model['prob_b'])
+
+    def __platt_probabilities(self, decision_values, prob_a, prob_b):
+        decision_values = numpy.asarray(decision_values, dtype=numpy.float64)
+
+        # libsvm works on the un-flipped decision value of the first (negative) class
+        f_apb = -decision_values * prob_a + prob_b
+        r_01 = numpy.empty_like(f_apb)
+        positive = f_apb >= 0
+        r_01[positive] = numpy.exp(-f_apb[positive]) / (1.0 + numpy.exp(-f_apb[positive]))
+        r_01[~positive] = 1.0 / (1.0 + numpy.exp(f_apb[~positive]))
+        r_01 = numpy.minimum(numpy.maximum(r_01, self.MIN_PROBABILITY), 1 - self.MIN_PROBABILITY)
+        r_10 = 1 - r_01
+
+        return self.__couple_two_class_probabilities(r_01, r_10)
+
+    def __checked_query_matrix(self, max_kmer_length, max_sub_score, gram_query):
+        group_size = len(self.kernel_group_support(max_kmer_length, max_sub_score))
+        gram_query = numpy.asarray(gram_query, dtype=numpy.float64)
+        if gram_query.shape[1] != group_size:
+            error('Query-matrix has {nr} columns, but the model-bundle has {s} support vectors for '
+                  'l={l} and y={y}'.format(nr=gram_query.shape[1], s=group_size, l=max_kmer_length, y=max_sub_score))
+            exit(721)
+
+        return gram_query
+
+    def __stack_kernel_group(self, max_kmer_length, max_sub_score):
+        """ Stack the models of all classes of a kernel-group: their dual coefficients become the columns of one
+        matrix over the group's support vectors (zero where a protein is no support vector of the class) """
+        class_names = [class_name for class_name in self._class_names
+                       if self.kernel_params(class_name) == (max_kmer_length, max_sub_score)]
+        group_size = len(self.kernel_group_support(max_kmer_length, max_sub_score))
+
+        stacked_group = dict()
+        stacked_group['class_names'] = class_names
+        stacked_group['dual_coef'] = numpy.zeros((group_size, len(class_names)), dtype=numpy.float64)
+        for class_index, class_name in enumerate(class_names):
+            model = self._models[class_name]
+            stacked_group['dual_coef'][model['group_support'], class_index] = model['dual_coef']
+        for key in ('intercept', 'prob_a', 'prob_b'):
+            stacked_group[key] = numpy.asarray([self._models[class_name][key] for class_name in class_names],
+                                               dtype=numpy.float64)
+        self._stacked_groups[(max_kmer_length, max_sub_score)] = stacked_group
+
+    def __couple_two_class_probabilities(self, r_01, r_10):
+        # same fixed-point iteration as multiclass_probability() in libsvm's svm.cpp, for k == 2
+        q_00 = r_10 * r_10
+        q_11 = r_01 * r_01
+        q_01 = -r_10 * r_01
+        p_0 = numpy.full_like(r_01, 0.5)
+        p_1 = numpy.full_like(r_01, 0.5)
+        eps = 0.005 / 2
+        active = numpy.ones(r_01.shape, dtype=bool)
+
+        for _ in range(self.MAX_PROBABILITY_ITERATIONS):
+            qp_0 = q_00 * p_0 + q_01 * p_1
+            qp_1 = q_01 * p_0 + q_11 * p_1
+            pqp = p_0 * qp_0 + p_1 * qp_1
+            max_error = numpy.maximum(numpy.abs(qp_0 - pqp), numpy.abs(qp_1 - pqp))
+            active &= max_error >= eps
+            if not active.any():
+                break
+
+            diff = numpy.where(active, (-qp_0 + pqp) / q_00, 0.0)
+            p_0 = p_0 + diff
+            pqp = (pqp + diff * (diff * q_00 + 2 * qp_0)) / (1 + diff) / (1 + diff)
+            qp_0 = (qp_0 + diff * q_00) / (1 + diff)
+            qp_1 = (qp_1 + diff * q_01) / (1 + diff)
+            p_0 = p_0 / (1 + diff)
+            p_1 = p_1 / (1 + diff)
+
+            diff = numpy.where(active, (-qp_1 + pqp) / q_11, 0.0)
+            p_1 = p_1 + diff
+            p_0 = p_0 / (1 + diff)
+            p_1 = p_1 / (1 + diff)
+
+        return p_1
+
+    def __kernel_group_name(self, max_kmer_length, max_sub_score):
+        return 'l{k}_y{sub}'.format(k=max_kmer_length, sub=max_sub_score)
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+        self.train_size = 0
+        self._class_names = list()
+        self._models = dict()
+        self._kernel_groups = dict()
+        self._stacked_groups = dict()  # (l, y) -> models of the group's classes stacked into arrays, not stored
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -0,0 +1,36 @@
+# -*- coding: utf8 -*-
+""" Structured prediction of one query protein, as returned by the in-memory prediction API
+"""
+from __future__ import print_function
+import sys
+
+
+class PredictionRecord(object):
+
+    """ Prediction of one query protein: predicted classes, their reliability indices and the source
+    ('b' == blast, 's' == svm, None if nothing was predicted) """
+
+    @property
+    def has_prediction(self):
+        return self.source is not None
+
+    def to_dict(self):
+        """ :return: Dictionary of the record, e.g. to be serialized as JSON """
+        return {'id': self.protein_id, 'classes': list(self.classes), 'reliabilities': list(self.reliabilities),
+                'source': self.source, 'localization': self.localization, 'reliability': self.reliability}
+
+    def __repr__(self):
+        return 'PredictionRecord({ac!r}, {cl!r}, {ri!r}, {src!r})'.format(ac=self.protein_id, cl=self.classes,
+                                                                         ri=self.reliabilities, src=self.source)
+
+    def __init__(self, protein_id, classes, reliabilities, source, localization, reliability):
+        self.protein_id = protein_id
+        self.classes = classes  # list of predicted localization classes
+        self.reliabilities = reliabilities  # reliability index (0 - 100) per class, same order as classes
+        self.source = source
+        self.localization = localization  # columns as written to the result-file
+        self.reliability = reliability
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -0,0 +1,287 @@
+# -*- coding: utf8 -*-
+"""
+DESCRIPTION:
+
+Long-running LocNuclei prediction server. Loads the sub-nuclear and the traveller models once and answers
+prediction requests over a local HTTP-port or a Unix-socket. Requests arriving together are predicted as one
+batch, i.e. with shared BLAST- and kernel-calls.
+
+POST /predict with a JSON-body
+    {"mode": "sn" or "tr", "proteins": [{"id": "P40218", "sequence": "MSE...", "profile": "<PSI-BLAST profile>"}]}
+returns
+    {"predictions": [{"id": "P40218", "classes": [...], "reliabilities": [...], "source": "b",
+                      "localization": "...", "reliability": "..."}]}
+GET /health returns {"status": "ok"}
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from bl.kernel_backend import DEFAULT_KERNEL_BACKEND, KERNEL_BACKENDS
+from bl.locnuclei_predictor import LocNucleiPredictor
+from bl.worker_pool import WorkerPool
+
+
+class PredictionJob(object):
+
+    """ Proteins of one request, waiting to be predicted in the next batch """
+
+    def __init__(self, proteins):
+        self.proteins = proteins  # list of dictionaries with id, sequence and profile
+        self.predictions = None
+        self.error_message = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+
+    """ Collects the jobs of one prediction mode and predicts all jobs arriving within the batch-window together """
+
+    def submit(self, proteins):
+        """ Queue the proteins of a request and wait for their predictions
+        :param proteins: List of dictionaries with id, sequence and profile
+        :return: The finished PredictionJob
+        """
+        job = PredictionJob(proteins)
+        self.jobs.put(job)
+        job.done.wait()
+        return job
+
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def run(self):
+        stop = False
+        while not stop:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            batch = [job]
+            protein_count = len(job.proteins)
+            deadline = time.time() + self.batch_window
+            while protein_count < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self.jobs.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+                protein_count += len(job.proteins)
+
+            self.predict_jobs(batch)
+
+    def predict_jobs(self, batch):
+        if self.verbose:
+            print('Predicting batch of {nr} requests for mode {m}'.format(nr=len(batch), m=self.mode))
+        try:
+            query_proteins = [(protein['id'], protein['sequence'], protein['profile'])
+                              for job in batch for protein in job.proteins]
+            records = self.loc_nuclei.predict_sequences(query_proteins, batch_size=len(query_proteins))
+
+            record_start = 0
+            for job in batch:
+                record_end = record_start + len(job.proteins)
+                job.predictions = [record.to_dict() for record in records[record_start:record_end]]
+                record_start = record_end
+        except (Exception, SystemExit) as prediction_error:  # most errors in LocNuclei end with exit()
+            error('Prediction of batch failed: {e}'.format(e=repr(prediction_error)))
+            for job in batch:
+                job.error_message = 'Prediction failed, see server log'
+        finally:
+            for job in batch:
+                job.done.set()
+
+    def __init__(self, is_verbose, mode, loc_nuclei, batch_window, max_batch_size):
+        self.verbose = is_verbose
+        self.mode = mode
+        self.loc_nuclei = loc_nuclei
+        self.batch_window = batch_window  # seconds to wait for further requests after the first one
+        self.max_batch_size = max_batch_size  # proteins
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'modes': sorted(self.server.batchers)})
+        else:
+            self.send_json(404, {'error': 'Unknown path {p}'.format(p=self.path)})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': 'Unknown path {p}'.format(p=self.path)})
+            return
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(content_length).decode('utf8'))
+            mode = request.get('mode', 'sn')
+            proteins = request['proteins']
+            for protein in proteins:
+                if not protein.get('id') or not protein.get('sequence') or not protein.get('profile'):
+                    raise ValueError('Every protein needs an id, a sequence and a profile')
+        except (ValueError, KeyError, TypeError, AttributeError) as request_error:
+            self.send_json(400, {'error': 'Invalid request: {e}'.format(e=request_error)})
+            return
+        if mode not in self.server.batchers:
+            self.send_json(400, {'error': 'Unknown mode {m}'.format(m=mode)})
+            return
+
+        job = self.server.batchers[mode].submit(proteins)
+        if job.error_message:
+            self.send_json(500, {'error': job.error_message})
+        else:
+            self.send_json(200, {'predictions': job.predictions})
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix-socket'  # clients of a Unix-socket have no address
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingPredictionHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingPredictionUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    usage_string = 'python -m bl.prediction_server --port 8080'
+
+    parser = argparse.ArgumentParser(description=__doc__, usage=usage_string,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', help='Host to listen on (default: 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on (default: 8080)', type=int, default=8080)
+    parser.add_argument('--socket', help='Listen on this Unix-socket instead of a port')
+    parser.add_argument('--temp_folder', help='Folder to work in. If not given, a temporary directory will be created.')
+    parser.add_argument('--batch_window', help='Seconds to wait for further requests to predict together '
+                                               '(default: 0.5)', type=float, default=0.5)
+    parser.add_argument('--max_batch_size', help='Maximum number of proteins per batch (default: 500)', type=int,
+                        default=500)
+    parser.add_argument('-j', '--jobs', help='Number of processes to run in parallel, shared by both modes '
+                                             '(default: 1)', type=int, default=1)
+    parser.add_argument('--blast_threads', help='Number of threads per BLAST-call (default: 1)', type=int,
+                        default=1)
+    parser.add_argument('--cache_file', help='SQLite-file to cache results in, shared by both modes')
+    parser.add_argument('--cache_max_mb', help='Maximum size of the result-cache in MB (default: 1024)', type=float,
+                        default=1024)
+    parser.add_argument('--kernel_backend', help='How the string-kernel of the query proteins is calculated: '
+                                                 '"binary" or "numpy" (default: binary)',
+                        choices=KERNEL_BACKENDS, default=DEFAULT_KERNEL_BACKEND)
+    parser.add_argument('-d', '--debug',
+                        help='Toggles clean up of temporary files off, '
+                             'i.e. no files will be deleted, that were created during prediction',
+                        action='store_true')
+    parser.add_argument('-v', '--verbose', help='Toggles verbose mode on', action='store_true')
+    args = parser.parse_args()
+
+    if args.socket:
+        remove_stale_socket(args.socket)
+
+    worker_pool = WorkerPool(args.verbose, args.jobs)  # runs the BLAST- and kernel-calls of both modes
+    try:
+        serve(args, worker_pool)
+    finally:
+        worker_pool.close()
+
+
+def serve(args, worker_pool):
+    with LocNucleiPredictor(args.verbose, args.debug, False, args.jobs, args.blast_threads, args.cache_file,
+                            args.cache_max_mb, kernel_backend=args.kernel_backend,
+                            worker_pool=worker_pool) as sn_loc_nuclei:
+        with LocNucleiPredictor(args.verbose, args.debug, True, args.jobs, args.blast_threads, args.cache_file,
+                                args.cache_max_mb, kernel_backend=args.kernel_backend,
+                                worker_pool=worker_pool) as tr_loc_nuclei:
+            batchers = dict()
+            for mode, loc_nuclei in (('sn', sn_loc_nuclei), ('tr', tr_loc_nuclei)):
+                loc_nuclei.prepare_temporary_directory(args.temp_folder)
+                loc_nuclei.load_predictors()  # load lookup-data and models before the first request
+                batchers[mode] = MicroBatcher(args.verbose, mode, loc_nuclei, args.batch_window,
+                                              args.max_batch_size)
+
+            if args.socket:
+                server = ThreadingPredictionUnixServer(args.socket, PredictionRequestHandler)
+                address = args.socket
+            else:
+                server = ThreadingPredictionHTTPServer((args.host, args.port), PredictionRequestHandler)
+                address = 'http://{h}:{p}'.format(h=args.host, p=args.port)
+            server.batchers = batchers
+            server.verbose = args.verbose
+
+            print('LocNuclei prediction server listening on {a}'.format(a=address))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                for batcher in batchers.values():
+                    batcher.stop()
+                if args.socket:
+                    os.remove(args.socket)
+
+
+def remove_stale_socket(socket_file):
+    """ Remove a Unix-socket left behind by a crashed server - exits if a server still listens on it or if it is
+    another kind of file
+    """
+    if not os.path.exists(socket_file):
+        return
+
+    if stat.S_ISSOCK(os.stat(socket_file).st_mode):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_file)
+        except ConnectionRefusedError:
+            os.remove(socket_file)
+            print('Removed stale socket {fl}'.format(fl=socket_file))
+            return
+        finally:
+            probe.close()
+        error('Another server listens on {fl} - exit!'.format(fl=socket_file))
+        exit(500)
+
+    error('File {fl} exists already - exit!'.format(fl=socket_file))
+    exit(500)
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
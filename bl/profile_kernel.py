@@ -0,0 +1,290 @@
+# -*- coding: utf8 -*-
+""" Profile (mismatch) kernel of my-string-kernel, calculated with numpy
+
+Every window of l consecutive profile-positions of a protein is mapped to its neighborhood: all k-mers of length l
+whose substitution score - the summed costs of their letters at the window positions - is lower than y. The
+feature of a protein for a k-mer is the number of windows whose neighborhood contains it, the kernel of two proteins
+is the dot-product of their features. The costs are the negative logarithms of the profile's observed percentages,
+mixed with background frequencies, exactly as my-string-kernel calculates them (same constants and order of
+floating point operations), so the kernel values are identical to the ones of the binary.
+"""
+from __future__ import print_function
+import math
+import os
+import sys
+import numpy
+from bl.helper import Helper
+
+
+class NeighborhoodIndex(object):
+
+    """ Features of the training proteins for one kernel-parameter combination, as k-mer -> training protein
+    posting lists: the postings of the k-mer codes[i] are sources[offsets[i]:offsets[i + 1]] with the feature values
+    counts[offsets[i]:offsets[i + 1]]. Built by ProfileKernel.build_index, stored by bl/model_builder.py.
+    """
+
+    INDEX_VERSION = 1
+
+    def is_built_from(self, max_kmer_length, max_sub_score, train_kernel_input):
+        """ :return: True if the index holds the given kernel-parameters and current content of the kernel input """
+        helper = Helper(self.verbose)
+        return self.max_kmer_length == max_kmer_length and self.max_sub_score == max_sub_score and \
+            self.source_digest == helper.file_digest(train_kernel_input)
+
+    def write_index_file(self, index_file):
+        # smallest sufficient integer types - the postings of large neighborhoods take most of the space
+        with open(index_file, 'wb') as index_out:
+            numpy.savez(index_out, version=numpy.int64(self.INDEX_VERSION),
+                        max_kmer_length=numpy.int64(self.max_kmer_length),
+                        max_sub_score=numpy.float64(self.max_sub_score),
+                        source_digest=numpy.str_(self.source_digest),
+                        train_names=numpy.array(self.train_names, dtype=numpy.str_),
+                        codes=self.codes.astype(numpy.min_scalar_type(max(int(self.codes.max(initial=0)), 1))),
+                        offsets=self.offsets.astype(numpy.int64),
+                        sources=self.sources.astype(numpy.min_scalar_type(max(len(self.train_names) - 1, 1))),
+                        counts=self.counts.astype(numpy.min_scalar_type(max(int(self.counts.max(initial=0)), 1))),
+                        self_hits=self.self_hits.astype(numpy.int64))
+
+        if self.verbose:
+            print('Wrote neighborhood-index to {fl}'.format(fl=index_file))
+
+    def read_index_file(self, index_file):
+        if not os.path.isfile(index_file):
+            error('Neighborhood-index {fl} not available - exit!'.format(fl=index_file))
+            exit(404)
+
+        with numpy.load(index_file, allow_pickle=False) as arrays:
+            if int(arrays['version']) != self.INDEX_VERSION:
+                error('Neighborhood-index {fl} was built with another version - '
+                      'please rebuild it with bl/model_builder.py'.format(fl=index_file))
+                exit(743)
+            self.max_kmer_length = int(arrays['max_kmer_length'])
+            self.max_sub_score = float(arrays['max_sub_score'])
+            self.source_digest = str(arrays['source_digest'])
+            self.train_names = arrays['train_names'].tolist()
+            self.codes = arrays['codes'].astype(numpy.int64)
+            self.offsets = arrays['offsets']
+            self.sources = arrays['sources']
+            self.counts = arrays['counts']
+            self.self_hits = arrays['self_hits']
+
+        if self.verbose:
+            print('Read neighborhood-index of {nr} training-proteins from {fl}'.format(nr=len(self.train_names),
+                                                                                     fl=index_file))
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+        self.max_kmer_length = None
+        self.max_sub_score = None
+        self.source_digest = None  # SHA-1 of the training kernel input the index was built from
+        self.train_names = list()
+        self.codes = None
+        self.offsets = None
+        self.sources = None
+        self.counts = None
+        self.self_hits = None  # un-normalized kernel of every training protein with itself
+
+
+class ProfileKernel(object):
+
+    ALPHABET = 'ACDEFGHIKLMNPQRSTVWY'  # letters of the k-mers, i.e. columns of the cost-rows
+    PROFILE_ORDER = 'ARNDCQEGHILKMFPSTWYV'  # order of the observed percentages in a blast-profile
+    # background frequency per letter in PROFILE_ORDER, as compiled into my-string-kernel
+    BACKGROUND_FREQUENCIES = (0.0799912015849807, 0.0484482507611578, 0.044293531582512, 0.0578891399707563,
+                              0.0171846021407367, 0.0380578923048682, 0.0638169929675978, 0.0760659374742852,
+                              0.0223465499452473, 0.0550905793661343, 0.0866897071203864, 0.060458245507428,
+                              0.0215379186368154, 0.0396348024787477, 0.0465746314476874, 0.0630028230885602,
+                              0.0580394726014824, 0.0144991866213453, 0.03635438623143, 0.0700241481678408)
+    OBSERVED_WEIGHT = 0.8
+    BACKGROUND_WEIGHT = 0.19999999999999996  # 1 - 0.8 in double precision, as used by my-string-kernel
+    MIN_PROFILE_LINE_LENGTH = 61  # shorter lines (including the line-break) end the positions of a profile
+    PROFILE_HEADER_LINES = 4  # lines after the fasta-header: sequence, empty line, title and column names
+    PROFILE_TRAILER_LINES = 5  # lines after the first short line: the K/Lambda-statistics
+    MAX_WINDOW_BLOCK_SIZE = 4096  # windows whose neighborhoods are enumerated together, limits memory use
+
+    def read_kernel_input(self, kernel_input):
+        """ Read a kernel input file (cleaned fasta followed by its blast-profile, per protein) line by line as
+        my-string-kernel does
+        :param kernel_input: File as given to my-string-kernel with -p/-P
+        :return: List of tupel(protein name, cost-rows as 2-D array with one row per profile-position)
+        """
+        proteins = list()
+        residues = None
+        percentages = None
+        with open(kernel_input, 'r') as kernel_src:
+            lines = iter(kernel_src)
+            for line in lines:
+                if line.startswith('>'):
+                    if residues is not None:
+                        proteins.append((protein_name, self.cost_rows(residues, percentages)))
+                    protein_name = line[1:].split()[0] if line[1:].split() else ''
+                    residues = list()
+                    percentages = list()
+                    for skipped in range(self.PROFILE_HEADER_LINES):
+                        next(lines, '')
+                elif len(line) >= self.MIN_PROFILE_LINE_LENGTH:
+                    if residues is None:
+                        error('Profile-position before the first protein in kernel input {fl}'.format(fl=kernel_input))
+                        exit(740)
+                    values = line.split()
+                    residues.append(values[1])
+                    percentages.append(values[22:42])
+                else:
+                    for skipped in range(self.PROFILE_TRAILER_LINES):
+                        next(lines, '')
+        if residues is not None:
+            proteins.append((protein_name, self.cost_rows(residues, percentages)))
+
+        return proteins
+
+    def cost_rows(self, residues, percentages):
+        """ Cost of every letter at every profile-position: -log(0.8 * observed percentage + 0.2 * background).
+        Positions without any observed percentage get the observed residue only.
+        :param residues: Residue per profile-position
+        :param percentages: Observed percentages per profile-position, in PROFILE_ORDER
+        :return: 2-D array, one row per position and one column per letter of ALPHABET
+        """
+        if not residues:
+            return numpy.zeros((0, len(self.ALPHABET)), dtype=numpy.float64)
+
+        observed = numpy.asarray(percentages, dtype=numpy.float64)
+        mixed = observed / 100.0 * self.OBSERVED_WEIGHT + \
+            self.BACKGROUND_WEIGHT * numpy.asarray(self.BACKGROUND_FREQUENCIES, dtype=numpy.float64)
+        unobserved_rows = numpy.flatnonzero(~(observed > 0.0).any(axis=1))
+        for row in unobserved_rows:
+            residue = residues[row]
+            if residue in self.ALPHABET:
+                mixed[row, self.PROFILE_ORDER.index(residue)] = \
+                    self.BACKGROUND_FREQUENCIES[self.PROFILE_ORDER.index(residue)] * self.BACKGROUND_WEIGHT + \
+                    self.OBSERVED_WEIGHT
+
+        # there are only few distinct values - the logarithm of the C-library, as used by the binary, is applied to
+        # each of them once
+        distinct_values, value_indices = numpy.unique(mixed, return_inverse=True)
+        distinct_costs = numpy.asarray([-math.log(value) for value in distinct_values], dtype=numpy.float64)
+        costs = distinct_costs[value_indices].reshape(mixed.shape)
+
+        return costs[:, [self.PROFILE_ORDER.index(letter) for letter in self.ALPHABET]]
+
+    def neighborhood_features(self, cost_rows, max_kmer_length, max_sub_score):
+        """ Features of a protein: number of windows whose neighborhood contains a k-mer, for all k-mers
+        :param cost_rows: Cost-rows of the protein as returned by cost_rows
+        :param max_kmer_length: Parameter l of the kernel, length of the k-mers
+        :param max_sub_score: Parameter y of the kernel, k-mers need a substitution score below it
+        :return: tupel(sorted k-mer codes, feature value per code)
+        """
+        letter_count = len(self.ALPHABET)
+        window_count = len(cost_rows) - max_kmer_length + 1
+        min_costs = cost_rows.min(axis=1) if len(cost_rows) else numpy.zeros(0, dtype=numpy.float64)
+        all_codes = list()
+        for block_start in range(0, max(window_count, 0), self.MAX_WINDOW_BLOCK_SIZE):
+            windows = numpy.arange(block_start, min(block_start + self.MAX_WINDOW_BLOCK_SIZE, window_count))
+            codes = numpy.zeros(len(windows), dtype=numpy.int64)
+            scores = numpy.zeros(len(windows), dtype=numpy.float64)
+            for depth in range(max_kmer_length):
+                # extend every k-mer prefix by every letter, in the same order of additions as my-string-kernel
+                extended_scores = scores[:, numpy.newaxis] + cost_rows[windows + depth]
+                prefix_indices, letters = numpy.nonzero(max_sub_score > extended_scores)
+                scores = extended_scores[prefix_indices, letters]
+                codes = codes[prefix_indices] * letter_count + letters
+                windows = windows[prefix_indices]
+
+                # drop prefixes that can't be completed even with the cheapest letters - costs are positive and
+                # rounding is monotonic, so this lower bound never drops a k-mer the binary would keep
+                lower_bounds = scores
+                for remaining_depth in range(depth + 1, max_kmer_length):
+                    lower_bounds = lower_bounds + min_costs[windows + remaining_depth]
+                if depth + 1 < max_kmer_length:
+                    is_completable = max_sub_score > lower_bounds
+                    scores = scores[is_completable]
+                    codes = codes[is_completable]
+                    windows = windows[is_completable]
+            all_codes.append(codes)
+
+        if not all_codes:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+        return numpy.unique(numpy.concatenate(all_codes), return_counts=True)
+
+    def build_index(self, train_kernel_input, max_kmer_length, max_sub_score):
+        """ Index the features of all training proteins
+        :param train_kernel_input: Kernel input of the training proteins
+        :param max_kmer_length: Parameter l of the kernel
+        :param max_sub_score: Parameter y of the kernel
+        :return: NeighborhoodIndex
+        """
+        train_names = list()
+        all_codes = list()
+        all_sources = list()
+        all_counts = list()
+        self_hits = list()
+        for source, (protein_name, cost_rows) in enumerate(self.read_kernel_input(train_kernel_input)):
+            codes, counts = self.neighborhood_features(cost_rows, max_kmer_length, max_sub_score)
+            train_names.append(protein_name)
+            all_codes.append(codes)
+            all_sources.append(numpy.full(len(codes), source, dtype=numpy.int32))
+            all_counts.append(counts)
+            self_hits.append(int(numpy.dot(counts, counts)))
+
+        all_codes = numpy.concatenate(all_codes) if all_codes else numpy.zeros(0, dtype=numpy.int64)
+        order = numpy.argsort(all_codes, kind='stable')
+        codes, offsets = numpy.unique(all_codes[order], return_index=True)
+        offsets = numpy.append(offsets, len(all_codes)).astype(numpy.int64)
+        sources = numpy.concatenate(all_sources)[order] if all_sources else numpy.zeros(0, dtype=numpy.int32)
+        counts = numpy.concatenate(all_counts)[order] if all_counts else numpy.zeros(0, dtype=numpy.int64)
+
+        if self.verbose:
+            print('Indexed {nr} k-mers of {t} training-proteins for l={k} and y={sub}'.format(
+                nr=len(codes), t=len(train_names), k=max_kmer_length, sub=max_sub_score))
+
+        index = NeighborhoodIndex(self.verbose)
+        index.max_kmer_length = max_kmer_length
+        index.max_sub_score = max_sub_score
+        index.source_digest = Helper(self.verbose).file_digest(train_kernel_input)
+        index.train_names = train_names
+        index.codes = codes
+        index.offsets = offsets
+        index.sources = sources
+        index.counts = counts
+        index.self_hits = numpy.asarray(self_hits, dtype=numpy.int64)
+
+        return index
+
+    def kernel_rows(self, index, query_kernel_input):
+        """ Kernel of all query proteins against all indexed training proteins
+        :param index: NeighborhoodIndex of the training proteins
+        :param query_kernel_input: Kernel input of the query proteins
+        :return: 2-D array in the layout of the my-string-kernel output - one row per query protein with one column
+                per training protein plus the query's self-hit as last column
+        """
+        query_proteins = self.read_kernel_input(query_kernel_input)
+        train_count = len(index.train_names)
+        kernel_values = numpy.zeros((len(query_proteins), train_count + 1), dtype=numpy.float64)
+        for row, (protein_name, cost_rows) in enumerate(query_proteins):
+            codes, counts = self.neighborhood_features(cost_rows, index.max_kmer_length, index.max_sub_score)
+            kernel_values[row, train_count] = numpy.dot(counts, counts)
+
+            # postings of all query k-mers that occur in the training set, without a python-loop over the k-mers
+            positions = numpy.searchsorted(index.codes, codes)
+            is_indexed = positions < len(index.codes)
+            is_indexed[is_indexed] = index.codes[positions[is_indexed]] == codes[is_indexed]
+            positions = positions[is_indexed]
+            starts = index.offsets[positions]
+            hit_counts = index.offsets[positions + 1] - starts
+            total_hits = int(hit_counts.sum())
+            if total_hits == 0:
+                continue
+            hit_indices = numpy.repeat(starts - numpy.cumsum(hit_counts) + hit_counts, hit_counts) + \
+                numpy.arange(total_hits)
+            weights = numpy.repeat(counts[is_indexed], hit_counts) * index.counts[hit_indices]
+            kernel_values[row, :train_count] = numpy.bincount(index.sources[hit_indices], weights=weights,
+                                                              minlength=train_count)
+
+        return kernel_values
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -12,10 +12,14 @@ class Protein(object):
         self.verbose = verbose
         self.fasta_file = None
         self.blast_file = None
+        self.sequence = None  # in-memory alternative to fasta_file
+        self.profile = None  # in-memory alternative to blast_file
         self.location_prediction = None
         self.has_blast_hit = False
         self.has_prediction = False
         self.reliability = None
+        self.predicted_classes = list()  # structured form of location_prediction
+        self.class_reliabilities = list()  # reliability per predicted class
 
 def error(*objs):
     print("ERROR: ", *objs, file=sys.stderr)
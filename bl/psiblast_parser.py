@@ -0,0 +1,120 @@
+# -*- coding: utf8 -*-
+""" Reads blastpgp output and selects the homologue used for homology based inference
+
+Replaces psi-blast2hssp.pl (HSSP-values per hit of the last PSI-BLAST round) and the 'maxSeqId'-method of
+PrintBlastPredictions.jar (hit with the highest percentage identity), so each blast-file can be evaluated as soon
+as its blastpgp-call finished.
+"""
+from __future__ import print_function
+import math
+import re
+import sys
+
+
+class PsiBlastHit(object):
+
+    """ First alignment of a hit in the last PSI-BLAST round, as written to the .psiBlast2hssp-files """
+
+    def __init__(self, hit_ac, identity, alignment_length, e_value, hssp_distance):
+        self.hit_ac = hit_ac
+        self.identity = identity  # percentage identity, rounded to one decimal place as psi-blast2hssp.pl does
+        self.alignment_length = alignment_length  # excluding gaps
+        self.e_value = e_value
+        self.hssp_distance = hssp_distance
+
+
+class PsiBlastParser(object):
+
+    # same expressions as in psi-blast2hssp.pl
+    LAST_ROUND_REGEX = re.compile(r'Results from round 3|CONVERGED!| No hits found ')
+    SCORE_REGEX = re.compile(r'^\s*Score\s*=\s*[\d.]+\s*bits\s*\([\d.]+\),\s*Expect\s*=\s*([e\-.\d]+)')
+    IDENTITIES_REGEX = re.compile(r'^\s*Identities\s*=\s*(\d+)/(\d+)\s*\(\d+%\),\s*Positives\s*=\s*(\d+)/\d+\s*'
+                                  r'\(\d+%\)(,\s*Gaps\s*=\s*(\d+)/\d+\s*\(\d+%\))?')
+
+    def read_hits(self, blast_file):
+        """ Read the hits of the last round (round 3, or the round PSI-BLAST converged in) of a blastpgp-output
+        :param blast_file: Output of blastpgp for one query protein
+        :return: List of PsiBlastHit, in the order of the blast-file
+        """
+        hits = list()
+        is_last_round = False
+        hit_ac = None
+        is_new_hit = False
+        with open(blast_file, 'r') as blast_src:
+            for line in blast_src:
+                if line.startswith('Query= '):
+                    is_last_round = False
+                    is_new_hit = False
+                elif not is_last_round:
+                    if self.LAST_ROUND_REGEX.search(line):
+                        is_last_round = True
+                elif line.startswith('>'):
+                    hit_ac = self.__hit_ac(line)
+                    is_new_hit = True
+                elif is_new_hit:
+                    score_match = self.SCORE_REGEX.match(line)
+                    if score_match:
+                        # only the first alignment of a hit counts - the line after its score has the identities
+                        identities_match = self.IDENTITIES_REGEX.match(next(blast_src, ''))
+                        if identities_match:
+                            hits.append(self.__create_hit(hit_ac, score_match.group(1), identities_match))
+                            is_new_hit = False
+                        else:
+                            error('BLAST-format not correct in {fl}: score-line is not followed by a line giving '
+                                  'information about %identity'.format(fl=blast_file))
+
+        return hits
+
+    def best_hit(self, blast_file):
+        """ Hit with the highest percentage identity, as PrintBlastPredictions.jar with 'maxSeqId' selects it.
+        On ties, the jar chooses randomly - here the first of them, i.e. the best scoring one, is chosen.
+        :param blast_file: Output of blastpgp for one query protein
+        :return: PsiBlastHit or None if there is no hit in the last round
+        """
+        return self.select_best_hit(self.read_hits(blast_file))
+
+    def select_best_hit(self, hits):
+        """ :return: First of the hits with the highest percentage identity, None if there are no hits """
+        best_hit = None
+        for hit in hits:
+            if best_hit is None or hit.identity > best_hit.identity:
+                best_hit = hit
+
+        return best_hit
+
+    def hssp_distance(self, identity, alignment_length):
+        """ HSSP-Distance using the formula from B. Rost's HSSP-Paper 1999
+        :param identity: Percentage identity in alignment (PIDE)
+        :param alignment_length: Length of alignment, excluding gaps (LALI)
+        """
+        if alignment_length <= 11:
+            return identity - 100
+        elif alignment_length > 450:
+            return identity - 19.5
+        else:
+            exponent = -0.32 * (1 + math.exp(- alignment_length / 1000.0))
+            return identity - (480 * (alignment_length ** exponent))
+
+    def __create_hit(self, hit_ac, e_value, identities_match):
+        identical = int(identities_match.group(1))
+        alignment_length = int(identities_match.group(2))
+        if identities_match.group(4):
+            alignment_length -= int(identities_match.group(5))
+        identity = (float(identical) / alignment_length) * 100
+        hssp_distance = int(round(self.hssp_distance(identity, alignment_length)))
+
+        return PsiBlastHit(hit_ac, float('{pi:.1f}'.format(pi=identity)), alignment_length, e_value, hssp_distance)
+
+    def __hit_ac(self, line):
+        # headers of the lookup-fasta are separated by '#', the AC is the second field
+        hit_values = line[1:].rstrip('\n').split('#')
+        if len(hit_values) > 1:
+            return hit_values[1]
+        return None
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
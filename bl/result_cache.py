@@ -0,0 +1,154 @@
+# -*- coding: utf8 -*-
+""" Persistent cache of prediction results in a SQLite-file, so proteins predicted before are not predicted again
+
+Results are keyed by a hash of the cleaned sequence, the profile, the prediction mode and a fingerprint of the
+model files, i.e. a result is only reused for the same input predicted with the same models. If the cache grows
+larger than its maximum size, the least recently used results are evicted.
+"""
+from __future__ import print_function
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from bl.helper import Helper
+
+
+class ResultCache(object):
+
+    DEFAULT_MAX_SIZE_MB = 1024
+    ENTRY_OVERHEAD = 128  # estimated bytes per entry for key and index, added to the size of the stored values
+
+    def protein_key(self, protein_name, protein, mode):
+        """ Content-address of the prediction of a protein, independent of its name
+        :param protein_name: Name of the protein (only used to clean the fasta-header)
+        :param protein: Protein with fasta_file/sequence and blast_file/profile
+        :param mode: Prediction mode, e.g. 'sn' or 'tr'
+        :return: Hex-digest identifying the prediction
+        """
+        helper = Helper(self.verbose)
+        sequence = helper.cleaned_sequence(protein, protein_name)
+        if protein.profile is not None:
+            profile = protein.profile
+        elif protein.blast_file is not None:
+            with open(protein.blast_file, 'r') as blast_src:
+                profile = blast_src.read()
+        else:
+            profile = ''
+
+        key = hashlib.sha256()
+        for part in (sequence, profile, mode, self.model_fingerprint):
+            key.update(part.encode('utf8'))
+            key.update(b'\0')  # separator, so shifted parts can't produce the same key
+
+        return key.hexdigest()
+
+    def lookup(self, key, protein):
+        """ Set the cached prediction of a protein, if there is one
+        :return: True on a cache-hit, False otherwise
+        """
+        row = self._connection.execute('SELECT location_prediction, reliability, has_blast_hit, has_prediction, '
+                                       'predicted_classes, class_reliabilities FROM results WHERE key = ?',
+                                       (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        protein.location_prediction = json.loads(row[0])
+        protein.reliability = json.loads(row[1])
+        protein.has_blast_hit = bool(row[2])
+        protein.has_prediction = bool(row[3])
+        protein.predicted_classes = json.loads(row[4])
+        protein.class_reliabilities = json.loads(row[5])
+        self._connection.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+
+        return True
+
+    def store(self, key, protein):
+        values = (json.dumps(protein.location_prediction), json.dumps(protein.reliability),
+                  json.dumps(protein.predicted_classes), json.dumps(protein.class_reliabilities))
+        size = sum(len(value) for value in values) + self.ENTRY_OVERHEAD
+        self._connection.execute('INSERT OR REPLACE INTO results (key, location_prediction, reliability, '
+                                 'predicted_classes, class_reliabilities, has_blast_hit, has_prediction, size, '
+                                 'last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (key, values[0], values[1], values[2], values[3], int(protein.has_blast_hit),
+                                  int(protein.has_prediction), size, time.time()))
+
+    def commit(self):
+        """ Write all stored results to disk and evict the least recently used ones, if the cache is too large """
+        self.evict()
+        self._connection.commit()
+
+    def evict(self):
+        total_size = self.size()
+        if total_size <= self.max_size:
+            return
+
+        evicted = 0
+        rows = self._connection.execute('SELECT key, size FROM results ORDER BY last_used ASC').fetchall()
+        for key, size in rows:
+            if total_size <= self.max_size:
+                break
+            self._connection.execute('DELETE FROM results WHERE key = ?', (key,))
+            total_size -= size
+            evicted += 1
+
+        self.evictions += evicted
+        if self.verbose:
+            print('Evicted {nr} results from cache {fl}'.format(nr=evicted, fl=self.cache_file))
+
+    def size(self):
+        """ :return: Estimated size of all cached results in bytes """
+        return self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def entry_count(self):
+        return self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def report_statistics(self):
+        requests = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / requests if requests else 0.0
+        print('Result-cache {fl}: {h} hits, {m} misses ({r:.1f}% hit-rate), {e} evictions, {nr} cached results '
+              '({s:.1f} MB)'.format(fl=self.cache_file, h=self.hits, m=self.misses, r=hit_rate, e=self.evictions,
+                                    nr=self.entry_count(), s=self.size() / 1024.0 / 1024.0))
+
+    def close(self):
+        if self._connection is not None:
+            self.commit()
+            self._connection.close()
+            self._connection = None
+
+    def __calculate_model_fingerprint(self, file_manager):
+        fingerprint = hashlib.sha256()
+        for model_file in file_manager.model_files():
+            if os.path.isfile(model_file):
+                file_stat = os.stat(model_file)
+                fingerprint.update('{fl}\t{s}\t{t}\n'.format(fl=os.path.abspath(model_file), s=file_stat.st_size,
+                                                             t=int(file_stat.st_mtime)).encode('utf8'))
+
+        return fingerprint.hexdigest()
+
+    def __init__(self, is_verbose, cache_file, file_manager, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.verbose = is_verbose
+        self.cache_file = cache_file
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.model_fingerprint = self.__calculate_model_fingerprint(file_manager)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # predictions may run in another thread than the one creating the cache (see bl/prediction_server.py)
+        self._connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, '
+                                 'location_prediction TEXT, reliability TEXT, predicted_classes TEXT, '
+                                 'class_reliabilities TEXT, has_blast_hit INTEGER, has_prediction INTEGER, '
+                                 'size INTEGER, last_used REAL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self._connection.commit()
+        if self.verbose:
+            print('Using result-cache {fl} with {nr} cached results'.format(fl=cache_file, nr=self.entry_count()))
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -3,6 +3,7 @@
 """
 from __future__ import print_function
 import sys
+from bl.prediction_record import PredictionRecord
 
 
 class ResultWriter(object):
@@ -16,28 +17,73 @@ class ResultWriter(object):
              '#\n' \
              '# Protein Id\tLocalization\tSource\tRI\n'
 
+    # sub-nuclear columns as in HEADER, followed by the same columns of the traveller prediction
+    COMBINED_HEADER = '# Sub-nuclear Localization and Nuclear Travelling Prediction using LocNuclei\n' \
+                      '#\n' \
+                      '# NOTATION Protein Id: Fasta sequences Id truncated by whitespace\n' \
+                      '# NOTATION Localization: Predicted sub-nuclear localization class\n' \
+                      '# NOTATION Travelling: Predicted nuclear travelling class (Traveller. or NOT Traveller.)\n' \
+                      '# NOTATION Source: s == svm, b == blast\n' \
+                      '# NOTATION Reliability Index (RI) between 0 and 100\n' \
+                      '#\n' \
+                      '# Protein Id\tLocalization\tSource\tRI\tTravelling\tSource\tRI\n'
 
     def write_results_to_file(self, proteins, out_file):
         with open(out_file, 'w') as target:
             target.write(self.HEADER)
-            
-            for protein_name in proteins:
-                ac = protein_name
-                protein = proteins[ac]
-                if protein.has_prediction:
-                    loc = protein.location_prediction
-                    if protein.has_blast_hit:
-                        source = 'b'
-                    else:
-                        source = 's'
-                    reliability = protein.reliability
-                else:
-                    loc = 'unknown'
-                    source = 'NA'
-                    reliability = 'NA'
-
-                result_line = '{ac} \t {loc} \t {src} \t {r}\n'.format(ac=ac, loc=loc, src=source, r=reliability)
-                target.write(result_line)
+            self.write_result_lines(proteins, target)
+
+    def write_result_lines(self, proteins, target, protein_ids=None):
+        """ Write one result-line per protein to the open target, e.g. to append the results of a batch
+        :param protein_ids: Dictionary of protein name to the id written for it, if proteins uses internal names
+        """
+        for protein_name in proteins:
+            ac = protein_name if protein_ids is None else protein_ids[protein_name]
+            protein = proteins[protein_name]
+            loc, source, reliability = self.result_columns(protein)
+
+            result_line = '{ac} \t {loc} \t {src} \t {r}\n'.format(ac=ac, loc=loc, src=source, r=reliability)
+            target.write(result_line)
+
+    def write_combined_result_lines(self, sn_proteins, tr_proteins, target, protein_ids=None):
+        """ Write one result-line per protein with its sub-nuclear and its traveller prediction to the open target
+        :param sn_proteins: Dictionary of protein name to Protein with the sub-nuclear prediction
+        :param tr_proteins: Dictionary of the same protein names to Protein with the traveller prediction
+        :param protein_ids: Dictionary of protein name to the id written for it, if proteins uses internal names
+        """
+        for protein_name in sn_proteins:
+            ac = protein_name if protein_ids is None else protein_ids[protein_name]
+            loc, source, reliability = self.result_columns(sn_proteins[protein_name])
+            tr_loc, tr_source, tr_reliability = self.result_columns(tr_proteins[protein_name])
+
+            result_line = '{ac} \t {loc} \t {src} \t {r} \t {tloc} \t {tsrc} \t {tr}\n'.format(
+                ac=ac, loc=loc, src=source, r=reliability, tloc=tr_loc, tsrc=tr_source, tr=tr_reliability)
+            target.write(result_line)
+
+    def result_columns(self, protein):
+        """ :return: tupel(localization, source, reliability) as written to the result-file for the protein """
+        if protein.has_prediction:
+            loc = protein.location_prediction
+            if protein.has_blast_hit:
+                source = 'b'
+            else:
+                source = 's'
+            reliability = protein.reliability
+        else:
+            loc = 'unknown'
+            source = 'NA'
+            reliability = 'NA'
+
+        return loc, source, reliability
+
+    def prediction_record(self, protein_id, protein):
+        """ :return: PredictionRecord of the protein, holding the same prediction as its result-file line """
+        loc, source, reliability = self.result_columns(protein)
+        if protein.has_prediction:
+            return PredictionRecord(protein_id, list(protein.predicted_classes), list(protein.class_reliabilities),
+                                    source, loc, reliability)
+        else:
+            return PredictionRecord(protein_id, list(), list(), None, loc, reliability)
 
     def __init__(self, is_verbose):
         self.verbose = is_verbose
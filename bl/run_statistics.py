@@ -0,0 +1,211 @@
+# -*- coding: utf8 -*-
+""" Wall-clock time, CPU time and item counts per stage of a LocNuclei run
+
+Stages measured in this process are timed with stage(), the runs of external programs (blastpgp, my-string-kernel)
+are added with add_external_run() from the times measured by the worker that ran them - their CPU time is the one of
+the external program. Besides the stages, counters of events (e.g. skipped BLAST searches) are kept.
+The statistics can be written as JSON-report and as textfile for the Prometheus node-exporter. Optionally the Python
+parts of a run are profiled with cProfile and tracemalloc.
+"""
+from __future__ import print_function
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+
+class StageStatistics(object):
+
+    def as_dict(self):
+        return OrderedDict([('calls', self.calls), ('items', self.items),
+                            ('wall_seconds', round(self.wall_seconds, 6)), ('cpu_seconds', round(self.cpu_seconds, 6))])
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+
+
+class RunStatistics(object):
+
+    REPORT_VERSION = 1
+    PROMETHEUS_PREFIX = 'locnuclei'
+    TRACEMALLOC_TOP_COUNT = 25  # allocation sites listed in the memory profile
+
+    @contextlib.contextmanager
+    def stage(self, stage_name, items=1):
+        """ Time the enclosed block as one call of the stage
+        :param stage_name: Name of the stage, e.g. 'input_discovery' or 'kernel_l4_y7'
+        :param items: Number of items (e.g. proteins) processed in the block
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(stage_name, time.perf_counter() - wall_start, time.process_time() - cpu_start, items)
+
+    def add(self, stage_name, wall_seconds, cpu_seconds, items=1):
+        with self._lock:
+            stage = self.stages.setdefault(stage_name, StageStatistics())
+            stage.calls += 1
+            stage.items += items
+            stage.wall_seconds += wall_seconds
+            stage.cpu_seconds += cpu_seconds
+
+    def add_external_run(self, stage_name, run_time, items=1):
+        """ Add the run of an external program
+        :param run_time: tupel(wall-seconds, cpu-seconds) as returned by bl.worker_pool.call_external_program
+        """
+        wall_seconds, cpu_seconds = run_time
+        self.add(stage_name, wall_seconds, cpu_seconds, items)
+
+    def count(self, counter_name, value=1):
+        with self._lock:
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + value
+
+    def report(self):
+        """ :return: All statistics of the run so far as (JSON-serializable) dictionary """
+        own_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self._lock:
+            return OrderedDict([
+                ('version', self.REPORT_VERSION),
+                ('started', self.started.isoformat()),
+                ('wall_seconds', round(time.perf_counter() - self._wall_start, 6)),
+                ('cpu_seconds', round(time.process_time() - self._cpu_start, 6)),
+                # ru_maxrss is given in kilobytes on Linux
+                ('peak_rss_bytes', own_usage.ru_maxrss * 1024),
+                ('peak_child_rss_bytes', children_usage.ru_maxrss * 1024),
+                ('dedup_ratio', round(self.dedup_ratio(), 6)),
+                ('stages', OrderedDict((stage_name, self.stages[stage_name].as_dict())
+                                       for stage_name in sorted(self.stages))),
+                ('counters', OrderedDict((counter_name, self.counters[counter_name])
+                                         for counter_name in sorted(self.counters))),
+            ])
+
+    def dedup_ratio(self):
+        """ :return: Query proteins per distinct input (sequence and profile) that was predicted - 1.0 without
+        duplicates, counted by LocNuclei.deduplicate_query_proteins """
+        unique_proteins = self.counters.get('dedup_unique_proteins', 0)
+        if not unique_proteins:
+            return 1.0
+        return self.counters.get('dedup_input_proteins', 0) / float(unique_proteins)
+
+    def write_json_report(self, report_file):
+        self.__write_atomically(report_file, json.dumps(self.report(), indent=2) + '\n')
+        if self.verbose:
+            print('Wrote run-statistics to {fl}'.format(fl=report_file))
+
+    def write_prometheus_textfile(self, textfile):
+        """ Write the statistics in the text-format of the Prometheus node-exporter's textfile-collector """
+        report = self.report()
+        prefix = self.PROMETHEUS_PREFIX
+        lines = list()
+        for metric, metric_type, description, value in (
+                ('run_wall_seconds', 'gauge', 'Wall-clock time of the run', report['wall_seconds']),
+                ('run_cpu_seconds', 'gauge', 'CPU time of the LocNuclei process', report['cpu_seconds']),
+                ('peak_rss_bytes', 'gauge', 'Peak resident set size of the LocNuclei process',
+                 report['peak_rss_bytes']),
+                ('dedup_ratio', 'gauge', 'Predicted query proteins per distinct sequence and profile',
+                 report['dedup_ratio'])):
+            lines.append('# HELP {p}_{m} {d}'.format(p=prefix, m=metric, d=description))
+            lines.append('# TYPE {p}_{m} {t}'.format(p=prefix, m=metric, t=metric_type))
+            lines.append('{p}_{m} {v}'.format(p=prefix, m=metric, v=value))
+
+        for metric, field, description in (
+                ('stage_calls_total', 'calls', 'Calls per stage'),
+                ('stage_items_total', 'items', 'Items processed per stage'),
+                ('stage_wall_seconds_total', 'wall_seconds', 'Wall-clock time per stage'),
+                ('stage_cpu_seconds_total', 'cpu_seconds', 'CPU time per stage, of the external program for '
+                                                           'blastpgp and my-string-kernel')):
+            lines.append('# HELP {p}_{m} {d}'.format(p=prefix, m=metric, d=description))
+            lines.append('# TYPE {p}_{m} counter'.format(p=prefix, m=metric))
+            for stage_name, stage in report['stages'].items():
+                lines.append('{p}_{m}{{stage="{s}"}} {v}'.format(p=prefix, m=metric, s=self.__label(stage_name),
+                                                                 v=stage[field]))
+
+        lines.append('# HELP {p}_events_total Events counted during the run'.format(p=prefix))
+        lines.append('# TYPE {p}_events_total counter'.format(p=prefix))
+        for counter_name, value in report['counters'].items():
+            lines.append('{p}_events_total{{event="{e}"}} {v}'.format(p=prefix, e=self.__label(counter_name), v=value))
+
+        self.__write_atomically(textfile, '\n'.join(lines) + '\n')
+        if self.verbose:
+            print('Wrote Prometheus-textfile {fl}'.format(fl=textfile))
+
+    def print_summary(self):
+        report = self.report()
+        print('Run took {w:.2f}s wall-clock and {c:.2f}s CPU time, peak RSS {r:.1f} MB'.format(
+            w=report['wall_seconds'], c=report['cpu_seconds'], r=report['peak_rss_bytes'] / 1024.0 / 1024.0))
+        if 'dedup_input_proteins' in report['counters']:
+            print('Deduplication: {u} distinct of {i} predicted query proteins, ratio {d:.2f}'.format(
+                u=report['counters']['dedup_unique_proteins'], i=report['counters']['dedup_input_proteins'],
+                d=report['dedup_ratio']))
+        for stage_name, stage in report['stages'].items():
+            print('\t{s}: {n} calls, {i} items, {w:.2f}s wall-clock, {c:.2f}s CPU'.format(
+                s=stage_name, n=stage['calls'], i=stage['items'], w=stage['wall_seconds'], c=stage['cpu_seconds']))
+        for counter_name, value in report['counters'].items():
+            print('\t{e}: {v}'.format(e=counter_name, v=value))
+
+    def start_profiling(self):
+        """ Profile the Python parts of the run with cProfile and tracemalloc until stop_profiling is called """
+        self._profiler = cProfile.Profile()
+        tracemalloc.start()
+        self._profiler.enable()
+
+    def stop_profiling(self, profile_prefix):
+        """ Write the cProfile-statistics to {prefix}.prof (readable with pstats) and the largest allocation sites and
+        peak of the traced memory to {prefix}.memory.txt
+        """
+        if self._profiler is None:
+            return
+
+        self._profiler.disable()
+        self._profiler.dump_stats('{p}.prof'.format(p=profile_prefix))
+        self._profiler = None
+
+        snapshot = tracemalloc.take_snapshot()
+        current_size, peak_size = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open('{p}.memory.txt'.format(p=profile_prefix), 'w') as memory_out:
+            memory_out.write('Traced memory: {c:.1f} MB at the end, {p:.1f} MB at peak\n'.format(
+                c=current_size / 1024.0 / 1024.0, p=peak_size / 1024.0 / 1024.0))
+            memory_out.write('Largest allocation sites:\n')
+            for statistic in snapshot.statistics('lineno')[:self.TRACEMALLOC_TOP_COUNT]:
+                memory_out.write('{s}\n'.format(s=statistic))
+
+        if self.verbose:
+            print('Wrote profile to {p}.prof and {p}.memory.txt'.format(p=profile_prefix))
+
+    def __label(self, value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def __write_atomically(self, target_file, content):
+        # readers (e.g. the node-exporter) never see a half-written file
+        temp_file = '{fl}.tmp'.format(fl=target_file)
+        with open(temp_file, 'w') as target:
+            target.write(content)
+        os.rename(temp_file, target_file)
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+        self.started = datetime.datetime.utcnow()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self.stages = dict()  # stage name -> StageStatistics
+        self.counters = dict()  # counter name -> value
+        self._profiler = None
+        self._lock = threading.Lock()  # predictors sharing the statistics may run in several threads
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -0,0 +1,299 @@
+# -*- coding: utf8 -*-
+"""
+DESCRIPTION:
+
+Sharded LocNuclei runs, e.g. as array job of a batch-scheduler:
+ - shard: split the proteins of a fasta- and a blast-folder into shards of about the same number of residues and
+   write them to a manifest (JSON)
+ - run-shard: predict the proteins of one shard of the manifest, on its own and in its own process
+ - merge: combine the outputs of all shards into one result file, in the order of the manifest, after checking that
+   every protein of the manifest was predicted exactly once
+
+The manifest holds absolute paths, so every shard can be run from any directory of a shared filesystem.
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import heapq
+import json
+import os
+import sys
+from collections import OrderedDict
+
+from bl.combined_predictor import CombinedLocNucleiPredictor
+from bl.helper import Helper
+from bl.kernel_backend import DEFAULT_KERNEL_BACKEND, KERNEL_BACKENDS
+from bl.locnuclei_predictor import LocNucleiPredictor
+from bl.result_writer import ResultWriter
+from bl.run_statistics import RunStatistics
+
+
+class ShardManifest(object):
+
+    MANIFEST_VERSION = 1
+
+    def create(self, fasta_folder, fasta_suffix, blast_folder, blast_suffix, shard_count):
+        """ Discover the input files as locnuclei.py does and balance the proteins over shard_count shards by the
+        length of their sequences
+        """
+        if shard_count < 1:
+            error('Number of shards needs to be at least 1, got {nr}'.format(nr=shard_count))
+            exit(774)
+
+        helper = Helper(self.verbose)
+        input_files = helper.find_input_files(fasta_folder, fasta_suffix, blast_folder, blast_suffix)
+        self.proteins = OrderedDict()
+        for protein_name in sorted(input_files):  # the glob-order depends on the filesystem
+            fasta_file, blast_file = input_files[protein_name]
+            if blast_file is None:
+                error('No Blast-File found for {p}'.format(p=protein_name))
+                exit(404)
+            sequence_length = len(''.join(helper.clean_fasta_input(fasta_file, protein_name)[1:]))
+            self.proteins[protein_name] = (os.path.abspath(fasta_file), os.path.abspath(blast_file), sequence_length)
+
+        self.shards = self.balance_shards(shard_count)
+
+    def balance_shards(self, shard_count):
+        """ Assign the proteins to shards, longest protein first to the shard with the fewest residues so far - the
+        run-time of a protein grows with its length, not the number of proteins
+        :return: List of shard_count lists of protein names, each in the order of the manifest
+        """
+        shard_residues = [(0, shard_index) for shard_index in range(shard_count)]  # heap of (residues, shard)
+        shard_members = [set() for shard_index in range(shard_count)]
+        for protein_name in sorted(self.proteins, key=lambda name: (-self.proteins[name][2], name)):
+            residues, shard_index = heapq.heappop(shard_residues)
+            shard_members[shard_index].add(protein_name)
+            heapq.heappush(shard_residues, (residues + self.proteins[protein_name][2], shard_index))
+
+        return [[protein_name for protein_name in self.proteins if protein_name in members]
+                for members in shard_members]
+
+    def shard_input_files(self, shard_index):
+        """ :return: OrderedDict of protein name to tupel(fasta-file, blast-file) of the shard's proteins """
+        if not 0 <= shard_index < len(self.shards):
+            error('Shard {s} does not exist, the manifest has shards 0 to {l}'.format(s=shard_index,
+                                                                                     l=len(self.shards) - 1))
+            exit(771)
+
+        return OrderedDict((protein_name, self.proteins[protein_name][:2])
+                           for protein_name in self.shards[shard_index])
+
+    def write_manifest(self, manifest_file):
+        manifest = OrderedDict([
+            ('version', self.MANIFEST_VERSION),
+            ('created', datetime.datetime.utcnow().isoformat()),
+            ('proteins', [[protein_name, fasta_file, blast_file, sequence_length]
+                          for protein_name, (fasta_file, blast_file, sequence_length) in self.proteins.items()]),
+            ('shards', [OrderedDict([('residues', sum(self.proteins[protein_name][2] for protein_name in shard)),
+                                     ('proteins', shard)]) for shard in self.shards]),
+        ])
+        with open(manifest_file, 'w') as manifest_out:
+            json.dump(manifest, manifest_out, indent=1)
+            manifest_out.write('\n')
+
+        if self.verbose:
+            for shard_index, shard in enumerate(manifest['shards']):
+                print('Shard {s}: {nr} proteins with {r} residues'.format(s=shard_index, nr=len(shard['proteins']),
+                                                                         r=shard['residues']))
+        print('Wrote {nr} proteins in {s} shards to {fl}'.format(nr=len(self.proteins), s=len(self.shards),
+                                                                 fl=manifest_file))
+
+    def read_manifest(self, manifest_file):
+        helper = Helper(self.verbose)
+        helper.file_check(manifest_file)
+        try:
+            with open(manifest_file, 'r') as manifest_src:
+                manifest = json.load(manifest_src)
+            version = manifest['version']
+            proteins = manifest['proteins']
+            shards = manifest['shards']
+        except (ValueError, KeyError, TypeError):
+            error('Was not able to read shard-manifest {fl}'.format(fl=manifest_file))
+            exit(770)
+        if version != self.MANIFEST_VERSION:
+            error('Shard-manifest {fl} has version {v}, expected {e} - create it again'.format(
+                fl=manifest_file, v=version, e=self.MANIFEST_VERSION))
+            exit(770)
+
+        self.proteins = OrderedDict((protein_name, (fasta_file, blast_file, sequence_length))
+                                    for protein_name, fasta_file, blast_file, sequence_length in proteins)
+        self.shards = [shard['proteins'] for shard in shards]
+
+    def merge_outputs(self, shard_output_files, out_file):
+        """ Write the result-lines of all shard outputs to out_file in the order of the manifest
+        :param shard_output_files: Output files of run-shard, in any order
+        """
+        header = None
+        result_lines = dict()  # protein name -> result-line
+        problems = list()
+        for shard_output_file in shard_output_files:
+            shard_header, shard_lines = self.read_shard_output(shard_output_file)
+            if header is None:
+                header = shard_header
+            elif shard_header != header:
+                error('{fl} was written in another prediction mode than {first}'.format(fl=shard_output_file,
+                                                                                       first=shard_output_files[0]))
+                exit(773)
+            for protein_name, result_line in shard_lines:
+                if protein_name not in self.proteins:
+                    problems.append('{p} in {fl} is not in the manifest'.format(p=protein_name, fl=shard_output_file))
+                elif protein_name in result_lines:
+                    problems.append('{p} in {fl} was predicted before'.format(p=protein_name, fl=shard_output_file))
+                else:
+                    result_lines[protein_name] = result_line
+
+        missing_proteins = [protein_name for protein_name in self.proteins if protein_name not in result_lines]
+        if missing_proteins:
+            problems.append('{nr} proteins of the manifest were not predicted: {p}{more}'.format(
+                nr=len(missing_proteins), p=', '.join(missing_proteins[:10]),
+                more=', ...' if len(missing_proteins) > 10 else ''))
+        if problems:
+            for problem in problems:
+                error(problem)
+            exit(772)
+
+        with open(out_file, 'w') as target:
+            target.write(header)
+            for protein_name in self.proteins:
+                target.write(result_lines[protein_name])
+        print('Merged {nr} predictions of {s} shard outputs into {fl}'.format(nr=len(result_lines),
+                                                                              s=len(shard_output_files),
+                                                                              fl=out_file))
+
+    def read_shard_output(self, shard_output_file):
+        """ :return: tupel(header, list of tupel(protein name, result-line)) of an output file of run-shard """
+        header_lines = list()
+        shard_lines = list()
+        with open(shard_output_file, 'r') as output_src:
+            for line in output_src:
+                if line.startswith('#'):
+                    header_lines.append(line)
+                elif line.strip():
+                    shard_lines.append((line.split('\t')[0].strip(), line))
+
+        header = ''.join(header_lines)
+        if header not in (ResultWriter.HEADER, ResultWriter.COMBINED_HEADER):
+            error('{fl} is not an output file of LocNuclei'.format(fl=shard_output_file))
+            exit(773)
+
+        return header, shard_lines
+
+    def __init__(self, is_verbose):
+        self.verbose = is_verbose
+        self.proteins = OrderedDict()  # protein name -> tupel(fasta-file, blast-file, sequence length)
+        self.shards = list()  # list of protein names per shard
+
+
+def run_shard(args):
+    manifest = ShardManifest(args.verbose)
+    manifest.read_manifest(args.manifest_file)
+    input_files = manifest.shard_input_files(args.shard_index)
+    batch_size = args.batch_size or max(1, len(input_files))
+    temp_folder = args.temp_folder
+    if temp_folder:
+        # shards running side by side on one node must not share a working-directory (nor its checkpoints)
+        temp_folder = os.path.join(temp_folder, 'shard_{s}'.format(s=args.shard_index))
+        if not os.path.isdir(temp_folder):
+            os.makedirs(temp_folder)
+    elif args.resume:
+        error('--resume needs the --temp_folder of the shard to resume')
+        exit(760)
+
+    # written under a temporary name, so merge never reads the output of a shard that did not finish
+    temp_output_file = '{fl}.tmp'.format(fl=args.output_file)
+    run_statistics = RunStatistics(args.verbose)
+    if args.combined:
+        with CombinedLocNucleiPredictor(args.verbose, args.debug, args.jobs, args.blast_threads, args.cache_file,
+                                        args.cache_max_mb, args.kmer_min_score, args.kernel_backend, run_statistics,
+                                        resume=args.resume) as loc_nuclei:
+            loc_nuclei.predict_input_files(input_files, temp_folder, temp_output_file, args.only_blast, batch_size)
+    else:
+        with LocNucleiPredictor(args.verbose, args.debug, args.traveller, args.jobs, args.blast_threads,
+                                args.cache_file, args.cache_max_mb, args.kmer_min_score, args.kernel_backend,
+                                run_statistics, resume=args.resume) as loc_nuclei:
+            loc_nuclei.stream_input_files(input_files, temp_folder, temp_output_file, args.only_blast, batch_size)
+    os.rename(temp_output_file, args.output_file)
+
+    if args.verbose:
+        run_statistics.print_summary()
+    if args.stats_file:
+        run_statistics.write_json_report(args.stats_file)
+
+
+def main():
+    usage_string = 'python -m bl.sharding shard example/ example/ manifest.json --shards 2'
+
+    parser = argparse.ArgumentParser(description=__doc__, usage=usage_string,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-v', '--verbose', help='Toggles verbose mode on', action='store_true')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    shard_parser = commands.add_parser('shard', help='Split the input proteins into shards and write the manifest')
+    shard_parser.add_argument('fasta_folder', help='Folder with protein sequences in fasta-format, as for '
+                                                   'locnuclei.py')
+    shard_parser.add_argument('blast_folder', help='Folder with the Blast-Profiles of the fasta files')
+    shard_parser.add_argument('manifest_file', help='Where the manifest should be written to')
+    shard_parser.add_argument('-n', '--shards', help='Number of shards', type=int, required=True)
+    shard_parser.add_argument('--fasta_suffix', help='Suffix of files in given Fasta-folder (default: "*.fasta")',
+                              default='*.fasta')
+    shard_parser.add_argument('--blast_suffix', help='Suffix of files in given Blast-Folder (default: "*.profile")',
+                              default='*.profile')
+
+    run_parser = commands.add_parser('run-shard', help='Predict the proteins of one shard')
+    run_parser.add_argument('manifest_file', help='Manifest written by the shard-command')
+    run_parser.add_argument('shard_index', help='Shard to predict, from 0 to the number of shards - 1 '
+                                                '(e.g. $SLURM_ARRAY_TASK_ID)', type=int)
+    run_parser.add_argument('output_file', help='Where the results of the shard should be written to')
+    target_group = run_parser.add_mutually_exclusive_group()
+    target_group.add_argument('-t', '--traveller', help='Predict nuclear travelling proteins', action='store_true')
+    target_group.add_argument('-c', '--combined', help='Predict sub-nuclear localization and nuclear travelling',
+                              action='store_true')
+    run_parser.add_argument('--temp_folder', help='Folder to work in, each shard works in its own sub-folder '
+                                                  'shard_{index}. If not given, a temporary directory is created.')
+    run_parser.add_argument('--resume', help='Continue the shard from the checkpoints in its --temp_folder',
+                            action='store_true')
+    run_parser.add_argument('-d', '--debug', help='Keep the temporary files', action='store_true')
+    run_parser.add_argument('-b', '--only_blast', help='Only run the blast search', action='store_true')
+    run_parser.add_argument('-j', '--jobs', help='Number of processes to run in parallel (default: 1)', type=int,
+                            default=1)
+    run_parser.add_argument('--blast_threads', help='Number of threads per BLAST-call (default: 1)', type=int,
+                            default=1)
+    run_parser.add_argument('--batch_size', help='Predict the proteins of the shard in batches of this size '
+                                                 '(default: all proteins of the shard in one batch)', type=int)
+    run_parser.add_argument('--cache_file', help='SQLite-file to cache results in, see locnuclei.py')
+    run_parser.add_argument('--cache_max_mb', help='Maximum size of the result-cache in MB (default: 1024)',
+                            type=float, default=1024)
+    run_parser.add_argument('--kmer_min_score', help='k-mer score below which BLAST is skipped, see locnuclei.py',
+                            type=int)
+    run_parser.add_argument('--kernel_backend', help='How the string-kernel is calculated (default: binary)',
+                            choices=KERNEL_BACKENDS, default=DEFAULT_KERNEL_BACKEND)
+    run_parser.add_argument('--stats_file', help='Write the run-statistics of the shard as JSON to this file')
+
+    merge_parser = commands.add_parser('merge', help='Combine the outputs of all shards into one result file')
+    merge_parser.add_argument('manifest_file', help='Manifest written by the shard-command')
+    merge_parser.add_argument('output_file', help='Where the merged results should be written to')
+    merge_parser.add_argument('shard_output_files', help='Output files of all shards', nargs='+')
+    args = parser.parse_args()
+
+    helper = Helper(args.verbose)
+    if args.command == 'shard':
+        if helper.folder_existence_check(args.fasta_folder) and helper.folder_existence_check(args.blast_folder):
+            manifest = ShardManifest(args.verbose)
+            manifest.create(args.fasta_folder, args.fasta_suffix, args.blast_folder, args.blast_suffix, args.shards)
+            manifest.write_manifest(args.manifest_file)
+    elif args.command == 'run-shard':
+        run_shard(args)
+    elif args.command == 'merge':
+        if helper.file_not_there_check(args.output_file):
+            manifest = ShardManifest(args.verbose)
+            manifest.read_manifest(args.manifest_file)
+            manifest.merge_outputs(args.shard_output_files, args.output_file)
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
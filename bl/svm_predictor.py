@@ -1,89 +1,217 @@
 # -*- coding: utf8 -*-
 from __future__ import print_function
-from math import sqrt
 import os
-from sklearn import svm
 import sys
-import subprocess
 import numpy
 from bl.helper import Helper
-from collections import defaultdict
+from bl.kernel_backend import DEFAULT_KERNEL_BACKEND, create_kernel_backend
+from bl.model_bundle import ModelBundle
+from bl.run_statistics import RunStatistics
+from bl.worker_pool import FinishedCall, WorkerPool
+from collections import OrderedDict
 
 class SVMPredictor(object):
 
     QUERY_IDS_FILENAME = 'query_ids.lst'
     QUERY_KERNEL_INPUT_FILE = 'query_kernel_input.psiBlastMat'
+    QUERY_CHUNK_IDS_FILENAME = 'query_ids.{nr}.lst'
+    QUERY_CHUNK_KERNEL_INPUT_FILE = 'query_kernel_input.{nr}.psiBlastMat'
     TRAVELLER_MAX = 1.51
     SN_MAX = 2.58
 
-    def __init__(self, is_verbose, working_directory, file_manager):
+    def __init__(self, is_verbose, working_directory, file_manager, use_model_bundle=True, worker_pool=None,
+                 metadata_store=None, kernel_backend=DEFAULT_KERNEL_BACKEND, run_statistics=None, checkpoint=None):
         self.verbose = is_verbose
         self.all_lookup_proteins = dict()
         self.working_directory = working_directory
         self.fm = file_manager
+        if worker_pool is None:
+            worker_pool = WorkerPool(is_verbose, 1)
+        self.worker_pool = worker_pool
+        self._train_diagonal_values = dict()  # (l, y) -> diagonal of the full training matrix
+        self.metadata_store = metadata_store  # compiled training labels, the training-fasta is parsed if None
+        if run_statistics is None:
+            run_statistics = RunStatistics(is_verbose)
+        self.run_statistics = run_statistics
+        self.checkpoint = checkpoint  # bl/checkpoint.py, normalized kernel rows are recorded there if set
+        self.kernel_backend = create_kernel_backend(is_verbose, kernel_backend, file_manager, self.worker_pool,
+                                                    run_statistics)
+
+        self.model_bundle = None
+        if use_model_bundle:
+            self.load_model_bundle()
+
+    def load_model_bundle(self):
+        """ Load the pre-trained models of all classes, if bl/model_builder.py was run for this data-set """
+        bundle_file = self.fm.model_bundle
+        if bundle_file and os.path.isfile(bundle_file):
+            self.model_bundle = ModelBundle(self.verbose)
+            with self.run_statistics.stage('model_load'):
+                self.model_bundle.read_bundle_file(bundle_file)
+            helper = Helper(self.verbose)
+            for max_kmer_length, max_sub_score in self.model_bundle.kernel_group_params():
+                helper.file_check(self.fm.support_vector_id_file_for_params(max_kmer_length, max_sub_score))
+                helper.file_check(self.fm.support_vector_kernel_input_for_params(max_kmer_length, max_sub_score))
+        elif self.verbose:
+            print('No model-bundle found at {fl} - SVMs will be fitted for every run'.format(fl=bundle_file))
 
     def predict_all_query_proteins_without_blast_hit(self, all_query_proteins):
         if self.verbose:
             print('Starting to create SVM-Predictions for all query-proteins:')
 
         # 1) Iterate over all left query proteins, i.e. the ones without predictions from blast
-        # 1a) Create test-id-file
-        test_id_file, test_id_list = self.create_test_id_file_from_protein_list(all_query_proteins)
-        # 1b) Create test-kernel-input-file (sequences & profiles)
-        test_kernel_input = self.create_test_kernel_input_file_from_protein_list(all_query_proteins, test_id_list)
-
+        test_id_list = self.get_query_ids_without_blast_hit(all_query_proteins)
+        # 1a) Create test-id-files and test-kernel-input-files (sequences & profiles) - split into chunks so all
+        #     workers are busy, even if there are less parameter-combinations than workers
+        chunk_count = -(-self.worker_pool.jobs // self.kernel_group_count())  # ceil
+        with self.run_statistics.stage('kernel_input', len(test_id_list)):
+            query_chunks = self.create_query_chunks(all_query_proteins, test_id_list, chunk_count)
+
+        pending_predictions = self.submit_query_matrices(test_id_list, query_chunks)
+        return self.collect_predictions(all_query_proteins, pending_predictions)
+
+    def kernel_group_count(self):
+        """ :return: Number of query-matrices calculated per prediction, see group_classes_by_kernel_params """
+        helper = Helper(self.verbose)
+        return len(self.group_classes_by_kernel_params(helper.read_param_file(self.fm.best_params)))
+
+    def submit_query_matrices(self, query_ids, query_chunks):
+        """ Submit the string-kernels of all classes for the query chunks, without waiting for them - so other work
+        can be submitted to the worker pool
+        :param query_ids: Ordered ids of the proteins in query_chunks
+        :param query_chunks: Query chunks as created by create_query_chunks
+        :return: Pending predictions, to be passed to collect_predictions
+        """
         # 2) get best params:
         helper = Helper(self.verbose)
         all_params = helper.read_param_file(self.fm.best_params)
-        # 2) Iterate over all parameter-combinations / classes
-        for class_name in all_params:
-            class_params = all_params[class_name]
-
-            max_kmer_length = class_params['l']  # subprocess arguments need to be strings
-            max_sub_score = class_params['y']
-            # print(max_kmer_length)
-            # print(max_sub_score)
-            # 3) call my-string-kernel with the created files (for all parameters)
-            normalized_query_matrix = self.call_string_kernel(max_kmer_length, max_sub_score, class_name)
-            # print(numpy.matrix(normalized_query_matrix))
-            # 4) predict
-            normalized_train_matrix = self.fm.normalized_matrix_file_for_params(max_kmer_length, max_sub_score)
-            query_acs = numpy.asarray(test_id_list)
-            class_results = self.predict_query_matrix(normalized_train_matrix, normalized_query_matrix,
-                                                      query_acs, class_name, class_params)
-
-            for result in class_results:
-                if class_results[result][0]:
-                    # print(class_results)
-                    new_loc_prediction = class_results[result][0].replace('_', ' ')
-                    r_index = str(class_results[result][1])                        
-                    ri_prediction = all_query_proteins[result].reliability
-                    loc_prediction = all_query_proteins[result].location_prediction 
-                    if not loc_prediction or loc_prediction.isspace():
-                        loc_prediction = new_loc_prediction
-                        loc_prediction += '.'
-                    else:
-                        loc_prediction += ' '
-                        loc_prediction += new_loc_prediction
-                        loc_prediction += '.'
-                        loc_prediction.strip()
-                    if not ri_prediction or ri_prediction.isspace():
-                        ri_prediction = r_index
-                        ri_prediction += '.'
-                    else:
-                        ri_prediction += ' '
-                        ri_prediction += r_index
-                        ri_prediction += '.'
-                        ri_prediction.strip()
-                    all_query_proteins[result].location_prediction = loc_prediction
-                    all_query_proteins[result].has_prediction = True
-                    all_query_proteins[result].reliability = ri_prediction
+        kernel_groups = self.group_classes_by_kernel_params(all_params)
+
+        # 3) call my-string-kernel with the created files (once per parameter-combination and chunk) - classes sharing
+        #    the kernel-parameters share one query-matrix
+        pending_query_matrices = list()
+        for kernel_params, class_names in kernel_groups.items():
+            max_kmer_length, max_sub_score, uses_model_bundle = kernel_params
+            if uses_model_bundle:
+                # pre-trained model: the query-kernel is only needed against the support vectors
+                pending_query_matrices.append(self.calculate_query_matrix(
+                    max_kmer_length, max_sub_score, class_names, query_chunks,
+                    self.fm.support_vector_id_file_for_params(max_kmer_length, max_sub_score),
+                    self.fm.support_vector_kernel_input_for_params(max_kmer_length, max_sub_score),
+                    self.model_bundle.kernel_group_diagonal(max_kmer_length, max_sub_score)))
+            else:
+                pending_query_matrices.append(self.calculate_query_matrix(max_kmer_length, max_sub_score,
+                                                                          class_names, query_chunks))
+
+        return query_ids, all_params, kernel_groups, pending_query_matrices
+
+    def collect_predictions(self, all_query_proteins, pending_predictions):
+        """ Wait for the kernels submitted by submit_query_matrices and predict all classes for the query proteins
+        :param all_query_proteins: Dictionary of query proteins - of the submitted ids only the ones in here without
+                blast-hit get the predictions
+        :param pending_predictions: Pending predictions as returned by submit_query_matrices
+        :return: The given dictionary of query proteins
+        """
+        test_id_list, all_params, kernel_groups, pending_query_matrices = pending_predictions
+
+        # 4) predict all classes of each parameter-combination - decision values and probabilities of the positive
+        #    class with one row per query and one column per class, in the order of the parameter-file
+        class_names = list(all_params)
+        decision_values = numpy.zeros((len(test_id_list), len(class_names)), dtype=numpy.float64)
+        positive_probabilities = numpy.zeros_like(decision_values)
+        for kernel_params, pending_query_matrix in zip(kernel_groups, pending_query_matrices):
+            max_kmer_length, max_sub_score, uses_model_bundle = kernel_params
+            group_class_names = kernel_groups[kernel_params]
+            group_columns = [class_names.index(class_name) for class_name in group_class_names]
+            normalized_query_matrix = self.collect_query_matrix(pending_query_matrix)
+            if uses_model_bundle:
+                with self.run_statistics.stage('predict_l{k}_y{y}'.format(k=max_kmer_length, y=max_sub_score),
+                                               len(test_id_list)):
+                    decision_values[:, group_columns], positive_probabilities[:, group_columns] = \
+                        self.predict_kernel_group_with_model_bundle(max_kmer_length, max_sub_score,
+                                                                    group_class_names, normalized_query_matrix)
+            else:
+                normalized_train_matrix = self.fm.normalized_matrix_file_for_params(max_kmer_length, max_sub_score)
+                for class_name, column in zip(group_class_names, group_columns):
+                    decision_values[:, column], positive_probabilities[:, column] = self.predict_query_matrix(
+                        normalized_train_matrix, normalized_query_matrix, class_name, all_params[class_name])
+
+        # 5) set predictions and reliability indices of all classes with a positive decision value
+        rows = [row for row, query_id in enumerate(test_id_list)
+                if query_id in all_query_proteins and not all_query_proteins[query_id].has_blast_hit]
+        reliability_indices = self.reliability_indices(class_names, positive_probabilities[rows])
+        self.set_svm_predictions(all_query_proteins, [test_id_list[row] for row in rows], class_names,
+                                 decision_values[rows], reliability_indices)
 
         return all_query_proteins
 
-    def create_test_id_file_from_protein_list(self, all_query_proteins):
+    def reliability_indices(self, class_names, positive_probabilities):
+        """ Scale the probabilities of the positive classes to reliability indices ranging between 0 and 100
+        :param class_names: Class per column of positive_probabilities
+        :param positive_probabilities: Matrix with one row per query and one column per class
+        :return: Matrix of reliability indices, rounded to two decimal places
+        """
+        max_probabilities = numpy.asarray([self.TRAVELLER_MAX if class_name == 'Traveller' else self.SN_MAX
+                                           for class_name in class_names], dtype=numpy.float64)
+        return numpy.round(positive_probabilities * 100 / max_probabilities, 2)
+
+    def set_svm_predictions(self, all_query_proteins, query_ids, class_names, decision_values, reliability_indices):
+        """ Append all classes with a positive decision value to the predictions of the query proteins
+        :param all_query_proteins: Dictionary of all query proteins
+        :param query_ids: Query protein per row of decision_values and reliability_indices
+        :param class_names: Class per column of decision_values and reliability_indices
+        :param decision_values: Matrix with one row per query and one column per class
+        :param reliability_indices: Matrix of the reliability index per query and class
+        :return: None
+        """
         if self.verbose:
-            print('Creating file of all query-ids')
+            print('Got {nr} predictions'.format(nr=decision_values.size))
+            for row, query_id in enumerate(query_ids):
+                for column, class_name in enumerate(class_names):
+                    print('Query AC {ac} is predicted with {p} for {c}'.format(ac=query_id,
+                                                                              p=decision_values[row, column],
+                                                                              c=class_name))
+
+        for row, column_indices in enumerate(decision_values > 0.0):
+            positive_columns = numpy.flatnonzero(column_indices)
+            if not len(positive_columns):
+                continue
+
+            query_protein = all_query_proteins[query_ids[row]]
+            new_classes = [class_names[column].replace('_', ' ') for column in positive_columns]
+            new_reliabilities = [float(reliability_indices[row, column]) for column in positive_columns]
+            query_protein.location_prediction = self.__append_to_column(query_protein.location_prediction,
+                                                                        new_classes)
+            query_protein.reliability = self.__append_to_column(query_protein.reliability,
+                                                                [str(r_index) for r_index in new_reliabilities])
+            query_protein.has_prediction = True
+            query_protein.predicted_classes.extend(new_classes)
+            query_protein.class_reliabilities.extend(new_reliabilities)
+
+    def __append_to_column(self, column, values):
+        # columns of the result-file list their values separated by '. ', e.g. 'Nucleolus. Nuclear Speckles.'
+        new_values = ' '.join('{v}.'.format(v=value) for value in values)
+        if not column or column.isspace():
+            return new_values
+        return '{c} {v}'.format(c=column, v=new_values)
+
+    def group_classes_by_kernel_params(self, all_params):
+        """ Group classes that can share one query-matrix, i.e. use the same l and y (and the same kind of model)
+        :param all_params: Parameters per class as read by Helper.read_param_file
+        :return: OrderedDict of (l, y, uses_model_bundle) to the list of class names, in order of first appearance
+        """
+        groups = OrderedDict()
+        for class_name in all_params:
+            uses_model_bundle = bool(self.model_bundle and self.model_bundle.has_class(class_name))
+            kernel_params = (all_params[class_name]['l'], all_params[class_name]['y'], uses_model_bundle)
+            groups.setdefault(kernel_params, list()).append(class_name)
+
+        if self.verbose:
+            print('Calculating {nr} query-matrices for {cl} classes'.format(nr=len(groups), cl=len(all_params)))
+
+        return groups
+
+    def get_query_ids_without_blast_hit(self, all_query_proteins):
         test_id_list = list()
         for protein_id, protein in all_query_proteins.items():
             if protein.has_blast_hit:
@@ -91,47 +219,85 @@ class SVMPredictor(object):
             else:
                 test_id_list.append(protein_id)
 
+        return test_id_list
+
+    def create_query_chunks(self, all_query_proteins, test_id_list, chunk_count):
+        """ Split the query proteins into consecutive chunks and create id-file and kernel input per chunk,
+        so the string-kernel can run for all chunks in parallel.
+        :param all_query_proteins: Dictionary of all query proteins
+        :param test_id_list: Ordered ids of the query proteins to predict
+        :param chunk_count: Number of chunks to create (at most one per query protein)
+        :return: List of (id-file, kernel input) per chunk, in the order of test_id_list
+        """
+        chunk_count = max(1, min(chunk_count, len(test_id_list)))
+        chunk_size, larger_chunks = divmod(len(test_id_list), chunk_count)
+        query_chunks = list()
+        chunk_start = 0
+        for chunk_nr in range(chunk_count):
+            chunk_end = chunk_start + chunk_size + (1 if chunk_nr < larger_chunks else 0)
+            chunk_ids = test_id_list[chunk_start:chunk_end]
+            chunk_start = chunk_end
+
+            if chunk_count == 1:
+                id_file_name = self.QUERY_IDS_FILENAME
+                kernel_input_name = self.QUERY_KERNEL_INPUT_FILE
+            else:
+                id_file_name = self.QUERY_CHUNK_IDS_FILENAME.format(nr=chunk_nr)
+                kernel_input_name = self.QUERY_CHUNK_KERNEL_INPUT_FILE.format(nr=chunk_nr)
+            test_id_file = self.create_test_id_file_from_protein_list(chunk_ids, id_file_name)
+            test_kernel_input = self.create_test_kernel_input_file_from_protein_list(all_query_proteins, chunk_ids,
+                                                                                    kernel_input_name)
+            query_chunks.append((test_id_file, test_kernel_input))
+
+        return query_chunks
+
+    def create_test_id_file_from_protein_list(self, test_id_list, id_file_name):
+        if self.verbose:
+            print('Creating file of {nr} query-ids'.format(nr=len(test_id_list)))
         helper = Helper(self.verbose)
 
         query_id_file_path = None
 
         if self.working_directory and helper.folder_existence_check(self.working_directory):
-            query_id_file_path = os.path.join(self.working_directory, self.QUERY_IDS_FILENAME)
+            query_id_file_path = os.path.join(self.working_directory, id_file_name)
             helper.file_not_there_check(query_id_file_path)  # quit if file already exists
             with open(query_id_file_path, 'w') as id_lst_file:
                 for name in test_id_list:
                     id_lst_file.write('{protein_name}\n'.format(protein_name=name))
 
-            self.fm.test_id_file = query_id_file_path
             self.fm.add_file_to_delete(query_id_file_path)
         else:
             error('Temporary working-directory {dr} was '
                   'not found or is not accessible'.format(dr=self.working_directory))
             exit(500)
 
-        return query_id_file_path, test_id_list
+        return query_id_file_path
 
-    def create_test_kernel_input_file_from_protein_list(self, all_query_proteins, test_ids):
+    def create_test_kernel_input_file_from_protein_list(self, all_query_proteins, test_ids, kernel_input_name):
         if self.verbose:
-            print('Creating file of all query-proteins used as input for string-kernel')
+            print('Creating file of {nr} query-proteins used as input for string-kernel'.format(nr=len(test_ids)))
         helper = Helper(self.verbose)
         query_kernel_input_path = None
         if self.working_directory and helper.folder_existence_check(self.working_directory):
-            query_kernel_input_path = os.path.join(self.working_directory, self.QUERY_KERNEL_INPUT_FILE)
+            query_kernel_input_path = os.path.join(self.working_directory, kernel_input_name)
             helper.file_not_there_check(query_kernel_input_path)  # quit if file already exists
             with open(query_kernel_input_path, 'w') as kernel_input:
                 self.fm.add_file_to_delete(query_kernel_input_path)
-                self.fm.test_kernel_input = query_kernel_input_path
                 for protein in test_ids:  # loop over id-list to make sure we have always the same order of IDs
-                    fasta_file = all_query_proteins[protein].fasta_file
-                    cleaned_fasta = helper.clean_fasta_input(fasta_file, protein)
+                    query_protein = all_query_proteins[protein]
+                    if query_protein.sequence is not None:
+                        cleaned_fasta = helper.clean_sequence_input(query_protein.sequence, protein)
+                    else:
+                        cleaned_fasta = helper.clean_fasta_input(query_protein.fasta_file, protein)
                     for line in cleaned_fasta:
                         kernel_input.write(line)
                     kernel_input.write('\n')  # add linebreak at end of sequence
 
-                    blast_file = all_query_proteins[protein].blast_file
-                    with open(blast_file, 'r') as blast_src:
-                        kernel_input.write(blast_src.read())
+                    if query_protein.profile is not None:
+                        kernel_input.write(query_protein.profile)
+                    else:
+                        with open(query_protein.blast_file, 'r') as blast_src:
+                            kernel_input.write(blast_src.read())
         else:
             error('Temporary working-directory {dr} was '
                   'not found or is not accessible'.format(dr=self.working_directory))
@@ -139,128 +305,119 @@ class SVMPredictor(object):
 
         return query_kernel_input_path
 
-    def call_string_kernel(self, max_kmer_length, max_sub_score, class_name):
-        max_kmer_length = str(max_kmer_length)  # subprocess arguments need to be strings
-        max_sub_score = str(max_sub_score)
-
-        kernel_call = list()
-        kernel_call.append(self.fm.my_string_kernel)
-        kernel_call.append('-o')
-        kernel_call.append(self.fm.test_id_file)
-        kernel_call.append('-O')
-        kernel_call.append(self.fm.train_id_file)
-        kernel_call.append('-p')
-        kernel_call.append(self.fm.test_kernel_input)
-        kernel_call.append('-P')
-        kernel_call.append(self.fm.train_kernel_input)
-        kernel_call.append('-K')
-        kernel_call.append('-L')
-        kernel_call.append(max_kmer_length)
-        kernel_call.append('-Y')
-        kernel_call.append(max_sub_score)
-        kernel_call.append('-i')
-        kernel_call.append(self.fm.amino_file)
-        kernel_call.append('-g')
-        kernel_call.append(self.fm.globals_file)
-
-        if self.verbose:
-            print('Calling String-Kernel for class {cl}'.format(cl=class_name))
-            call = ''
-            for c in kernel_call:
-                call += ' {ca}'.format(ca=c)
-            print(call)
-
-        #debug:
-        import datetime
-        print('Start: {dt}'.format(dt=datetime.datetime.utcnow()))
-
-        sp = subprocess.Popen(kernel_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = sp.communicate()
-        if out:
-            print('String-Kernel finished for parameters k-mer-length {k} and sub-scores {l}'.format(
-                k=max_kmer_length, l=max_sub_score))
-        if err:
+    def calculate_query_matrix(self, max_kmer_length, max_sub_score, class_names, query_chunks,
+                               train_id_file=None, train_kernel_input=None, train_diagonal_values=None):
+        """ Submit the string-kernel for all query chunks to the kernel backend.
+        :param max_kmer_length: Parameter l of the kernel
+        :param max_sub_score: Parameter y of the kernel
+        :param class_names: Classes the kernel is calculated for (only used for logging)
+        :param query_chunks: Query chunks as created by create_query_chunks
+        :param train_id_file: Training ids to calculate the kernel against (default: full training set)
+        :param train_kernel_input: Kernel input of the proteins in train_id_file (default: full training set)
+        :param train_diagonal_values: Un-normalized self-hits of the proteins in train_id_file, in the same order
+                (default: read from the full training matrix)
+        :return: Pending kernel calculation, to be passed to collect_query_matrix
+        """
+        if train_id_file is None:
+            train_id_file = self.fm.train_id_file
+            train_kernel_input = self.fm.train_kernel_input
+
+        pending_kernels = list()  # tupel(checkpoint key, pending kernel, True if already normalized) per chunk
+        for test_id_file, test_kernel_input in query_chunks:
+            checkpoint_key = None
+            if self.checkpoint is not None:
+                checkpoint_key = self.checkpoint.kernel_key(max_kmer_length, max_sub_score, train_id_file,
+                                                            test_id_file)
+                normalized_rows = self.checkpoint.kernel_rows(checkpoint_key)
+                if normalized_rows is not None:  # calculated before the run was resumed
+                    self.run_statistics.count('kernel_chunks_resumed')
+                    pending_kernels.append((checkpoint_key, FinishedCall(normalized_rows), True))
+                    continue
             if self.verbose:
-                print(err)
-        if sp.returncode:
-            code = int(sp.returncode)
-            print(out)
-            print(err)
-            if code != 0:
-                error('String-kernel returned with exit-code {nr}'.format(nr=code))
-                exit(666)
+                print('Calling String-Kernel for class {cl}'.format(cl=', '.join(class_names)))
+            pending_kernels.append((checkpoint_key, self.kernel_backend.submit_kernel(
+                max_kmer_length, max_sub_score, test_id_file, test_kernel_input, train_id_file, train_kernel_input),
+                False))
 
-        print('Finish: {dt}'.format(dt=datetime.datetime.utcnow()))
+        return max_kmer_length, max_sub_score, train_diagonal_values, pending_kernels
 
-        if self.verbose:
-            print('Normalizing query-matrix:')
-            print('\t Reading diagonal values of train-matrix')
-        train_diagonal_values = self.__get_diagonal_values_from_matrix_files(max_kmer_length, max_sub_score)
+    def collect_query_matrix(self, pending_query_matrix):
+        """ Wait for all chunks of a kernel calculation and merge their normalized rows in query order
+        :param pending_query_matrix: Pending kernel calculation as returned by calculate_query_matrix
+        :return: Normalized query-matrix, one row per query protein
+        """
+        max_kmer_length, max_sub_score, train_diagonal_values, pending_kernels = pending_query_matrix
 
+        if train_diagonal_values is None:
+            if self.verbose:
+                print('\t Reading diagonal values of train-matrix')
+            train_diagonal_values = self.get_diagonal_values_from_matrix_files(max_kmer_length, max_sub_score)
+        train_diagonal_roots = numpy.sqrt(numpy.asarray(train_diagonal_values, dtype=numpy.float64))
+
+        normalized_chunks = list()
+        for checkpoint_key, pending_kernel, is_normalized in pending_kernels:  # chunks were submitted in query order
+            if is_normalized:
+                normalized_chunks.append(pending_kernel.get())
+                continue
+            kernel_values = self.kernel_backend.collect_kernel(pending_kernel, max_kmer_length, max_sub_score)
+            normalized_rows = self.normalize_kernel_values(kernel_values, train_diagonal_roots)
+            if checkpoint_key is not None:
+                self.checkpoint.store_kernel_rows(checkpoint_key, normalized_rows)
+            normalized_chunks.append(normalized_rows)
+
+        return numpy.vstack(normalized_chunks)
+
+    def normalize_kernel_values(self, kernel_values, train_diagonal_roots):
+        """ Normalize the kernel of the query proteins:
+        normalized[q, t] = kernel[q, t] / (sqrt(self-hit[t]) * sqrt(self-hit[q]))
+        :param kernel_values: Un-normalized kernel as returned by the kernel backend - one row per query with one
+                column per training protein plus the query's self-hit as last column, None if there is none
+        :param train_diagonal_roots: Square roots of the training proteins' self-hits, in column order
+        :return: Normalized query-matrix as 2-D array, one row per query protein
+        """
         if self.verbose:
             print('\t Calcualting normalized values for queries')
 
+        if kernel_values is None:
+            return numpy.zeros((0, len(train_diagonal_roots)))
 
-        normalized_rows = list()
-        if out:
-            # print(out)
-            row_index = len(train_diagonal_values)
-            start = True
-            lines = out.split(b'\n')
-            for line in lines:
-                # print(line)
-                if not line:
-                    continue
-                if start:                    
-                        if line.strip().startswith(b'Read in all data files.'):
-                            continue
-                        else:
-                            # print(line)
-                            header_values = line.replace(b'\n', b'').strip().split()
-                            try:
-                                row_count = int(header_values[0])
-                                col_count = int(header_values[1])
-                                start = False
-                                continue
-                            except ValueError:
-                                error('Was not able to parse row/column-counts from my-string-kernel output')
-                                exit(712)
-                else:
-                    current_row_values = line.replace(b'\n', b'').strip().split()  # TODO fix to use correct diagonal values.
-                    # last column in my-string-kernel output is diagonal value/self-hit
-                    normalized_row = list()
-                    column_index = 0
-                    for cell_value in current_row_values:
-                        if row_index < (row_count+len(train_diagonal_values)):
-                            if column_index < col_count:  # the my-string-kernel output has +1 columsn for the diagonal values
-                                self_hit_value = float(current_row_values[col_count])
-                                cell_value = float(cell_value)
-                                diag_product = (sqrt(float(train_diagonal_values[column_index])) * sqrt(self_hit_value))
-                                normalized_value = cell_value / diag_product
-                                normalized_row.append(float(normalized_value))
-                                column_index += 1
-                            
-                            # $tmp_ar[$i]/(sqrt($diags[$i]*$diags[$ctr]));
-                            # Spalte[$i] / sqrt(diagonalwert[$i] * diagonalwert[Zeilennr])
-                            # Example:
-                            # AC / (sqrt(CC * AA))
-
-                    normalized_rows.append(normalized_row)
-                    row_index += 1
+        col_count = kernel_values.shape[1] - 1
+        if col_count != len(train_diagonal_roots):
+            error('String-kernel returned {nr} columns, expected {c} columns plus self-hit'.format(
+                nr=kernel_values.shape[1], c=len(train_diagonal_roots)))
+            exit(713)
 
-            if self.verbose:
-                print('Normalized query-matrix:')
-                for r in normalized_rows:
-                    print(r)
+        # last column in my-string-kernel output is diagonal value/self-hit
+        # $tmp_ar[$i]/(sqrt($diags[$i]*$diags[$ctr]));
+        # Spalte[$i] / sqrt(diagonalwert[$i] * diagonalwert[Zeilennr])
+        # Example:
+        # AC / (sqrt(CC * AA))
+        self_hit_roots = numpy.sqrt(kernel_values[:, col_count])
+        normalized_rows = kernel_values[:, :col_count] / (train_diagonal_roots[numpy.newaxis, :] *
+                                                         self_hit_roots[:, numpy.newaxis])
 
-        # call to kernel:
-        # my $kernelCommand = "$stringKernelExePath -o $combinedIDFile -O $trainIDsFilePath
-        # -p $kernelInputFile -P $trainInputFilePath -K -L $maxKmerLength -Y $maxSubScore -i $aminoFilePath
-        # -g $globalsFilePath  1> $kernelMatrixFilePath 2> $kernelMatrixErrorFilePath";
+        if self.verbose:
+            print('Normalized query-matrix:')
+            for r in normalized_rows:
+                print(r)
 
         return normalized_rows
 
-    def __get_diagonal_values_from_matrix_files(self, max_kmer_length, max_sub_score):
+    def get_diagonal_values_from_matrix_files(self, max_kmer_length, max_sub_score):
+        if (max_kmer_length, max_sub_score) in self._train_diagonal_values:
+            return self._train_diagonal_values[(max_kmer_length, max_sub_score)]
+
+        diagonal_file = self.fm.diagonal_file_for_params(max_kmer_length, max_sub_score)
+        with self.run_statistics.stage('matrix_load'):
+            diagonal_values = self.read_diagonal_values(max_kmer_length, max_sub_score, diagonal_file)
+        self._train_diagonal_values[(max_kmer_length, max_sub_score)] = diagonal_values  # same for every batch
+        return diagonal_values
+
+    def read_diagonal_values(self, max_kmer_length, max_sub_score, diagonal_file):
+        if os.path.isfile(diagonal_file):
+            # binary diagonal created by bl/model_builder.py
+            return numpy.load(diagonal_file, mmap_mode='r')
+
         if self.verbose:
             print('Reading diagonal values for matrix with K={k} and L={l}'.format(k=max_kmer_length, l=max_sub_score))
         matrix_file = self.fm.matrix_file_for_params(max_kmer_length, max_sub_score)
@@ -302,17 +459,20 @@ class SVMPredictor(object):
 
                     row_counter += 1
 
-        return diags
+        return numpy.asarray([diags[diag_index] for diag_index in range(len(diags))], dtype=numpy.float64)
 
-    def predict_query_matrix(self, train_matrix, query_matrix, query_acs, class_name, class_params):
+    def predict_query_matrix(self, train_matrix, query_matrix, class_name, class_params):
+        """ Fit the SVM of a class without pre-trained model and predict the query proteins
+        :return: tupel(decision values, probabilities of the positive class), one value per query
+        """
         helper = Helper(self.verbose)
 
-        # 1) Read fasta file:
-        train_fasta_file = self.fm.train_fasta_file
-        y_values_train, ac_list_train = helper.read_fasta_file(class_name, train_fasta_file)
+        # 1) Read labels of the training proteins:
+        y_values_train, ac_list_train = self.read_train_labels(class_name)
 
         # 2) Read matrix into array
-        gram_train = helper.read_matrix_file(train_matrix)
+        with self.run_statistics.stage('matrix_load'):
+            gram_train = helper.read_matrix_file(train_matrix)
 
         # 3) Train predictor
         c = class_params['C']
@@ -324,19 +484,52 @@ class SVMPredictor(object):
         else:
             class_weight_auto = False
 
-        classifier = self.train_predictor(gram_train, y_values_train, c, tol, class_weight_auto)
+        with self.run_statistics.stage('fit_{cl}'.format(cl=class_name)):
+            classifier = self.train_predictor(gram_train, y_values_train, c, tol, class_weight_auto)
         if self.verbose:
             print(classifier)
 
         # 4) Create numpy array from query-matrix
         gram_test = numpy.asarray(query_matrix)
 
-        # 6) Predict
-        results_for_class = self.predict_with_reliability_index(classifier, gram_test, query_acs, class_name)
-        
-        return results_for_class
+        # 5) Predict
+        if self.verbose:
+            print('Predicting for {cl} for query proteins'.format(cl=class_name))
+        with self.run_statistics.stage('predict_{cl}'.format(cl=class_name), len(gram_test)):
+            return classifier.decision_function(gram_test), classifier.predict_proba(gram_test)[:, 1]
+
+    def predict_kernel_group_with_model_bundle(self, max_kmer_length, max_sub_score, class_names, query_matrix):
+        """ Predict all given classes of a kernel-group with the pre-trained models
+        :return: tupel(decision values, probabilities of the positive class), one row per query and one column per
+                class of class_names
+        """
+        for class_name in class_names:
+            if self.model_bundle.kernel_params(class_name) != (max_kmer_length, max_sub_score):
+                error('Model-bundle for {cl} was built with other kernel-parameters than given in {fl} - '
+                      'please rebuild it with bl/model_builder.py'.format(cl=class_name, fl=self.fm.best_params))
+                exit(722)
+        if self.verbose:
+            print('Predicting for {cl} for query proteins with pre-trained model'.format(cl=', '.join(class_names)))
+
+        bundle_class_names = self.model_bundle.group_class_names(max_kmer_length, max_sub_score)
+        columns = [bundle_class_names.index(class_name) for class_name in class_names]
+        decision_values = self.model_bundle.group_decision_values(max_kmer_length, max_sub_score,
+                                                                  query_matrix)[:, columns]
+        positive_probabilities = self.model_bundle.group_positive_probabilities(max_kmer_length, max_sub_score,
+                                                                                decision_values)
+        return decision_values, positive_probabilities
+
+    def read_train_labels(self, class_name):
+        """ :return: tupel(y-values, AC-list) of the training proteins for the class, from the metadata-store
+        if available, otherwise from the training-fasta """
+        if self.metadata_store is not None and self.metadata_store.has_class(class_name):
+            return self.metadata_store.class_labels(class_name)
+
+        helper = Helper(self.verbose)
+        return helper.read_fasta_file(class_name, self.fm.train_fasta_file)
 
     def train_predictor(self, gram_train, y_train, c, tol, cw_auto):
+        from sklearn import svm  # only needed to fit models - predictions with a model-bundle don't import it
         if cw_auto:
             class_weights = 'balanced'
         else:
@@ -378,39 +571,5 @@ class SVMPredictor(object):
         return results
 
 
-    def predict_with_reliability_index(self, classifier, gram_query, query_acs, class_name):
-        if self.verbose:
-            print('Predicting for {cl} for query proteins'.format(cl=class_name))
-        predictions = classifier.decision_function(gram_query)
-        proba_predictions = classifier.predict_proba(gram_query)
-
-        if self.verbose:
-            print('Got {nr} predictions'.format(nr=len(predictions)))
-        results = defaultdict(list)
-       
-        for idx, p in enumerate(predictions):
-            prediction_class = None
-            if p > 0.0:
-                prediction_class = class_name
-            if self.verbose:
-                print('Query AC {ac} is predicted with {p} for {c}'.format(
-                    ac=query_acs[idx], p=p, c=class_name))
-
-            # get reliability index ranging between 0 and 100
-            prediction = proba_predictions[idx,1]
-            prediction = prediction * 100
-            if class_name == "Traveller":
-                prediction = prediction/self.TRAVELLER_MAX
-            else:
-                prediction = prediction/self.SN_MAX            
-            prediction = round(prediction,2)
-            if prediction_class == None:
-                prediction = None
-            results[query_acs[idx]].append(prediction_class)
-            results[query_acs[idx]].append(prediction)
-
-        return results
-        
-
 def error(*objs):
     print("ERROR: ", *objs, file=sys.stderr)
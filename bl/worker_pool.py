@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+""" Pool of worker processes to run independent calls of external programs (e.g. my-string-kernel) concurrently
+"""
+from __future__ import print_function
+import multiprocessing
+import resource
+import subprocess
+import sys
+import time
+
+
+def call_external_program(program_call):
+    """ Run an external program and wait for it - defined on module level, so it can be sent to worker processes.
+    :param program_call: Program and its arguments as list
+    :return: tupel(exit-code, stdout, stderr, run-time) - exit-code 127 if the program could not be started at all.
+            run-time is a tupel(wall-seconds, cpu-seconds) of the program, see bl/run_statistics.py
+    """
+    wall_start = time.perf_counter()
+    # the calling process runs one program at a time, so the growth of its children's usage is this program's
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        sp = subprocess.Popen(program_call, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as os_error:
+        return 127, b'', str(os_error).encode('utf8'), (time.perf_counter() - wall_start, 0.0)
+    out, err = sp.communicate()
+    children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = (children_end.ru_utime - children_start.ru_utime) + (children_end.ru_stime - children_start.ru_stime)
+    return sp.returncode, out, err, (time.perf_counter() - wall_start, cpu_seconds)
+
+
+class FinishedCall(object):
+
+    """ Result of a call that was run directly, offering the same get() as a result of the multiprocessing-pool """
+
+    def get(self):
+        return self.result
+
+    def __init__(self, result):
+        self.result = result
+
+
+class WorkerPool(object):
+
+    def submit_external_call(self, program_call):
+        """ Start an external program on the next free worker.
+        :param program_call: Program and its arguments as list
+        :return: Pending call, get() waits for it and returns tupel(exit-code, stdout, stderr, run-time)
+        """
+        if self._pool is None:
+            return FinishedCall(call_external_program(program_call))
+        else:
+            return self._pool.apply_async(call_external_program, (program_call,))
+
+    def close(self):
+        if self._pool is not None:
+            if self.verbose:
+                print('Shutting down {nr} workers'.format(nr=self.jobs))
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __init__(self, is_verbose, jobs):
+        self.verbose = is_verbose
+        self.jobs = max(1, int(jobs))
+        self._pool = None
+        if self.jobs > 1:
+            if self.verbose:
+                print('Starting {nr} workers'.format(nr=self.jobs))
+            self._pool = multiprocessing.Pool(self.jobs)
+
+
+def error(*objs):
+    print("ERROR: ", *objs, file=sys.stderr)
@@ -6,10 +6,15 @@ Sub-nuclear localization prediction for proteins of all (eukaryotic) species
 """
 from __future__ import print_function
 import argparse
+import os
 import sys
 
+from bl.combined_predictor import CombinedLocNucleiPredictor
 from bl.helper import Helper
+from bl.input_reader import InputReader
+from bl.kernel_backend import DEFAULT_KERNEL_BACKEND, KERNEL_BACKENDS
 from bl.locnuclei_predictor import LocNucleiPredictor
+from bl.run_statistics import RunStatistics
 
 
 def main():
@@ -19,19 +24,27 @@ def main():
     # parse command line options
     parser = argparse.ArgumentParser(description=__doc__, usage=usage_string)
     parser.add_argument('fasta_folder', help='Folder with protein sequences in fasta-format. '
-                                             'Every file may only contain one sequence.')
+                                             'Every file may only contain one sequence. '
+                                             'Or one (gzip-compressed) multi-fasta file with all sequences.')
     parser.add_argument('--fasta_suffix', help='Suffix of files in given Fasta-folder (default: "*.fasta")',
                         default='*.fasta')
     parser.add_argument('blast_folder', help='Folder with Blast-Profiles for the fasta files. '
                                              'Blast-Files need to have the same name in front of the suffix '
-                                             'as the fasta files! (e.g. Q9XLZ3.fasta <-> Q9XLZ3.profile)')
+                                             'as the fasta files! (e.g. Q9XLZ3.fasta <-> Q9XLZ3.profile). '
+                                             'Or, for a multi-fasta file, one archive with all profiles: a '
+                                             '(compressed) tar-archive of profile-files or all profiles concatenated '
+                                             'into one (gzip-compressed) file, each after a header-line ">{AC}".')
     parser.add_argument('--blast_suffix', help='Suffix of files in given Blast-Folder (default: "*.profile")',
                         default='*.profile')
     parser.add_argument('--temp_folder', help='Folder to work in, will be automatically deleted afterwards. '
                                               'If not given, a temporary directory will be created.')
     parser.add_argument('output_file', help='Where should results be written to?')
-    parser.add_argument('-t', '--traveller', help='Predict nuclear travelling proteins '
-                                                  'instead of sub-nuclear localization', action='store_true')
+    target_group = parser.add_mutually_exclusive_group()
+    target_group.add_argument('-t', '--traveller', help='Predict nuclear travelling proteins '
+                                                        'instead of sub-nuclear localization', action='store_true')
+    target_group.add_argument('-c', '--combined', help='Predict sub-nuclear localization and nuclear travelling in '
+                                                       'one run, both written to the output file',
+                              action='store_true')
 
     parser.add_argument('-d', '--debug',
                         help='Toggles clean up of temporary files off, '
@@ -39,17 +52,94 @@ def main():
                         action='store_true')
     parser.add_argument('-v', '--verbose', help='Toggles verbose mode on', action='store_true')
     parser.add_argument('-b', '--only_blast', help='Only run the blast search', action='store_true')
+    parser.add_argument('-j', '--jobs', help='Number of processes to run in parallel (default: 1)', type=int,
+                        default=1)
+    parser.add_argument('--blast_threads', help='Number of threads per BLAST-call (default: 1)', type=int,
+                        default=1)
+    parser.add_argument('--batch_size', help='Predict the proteins in batches of this size and append the results '
+                                             'of every batch to the output file as soon as it is done '
+                                             '(default: all proteins in one batch, 500 for a multi-fasta file)',
+                        type=int)
+    parser.add_argument('--cache_file', help='SQLite-file to cache results in - proteins with the same sequence and '
+                                             'profile are then only predicted once for the same models')
+    parser.add_argument('--cache_max_mb', help='Maximum size of the result-cache in MB, least recently used results '
+                                               'are evicted (default: 1024)', type=float, default=1024)
+    parser.add_argument('--kmer_min_score', help='Skip BLAST for proteins whose k-mer score against the lookup-'
+                                                 'proteins is below this value (default: 4 for sub-nuclear, 0 for '
+                                                 'traveller predictions; 0 disables the prefilter)', type=int)
+    parser.add_argument('--kernel_backend', help='How the string-kernel of the query proteins is calculated: '
+                                                 '"binary" calls bl/data/my-string-kernel, "numpy" calculates the '
+                                                 'same values in Python (default: binary)',
+                        choices=KERNEL_BACKENDS, default=DEFAULT_KERNEL_BACKEND)
+    parser.add_argument('--stats_file', help='Write wall-clock/CPU time per stage, peak memory and counters of the '
+                                             'run as JSON to this file')
+    parser.add_argument('--prometheus_file', help='Write the run-statistics to this file in the textfile-format of '
+                                                  'the Prometheus node-exporter')
+    parser.add_argument('--resume', help='Continue a run that died from the checkpoints in its --temp_folder: '
+                                         'finished BLAST-searches, kernels and predictions are not repeated and '
+                                         'the output file is written again', action='store_true')
+    parser.add_argument('--profile', help='Profile the run with cProfile and tracemalloc, written to PREFIX.prof '
+                                          'and PREFIX.memory.txt', metavar='PREFIX')
     args = parser.parse_args()
     print(args)
     helper = Helper(args.verbose)
+    if args.resume and not args.temp_folder:
+        error('--resume needs the --temp_folder of the run to resume')
+        exit(760)
     if helper.folder_existence_check(args.fasta_folder):  # check if fasta-folder exists and is reachable
         if helper.folder_existence_check(args.blast_folder):  # check if blast-profile-folder exists and is reachable
-            if helper.file_not_there_check(args.output_file):  # check if output-file doesn't exist yet -
-                                                               # no overwriting of existing files
-                with LocNucleiPredictor(args.verbose, args.debug, args.traveller) as loc_nuclei:
-                    loc_nuclei.predict_given_files(args.fasta_folder, args.fasta_suffix, args.blast_folder,
-                                                   args.blast_suffix, args.temp_folder, args.output_file, 
-                                                   args.only_blast)
+            # check if output-file doesn't exist yet - no overwriting of existing files, unless a run is resumed
+            if args.resume or helper.file_not_there_check(args.output_file):
+                query_records = None
+                batch_size = args.batch_size
+                if os.path.isfile(args.fasta_folder):
+                    # one multi-fasta file and one profile archive, read lazily batch by batch
+                    if not os.path.isfile(args.blast_folder):
+                        error('For the multi-fasta file {fl} the profiles need to be given as one archive, not as '
+                              'folder'.format(fl=args.fasta_folder))
+                        exit(780)
+                    query_records = InputReader(args.verbose).iter_query_proteins(args.fasta_folder,
+                                                                                  args.blast_folder)
+                    batch_size = batch_size or LocNucleiPredictor.DEFAULT_BATCH_SIZE
+                run_statistics = RunStatistics(args.verbose)
+                if args.profile:
+                    run_statistics.start_profiling()
+                if args.combined:
+                    with CombinedLocNucleiPredictor(args.verbose, args.debug, args.jobs, args.blast_threads,
+                                                    args.cache_file, args.cache_max_mb, args.kmer_min_score,
+                                                    args.kernel_backend, run_statistics,
+                                                    resume=args.resume) as loc_nuclei:
+                        if query_records is not None:
+                            loc_nuclei.predict_query_records(query_records, args.temp_folder, args.output_file,
+                                                             args.only_blast, batch_size)
+                        else:
+                            loc_nuclei.predict_given_files(args.fasta_folder, args.fasta_suffix, args.blast_folder,
+                                                           args.blast_suffix, args.temp_folder, args.output_file,
+                                                           args.only_blast, args.batch_size)
+                else:
+                    with LocNucleiPredictor(args.verbose, args.debug, args.traveller, args.jobs,
+                                            args.blast_threads, args.cache_file, args.cache_max_mb,
+                                            args.kmer_min_score, args.kernel_backend, run_statistics,
+                                            resume=args.resume) as loc_nuclei:
+                        if query_records is not None:
+                            loc_nuclei.stream_query_records(query_records, args.temp_folder, args.output_file,
+                                                            args.only_blast, batch_size)
+                        elif args.batch_size:
+                            loc_nuclei.stream_given_files(args.fasta_folder, args.fasta_suffix, args.blast_folder,
+                                                          args.blast_suffix, args.temp_folder, args.output_file,
+                                                          args.only_blast, args.batch_size)
+                        else:
+                            loc_nuclei.predict_given_files(args.fasta_folder, args.fasta_suffix, args.blast_folder,
+                                                           args.blast_suffix, args.temp_folder, args.output_file,
+                                                           args.only_blast)
+                if args.profile:
+                    run_statistics.stop_profiling(args.profile)
+                if args.verbose:
+                    run_statistics.print_summary()
+                if args.stats_file:
+                    run_statistics.write_json_report(args.stats_file)
+                if args.prometheus_file:
+                    run_statistics.write_prometheus_textfile(args.prometheus_file)
 
 
 def error(*objs):
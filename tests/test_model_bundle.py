@@ -0,0 +1,96 @@
+# -*- coding: utf8 -*-
+""" Parity of the model-bundle predictions with svm.SVC(kernel='precomputed', probability=True) """
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from sklearn import svm
+
+from bl.model_bundle import ModelBundle
+
+
+class ModelBundleTest(unittest.TestCase):
+
+    TRAIN_SIZE = 60
+    QUERY_SIZE = 25
+    # two classes sharing (l, y) form a stacked kernel-group, the third one has a group of its own
+    CLASS_PARAMS = [('Nucleolus', {'l': 3, 'y': 5}), ('Chromatin', {'l': 3, 'y': 5}), ('Nuclear_Speckles',
+                                                                                        {'l': 4, 'y': 7})]
+
+    def test_group_predictions_match_sklearn(self):
+        for max_kmer_length, max_sub_score in self.bundle.kernel_group_params():
+            support = self.bundle.kernel_group_support(max_kmer_length, max_sub_score)
+            gram_query = self.gram_query[:, support]
+            decision_values = self.bundle.group_decision_values(max_kmer_length, max_sub_score, gram_query)
+            probabilities = self.bundle.group_positive_probabilities(max_kmer_length, max_sub_score, decision_values)
+
+            class_names = self.bundle.group_class_names(max_kmer_length, max_sub_score)
+            self.assertEqual(decision_values.shape, (self.QUERY_SIZE, len(class_names)))
+            for class_index, class_name in enumerate(class_names):
+                classifier = self.classifiers[class_name]
+                self.assertTrue(numpy.allclose(decision_values[:, class_index],
+                                               classifier.decision_function(self.gram_query)))
+                self.assertTrue(numpy.allclose(probabilities[:, class_index],
+                                               classifier.predict_proba(self.gram_query)[:, 1]))
+
+    def test_stacked_group_has_several_classes(self):
+        self.assertEqual(self.bundle.group_class_names(3, 5), ['Nucleolus', 'Chromatin'])
+
+    def test_class_predictions_match_sklearn(self):
+        for class_name, classifier in self.classifiers.items():
+            support = self.bundle.kernel_group_support(*self.bundle.kernel_params(class_name))
+            decision_values = self.bundle.decision_values(class_name, self.gram_query[:, support])
+            self.assertTrue(numpy.allclose(decision_values, classifier.decision_function(self.gram_query)))
+            self.assertTrue(numpy.allclose(self.bundle.positive_probabilities(class_name, decision_values),
+                                           classifier.predict_proba(self.gram_query)[:, 1]))
+
+    def test_bundle_file_round_trip(self):
+        bundle_file = os.path.join(self.temp_folder, 'model_bundle.npz')
+        self.bundle.write_bundle_file(bundle_file)
+        read_bundle = ModelBundle(False)
+        read_bundle.read_bundle_file(bundle_file)
+
+        self.assertEqual(read_bundle.class_names, self.bundle.class_names)
+        for max_kmer_length, max_sub_score in self.bundle.kernel_group_params():
+            gram_query = self.gram_query[:, self.bundle.kernel_group_support(max_kmer_length, max_sub_score)]
+            decision_values = self.bundle.group_decision_values(max_kmer_length, max_sub_score, gram_query)
+            read_decision_values = read_bundle.group_decision_values(max_kmer_length, max_sub_score, gram_query)
+            self.assertTrue(numpy.array_equal(read_decision_values, decision_values))
+            self.assertTrue(numpy.array_equal(
+                read_bundle.group_positive_probabilities(max_kmer_length, max_sub_score, read_decision_values),
+                self.bundle.group_positive_probabilities(max_kmer_length, max_sub_score, decision_values)))
+
+    def setUp(self):
+        self.temp_folder = tempfile.mkdtemp()
+        random_state = numpy.random.RandomState(17)
+        # a linear kernel of random features is positive semi-definite, as the normalized string-kernel
+        features = random_state.normal(size=(self.TRAIN_SIZE + self.QUERY_SIZE, 8))
+        gram = features.dot(features.T)
+        gram_train = gram[:self.TRAIN_SIZE, :self.TRAIN_SIZE]
+        self.gram_query = gram[self.TRAIN_SIZE:, :self.TRAIN_SIZE]
+
+        self.bundle = ModelBundle(False)
+        self.bundle.train_size = self.TRAIN_SIZE
+        self.classifiers = dict()
+        for class_index, (class_name, class_params) in enumerate(self.CLASS_PARAMS):
+            labels = (features[:self.TRAIN_SIZE, class_index] + 0.5 * random_state.normal(size=self.TRAIN_SIZE) >
+                      0.3).astype(int)
+            classifier = svm.SVC(kernel='precomputed', probability=True, C=0.5, random_state=class_index)
+            classifier.fit(gram_train, labels)
+            self.classifiers[class_name] = classifier
+            self.bundle.add_class_model(class_name, class_params, classifier)
+
+        for max_kmer_length, max_sub_score in self.bundle.kernel_group_params():
+            support_union = numpy.unique(numpy.concatenate(
+                [self.bundle.class_support(class_name) for class_name in self.bundle.class_names
+                 if self.bundle.kernel_params(class_name) == (max_kmer_length, max_sub_score)]))
+            self.bundle.add_kernel_group(max_kmer_length, max_sub_score, support_union,
+                                         numpy.diag(gram_train)[support_union])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+""" Parity of the numpy profile-kernel with bl/data/my-string-kernel on the example proteins """
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import numpy
+
+from bl.helper import Helper
+from bl.kernel_backend import StringKernelBackend
+from bl.profile_kernel import ProfileKernel
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_FOLDER = os.path.join(REPO_FOLDER, 'bl', 'data')
+EXAMPLE_FOLDER = os.path.join(REPO_FOLDER, 'example')
+BEST_PARAMS_FILES = (os.path.join(DATA_FOLDER, 'sn', 'sn_best_params'),
+                     os.path.join(DATA_FOLDER, 'tr', 'tr_best_params'))
+
+
+def string_kernel_runs():
+    """ :return: True if my-string-kernel can be executed on this machine """
+    try:
+        subprocess.call([os.path.join(DATA_FOLDER, 'my-string-kernel')], stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+    except OSError:
+        return False
+    return True
+
+
+class StringKernelFiles(object):
+
+    """ The files of bl/data needed to build a my-string-kernel call, as provided by the ExternalFileManager """
+
+    def __init__(self):
+        self.my_string_kernel = os.path.join(DATA_FOLDER, 'my-string-kernel')
+        self.amino_file = os.path.join(DATA_FOLDER, 'Amino.txt')
+        self.globals_file = os.path.join(DATA_FOLDER, 'sn', 'matrices', 'sn.globals')
+
+
+@unittest.skipUnless(string_kernel_runs(), 'my-string-kernel can not be executed on this machine')
+class ProfileKernelTest(unittest.TestCase):
+
+    def test_kernel_rows_match_string_kernel(self):
+        helper = Helper(False)
+        kernel_params = sorted(set((params['l'], params['y']) for best_params_file in BEST_PARAMS_FILES
+                                   for params in helper.read_param_file(best_params_file).values()))
+        profile_kernel = ProfileKernel(False)
+        string_kernel = StringKernelBackend(False, StringKernelFiles(), None, None)
+
+        for max_kmer_length, max_sub_score in kernel_params:
+            kernel_call = string_kernel.build_string_kernel_call(max_kmer_length, max_sub_score, self.id_file,
+                                                                 self.kernel_input, self.id_file, self.kernel_input)
+            binary_values = string_kernel.parse_string_kernel_output(subprocess.check_output(kernel_call,
+                                                                                             stderr=subprocess.PIPE))
+
+            index = profile_kernel.build_index(self.kernel_input, max_kmer_length, max_sub_score)
+            numpy_values = profile_kernel.kernel_rows(index, self.kernel_input)
+
+            self.assertEqual(numpy_values.shape, (len(self.protein_names), len(self.protein_names) + 1))
+            self.assertTrue(numpy.array_equal(numpy_values, binary_values),
+                            'kernel values differ for l={l} and y={y}'.format(l=max_kmer_length, y=max_sub_score))
+
+    def setUp(self):
+        """ Write the example proteins as kernel input, as the SVMPredictor does for query proteins """
+        helper = Helper(False)
+        self.temp_folder = tempfile.mkdtemp()
+        self.protein_names = sorted(os.path.basename(fasta_file)[:-len('.fasta')]
+                                    for fasta_file in glob.glob(os.path.join(EXAMPLE_FOLDER, '*.fasta')))
+        self.id_file = os.path.join(self.temp_folder, 'example.idList')
+        self.kernel_input = os.path.join(self.temp_folder, 'example.psiBlastMat')
+        with open(self.id_file, 'w') as id_out, open(self.kernel_input, 'w') as kernel_out:
+            for protein_name in self.protein_names:
+                id_out.write('{p}\n'.format(p=protein_name))
+                for line in helper.clean_fasta_input(os.path.join(EXAMPLE_FOLDER, protein_name + '.fasta'),
+                                                     protein_name):
+                    kernel_out.write(line)
+                kernel_out.write('\n')
+                with open(os.path.join(EXAMPLE_FOLDER, protein_name + '.profile'), 'r') as profile_src:
+                    kernel_out.write(profile_src.read())
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
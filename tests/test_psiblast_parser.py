@@ -0,0 +1,55 @@
+# -*- coding: utf8 -*-
+""" Parity of the blastpgp-parser with psi-blast2hssp.pl and the 'maxSeqId'-selection of PrintBlastPredictions.jar
+
+The expected hits are the lines psi-blast2hssp.pl writes for the blast-files in tests/data/psiblast/.
+"""
+import os
+import unittest
+
+from bl.psiblast_parser import PsiBlastParser
+
+BLAST_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'psiblast')
+
+
+class PsiBlastParserTest(unittest.TestCase):
+
+    # tupel(hit_ac, identity, alignment_length, e_value, hssp_distance) per blast-file
+    EXPECTED_HITS = {
+        # round 1 is ignored, of P84588 only the first of two alignments counts, the gaps of O70576 are not aligned
+        'converged.blastPsiOutTmp': [('P84588', 75.0, 120, 'e-106', 48),
+                                     ('O70576', 79.8, 188, '2e-67', 57)],
+        # rounds 1 and 2 are ignored, the first three hits have the same identity
+        'round3.blastPsiOutTmp': [('Q8VDL9', 60.0, 100, '1e-81', 31),
+                                  ('Q9HDC9', 60.0, 145, '4e-46', 35),
+                                  ('P08985', 60.0, 10, '8e-13', -40),
+                                  ('P08433', 33.3, 3, '0.040', -67)],
+        'no_hits.blastPsiOutTmp': [],
+    }
+    EXPECTED_BEST_HITS = {
+        'converged.blastPsiOutTmp': 'O70576',
+        'round3.blastPsiOutTmp': 'Q8VDL9',  # the first of the tied hits
+        'no_hits.blastPsiOutTmp': None,
+    }
+
+    def test_read_hits(self):
+        for blast_file, expected_hits in self.EXPECTED_HITS.items():
+            hits = self.parser.read_hits(os.path.join(BLAST_FOLDER, blast_file))
+            self.assertEqual([(hit.hit_ac, hit.identity, hit.alignment_length, hit.e_value, hit.hssp_distance)
+                              for hit in hits], expected_hits, blast_file)
+
+    def test_best_hit(self):
+        for blast_file, expected_hit_ac in self.EXPECTED_BEST_HITS.items():
+            best_hit = self.parser.best_hit(os.path.join(BLAST_FOLDER, blast_file))
+            self.assertEqual(None if best_hit is None else best_hit.hit_ac, expected_hit_ac, blast_file)
+
+    def test_hssp_distance(self):
+        self.assertEqual(self.parser.hssp_distance(50.0, 11), -50.0)
+        self.assertEqual(self.parser.hssp_distance(50.0, 451), 30.5)
+        self.assertEqual(int(round(self.parser.hssp_distance(75.0, 120))), 48)
+
+    def setUp(self):
+        self.parser = PsiBlastParser(False)
+
+
+if __name__ == '__main__':
+    unittest.main()